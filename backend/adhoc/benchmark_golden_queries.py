@@ -0,0 +1,116 @@
+"""
+Benchmarks the latency of retrieving the closest golden queries for a question,
+with 1k, 10k and 100k golden queries in a single db_name.
+
+Random unit vectors are inserted under a throwaway db_name, and then we time
+`get_closest_golden_queries` (which uses the HNSW index) as well as an exact
+search with index scans disabled, for comparison. The rows are deleted at the end.
+
+Run it inside the backend container:
+$ python adhoc/benchmark_golden_queries.py
+"""
+
+import asyncio
+import sys
+import time
+
+import numpy as np
+from db_config import engine
+from db_models import EMBEDDING_DIMENSIONS, GoldenQueries
+from sqlalchemy import delete, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from utils_golden_queries import get_closest_golden_queries
+
+SIZES = [1_000, 10_000, 100_000]
+NUM_SEARCHES = 200
+NUM_GOLDEN_QUERIES = 4
+INSERT_BATCH_SIZE = 5_000
+BENCHMARK_DB_NAME = "__benchmark_golden_queries__"
+
+
+def random_unit_vectors(n: int, rng: np.random.Generator) -> np.ndarray:
+    vectors = rng.standard_normal((n, EMBEDDING_DIMENSIONS)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+async def insert_golden_queries(start: int, end: int, rng: np.random.Generator):
+    for batch_start in range(start, end, INSERT_BATCH_SIZE):
+        batch_end = min(batch_start + INSERT_BATCH_SIZE, end)
+        vectors = random_unit_vectors(batch_end - batch_start, rng)
+        async with AsyncSession(engine) as session:
+            async with session.begin():
+                await session.execute(
+                    insert(GoldenQueries),
+                    [
+                        {
+                            "db_name": BENCHMARK_DB_NAME,
+                            "question": f"benchmark question {i}",
+                            "sql": f"SELECT {i};",
+                            "embedding": vector.tolist(),
+                        }
+                        for i, vector in zip(range(batch_start, batch_end), vectors)
+                    ],
+                )
+
+
+async def exact_closest_golden_queries(question_embedding: list[float]):
+    async with AsyncSession(engine) as session:
+        async with session.begin():
+            await session.execute(text("SET LOCAL enable_indexscan = off"))
+            result = await session.execute(
+                select(GoldenQueries.question)
+                .where(GoldenQueries.db_name == BENCHMARK_DB_NAME)
+                .order_by(GoldenQueries.embedding.cosine_distance(question_embedding))
+                .limit(NUM_GOLDEN_QUERIES)
+            )
+            return [row[0] for row in result.all()]
+
+
+async def time_searches(search_fn, queries: np.ndarray) -> list[float]:
+    latencies = []
+    for query in queries:
+        t_start = time.perf_counter()
+        await search_fn(query.tolist())
+        latencies.append((time.perf_counter() - t_start) * 1000)
+    return latencies
+
+
+async def delete_benchmark_rows():
+    async with AsyncSession(engine) as session:
+        async with session.begin():
+            await session.execute(
+                delete(GoldenQueries).where(GoldenQueries.db_name == BENCHMARK_DB_NAME)
+            )
+
+
+async def main(sizes: list[int]):
+    rng = np.random.default_rng(0)
+    await delete_benchmark_rows()
+    num_inserted = 0
+    print(f"{'golden queries':>15} | {'hnsw p50 (ms)':>13} | {'hnsw p95 (ms)':>13} | {'exact p50 (ms)':>14} | {'exact p95 (ms)':>14}")
+    try:
+        for size in sorted(sizes):
+            await insert_golden_queries(num_inserted, size, rng)
+            num_inserted = size
+            async with engine.begin() as conn:
+                await conn.execute(text("ANALYZE golden_queries"))
+
+            queries = random_unit_vectors(NUM_SEARCHES, rng)
+            hnsw_latencies = await time_searches(
+                lambda q: get_closest_golden_queries(
+                    BENCHMARK_DB_NAME, q, num_queries=NUM_GOLDEN_QUERIES
+                ),
+                queries,
+            )
+            exact_latencies = await time_searches(exact_closest_golden_queries, queries)
+            print(
+                f"{size:>15} | {np.percentile(hnsw_latencies, 50):>13.2f} | {np.percentile(hnsw_latencies, 95):>13.2f} "
+                f"| {np.percentile(exact_latencies, 50):>14.2f} | {np.percentile(exact_latencies, 95):>14.2f}"
+            )
+    finally:
+        await delete_benchmark_rows()
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    asyncio.run(main(sizes))
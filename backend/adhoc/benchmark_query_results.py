@@ -0,0 +1,116 @@
+"""
+Benchmarks turning query results into a dataframe: the previous path (which
+collects all the rows as python lists, copies them, builds an object
+dataframe and then re-types it column by column with `mk_df`) against the
+arrow path (which converts each chunk of rows into arrow arrays as soon as it
+is fetched, and then converts the typed arrow table with `mk_df_from_arrow`).
+
+The rows are synthetic, and are yielded in chunks like the pooled drivers do.
+Each path runs in a fresh process, so that their peak memory can be compared.
+
+This doesn't need a database, and can be run from the backend directory:
+$ python adhoc/benchmark_query_results.py [num_rows] [num_columns]
+"""
+
+import asyncio
+import datetime
+import multiprocessing
+import resource
+import sys
+import time
+from contextlib import aclosing
+from decimal import Decimal
+from unittest.mock import patch
+
+NUM_ROWS = 1_000_000
+NUM_COLUMNS = 30
+CHUNK_SIZE = 1000
+
+
+def mk_value(row: int, col: int):
+    """
+    Columns cycle through ints, floats, decimals, strings, dates and timestamps.
+    """
+    kind = col % 6
+    if kind == 0:
+        return row * col
+    elif kind == 1:
+        return row / (col + 1)
+    elif kind == 2:
+        return Decimal(row) / 100
+    elif kind == 3:
+        return f"customer {row % 5000}"
+    elif kind == 4:
+        return datetime.date(2020, 1, 1) + datetime.timedelta(days=row % 1000)
+    return datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=row)
+
+
+async def stream_query(num_rows: int, num_columns: int):
+    columns = [f"col_{i}" for i in range(num_columns)]
+    for start in range(0, num_rows, CHUNK_SIZE):
+        yield columns, [
+            [mk_value(row, col) for col in range(num_columns)]
+            for row in range(start, min(start + CHUNK_SIZE, num_rows))
+        ]
+
+
+async def previous_path(num_rows: int, num_columns: int):
+    from utils_df import mk_df
+
+    columns, rows = [], []
+    async with aclosing(stream_query(num_rows, num_columns)) as chunks:
+        async for columns, chunk in chunks:
+            rows.extend(chunk)
+    data = [list(row) for row in rows]
+    return mk_df(data, columns)
+
+
+async def arrow_path(num_rows: int, num_columns: int):
+    import utils_query_results
+    from utils_df import mk_df_from_arrow
+
+    def fake_stream_query(db_type, db_creds, query, chunk_size, timeout=None):
+        return stream_query(num_rows, num_columns)
+
+    with patch.object(utils_query_results, "stream_query", fake_stream_query):
+        results = await utils_query_results.fetch_query_results(
+            "postgres", {}, "SELECT * FROM t", max_rows=num_rows, chunk_size=CHUNK_SIZE
+        )
+    return mk_df_from_arrow(results.table)
+
+
+def run(path_name: str, num_rows: int, num_columns: int, queue: multiprocessing.Queue):
+    path = {"previous": previous_path, "arrow": arrow_path}[path_name]
+    # import everything before measuring the baseline memory
+    import utils_df
+    import utils_query_results
+
+    baseline_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    t_start = time.perf_counter()
+    df = asyncio.run(path(num_rows, num_columns))
+    elapsed = time.perf_counter() - t_start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((elapsed, peak_mb - baseline_mb, df.memory_usage(deep=True).sum() / 1024**2))
+
+
+def main(num_rows: int, num_columns: int):
+    print(f"{num_rows} rows x {num_columns} columns, fetched {CHUNK_SIZE} rows at a time\n")
+    print(f"{'path':>8} | {'time (s)':>8} | {'peak memory (MB)':>16} | {'df memory (MB)':>14}")
+    ctx = multiprocessing.get_context("spawn")
+    for path_name in ["previous", "arrow"]:
+        queue = ctx.Queue()
+        process = ctx.Process(target=run, args=(path_name, num_rows, num_columns, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            # e.g. killed for running out of memory
+            print(f"{path_name:>8} | failed with exit code {process.exitcode}")
+            continue
+        elapsed, peak_mb, df_mb = queue.get()
+        print(f"{path_name:>8} | {elapsed:>8.1f} | {peak_mb:>16.0f} | {df_mb:>14.0f}")
+
+
+if __name__ == "__main__":
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_ROWS
+    num_columns = int(sys.argv[2]) if len(sys.argv) > 2 else NUM_COLUMNS
+    main(num_rows, num_columns)
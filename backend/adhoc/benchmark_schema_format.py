@@ -0,0 +1,108 @@
+"""
+Benchmarks the compact schema format against the DDL format for a db_name,
+using its golden queries as the ground truth.
+
+For each schema format, we measure:
+- the number of tokens in the full rendered schema
+- the average number of input tokens of the SQL generation requests
+- SQL accuracy: the fraction of golden questions for which the generated SQL
+  returns the same results as the golden SQL (see `compare_query_results`)
+
+Golden queries are not included in the prompts (and the SQL cache is bypassed),
+so that the golden SQL isn't simply copied.
+
+Run it inside the backend container:
+$ python adhoc/benchmark_schema_format.py <db_name> [max_questions]
+"""
+
+import asyncio
+import sys
+
+import numpy as np
+import tiktoken
+from db_utils import get_db_type_creds
+from utils_golden_queries import get_all_golden_queries
+from utils_md import mk_schema_prompt
+from utils_schema_context import get_schema_context
+from utils_sql import compare_query_results, execute_sql, generate_sql_query
+
+SCHEMA_FORMATS = ["ddl", "compact"]
+ENCODING = tiktoken.get_encoding("o200k_base")
+
+
+async def evaluate(
+    question: str,
+    golden_sql: str,
+    db_name: str,
+    db_type: str,
+    db_creds: dict,
+    schema_format: str,
+) -> tuple[bool, int | None]:
+    """
+    Returns whether the SQL generated for the question is correct, and the
+    number of input tokens used to generate it.
+    """
+    resp = await generate_sql_query(
+        question=question,
+        db_name=db_name,
+        db_type=db_type,
+        num_golden_queries=0,
+        cache="bypass",
+        schema_format=schema_format,
+    )
+    input_tokens = (resp.get("usage") or {}).get("input_tokens")
+    if resp.get("error") or not resp.get("sql"):
+        return False, input_tokens
+    df_gen, err_msg = await execute_sql(db_type, db_creds, resp["sql"])
+    if err_msg:
+        return False, input_tokens
+    result = await compare_query_results(
+        query_gold=golden_sql,
+        query_gen=resp["sql"],
+        df_gen=df_gen,
+        question=question,
+        db_type=db_type,
+        db_creds=db_creds,
+    )
+    return result["correct"], input_tokens
+
+
+async def main(db_name: str, max_questions: int | None):
+    schema_context = await get_schema_context(db_name)
+    db_type, db_creds = await get_db_type_creds(db_name)
+    golden_queries = await get_all_golden_queries(db_name)
+    if not golden_queries:
+        print(f"No golden queries found for {db_name}")
+        return
+    golden_queries = golden_queries[:max_questions]
+    print(
+        f"{db_name}: {len(schema_context.metadata)} columns, "
+        f"{len(golden_queries)} golden queries\n"
+    )
+
+    print(f"{'format':>8} | {'schema tokens':>13} | {'avg input tokens':>16} | {'accuracy':>8}")
+    for schema_format in SCHEMA_FORMATS:
+        schema = mk_schema_prompt(
+            schema_context.metadata, schema_context.table_descriptions, schema_format
+        )
+        results = [
+            await evaluate(
+                gq["question"], gq["sql"], db_name, db_type, db_creds, schema_format
+            )
+            for gq in golden_queries
+        ]
+        accuracy = np.mean([correct for correct, _ in results])
+        input_tokens = [tokens for _, tokens in results if tokens is not None]
+        avg_input_tokens = np.mean(input_tokens) if input_tokens else float("nan")
+        print(
+            f"{schema_format:>8} | {len(ENCODING.encode(schema)):>13} "
+            f"| {avg_input_tokens:>16.0f} | {accuracy:>8.1%}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python adhoc/benchmark_schema_format.py <db_name> [max_questions]")
+        sys.exit(1)
+    max_questions = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    asyncio.run(main(sys.argv[1], max_questions))
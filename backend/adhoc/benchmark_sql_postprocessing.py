@@ -0,0 +1,99 @@
+"""
+Benchmarks the post-processing of generated SQL: the previous path (which
+parses the SQL once to add the hard filters, and then reformats the rendered
+SQL with sqlparse and checks it with a regex) against `postprocess_sql` (which
+parses the SQL once, applies all transforms to the AST and renders it once).
+
+The queries are synthetic analytic queries with a configurable number of CTEs,
+each of which has joins, aggregates and divisions by NULLIF(...).
+
+This doesn't need a database, and can be run from the backend directory:
+$ python adhoc/benchmark_sql_postprocessing.py [num_ctes ...]
+"""
+
+import sys
+import time
+
+import numpy as np
+from request_models import HardFilter
+from utils_sql import add_hard_filters, clean_generated_query, postprocess_sql, safe_sql
+
+NUM_CTES = [1, 5, 20]
+NUM_RUNS = 50
+HARD_FILTERS = [
+    HardFilter(table_name="orders", column_name="region", operator="=", value="EMEA"),
+    HardFilter(table_name="customers", column_name="is_test", operator="=", value="false"),
+]
+
+
+def mk_analytic_query(num_ctes: int) -> str:
+    """
+    Returns a query with num_ctes CTEs of ~14 lines each, that are joined together.
+    """
+    ctes = []
+    for i in range(num_ctes):
+        ctes.append(
+            f"""cte_{i} AS (
+  SELECT c.customer_id,
+         c.segment,
+         DATE_TRUNC('month', o.created_at) AS month,
+         COUNT(DISTINCT o.order_id) AS num_orders,
+         SUM(o.amount) AS revenue,
+         SUM(o.amount) / NULLIF(COUNT(DISTINCT o.order_id), 0) AS avg_order_value,
+         SUM(CASE WHEN o.status = 'refunded' THEN o.amount ELSE 0 END) / NULLIF(SUM(o.amount), 0) AS refund_rate
+  FROM orders o
+  JOIN customers c ON o.customer_id = c.customer_id
+  WHERE o.created_at >= '2024-01-01' AND o.amount > {i}
+  GROUP BY c.customer_id, c.segment, DATE_TRUNC('month', o.created_at)
+  HAVING COUNT(*) > 1
+)"""
+        )
+    select = ",\n       ".join(f"cte_{i}.revenue AS revenue_{i}" for i in range(num_ctes))
+    joins = "\n".join(
+        f"JOIN cte_{i} ON cte_{i}.customer_id = cte_0.customer_id AND cte_{i}.month = cte_0.month"
+        for i in range(1, num_ctes)
+    )
+    return (
+        "WITH "
+        + ",\n".join(ctes)
+        + f"\nSELECT cte_0.customer_id, cte_0.month,\n       {select}\nFROM cte_0\n{joins}\n"
+        + "ORDER BY cte_0.month DESC\nLIMIT 100"
+    )
+
+
+def previous_path(sql: str) -> str | None:
+    sql = add_hard_filters(sql, HARD_FILTERS)
+    sql = clean_generated_query(sql)
+    return sql if safe_sql(sql) else None
+
+
+def single_parse_path(sql: str) -> str | None:
+    sql, _ = postprocess_sql(sql, "postgres", HARD_FILTERS)
+    return sql
+
+
+def time_ms(fn, sql: str) -> tuple[float, float]:
+    timings = []
+    for _ in range(NUM_RUNS):
+        t_start = time.perf_counter()
+        fn(sql)
+        timings.append((time.perf_counter() - t_start) * 1000)
+    return np.percentile(timings, 50), np.percentile(timings, 95)
+
+
+def main(num_ctes_list: list[int]):
+    print(f"{NUM_RUNS} runs per query\n")
+    print(f"{'lines':>6} | {'previous p50 / p95 (ms)':>24} | {'single parse p50 / p95 (ms)':>28} | {'speedup':>7}")
+    for num_ctes in num_ctes_list:
+        sql = mk_analytic_query(num_ctes)
+        previous_p50, previous_p95 = time_ms(previous_path, sql)
+        single_p50, single_p95 = time_ms(single_parse_path, sql)
+        print(
+            f"{len(sql.splitlines()):>6} | {previous_p50:>11.1f} / {previous_p95:>10.1f} "
+            f"| {single_p50:>13.1f} / {single_p95:>12.1f} | {previous_p50 / single_p50:>6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    num_ctes_list = [int(num_ctes) for num_ctes in sys.argv[1:]] or NUM_CTES
+    main(num_ctes_list)
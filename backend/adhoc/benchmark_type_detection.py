@@ -0,0 +1,94 @@
+"""
+Benchmarks determining the types of string columns with `determine_column_type`
+(which guesses the type from a sample with a single combined regex, and then
+only checks that type against the whole column) against the previous
+implementation (which cast the whole column to strings and matched it against
+each type's pattern in turn, up to six times).
+
+The columns are synthetic string columns of each type, like the ones that text
+columns of query results are. Both implementations are checked to agree.
+
+This doesn't need a database, and can be run from the backend directory:
+$ python adhoc/benchmark_type_detection.py [num_rows] [num_columns]
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from utils_df import (
+    REGEX_DATE_PATTERN,
+    REGEX_DATETIME_PATTERN,
+    REGEX_FLOAT_PATTERN,
+    REGEX_INTEGER_PATTERN,
+    REGEX_MONEY_PATTERN,
+    REGEX_TIME_PATTERN,
+    TYPE_DATE,
+    TYPE_DATETIME,
+    TYPE_FLOAT,
+    TYPE_INTEGER,
+    TYPE_MONEY,
+    TYPE_STRING,
+    TYPE_TIME,
+    determine_column_type,
+)
+
+NUM_ROWS = 1_000_000
+NUM_COLUMNS = 20
+
+
+def previous_determine_column_type(column: pd.Series) -> str:
+    if column.dtype == "object":
+        if column.astype(str).str.match(REGEX_DATE_PATTERN).all():
+            return TYPE_DATE
+        if column.astype(str).str.match(REGEX_TIME_PATTERN).all():
+            return TYPE_TIME
+        if column.astype(str).str.match(REGEX_DATETIME_PATTERN).all():
+            return TYPE_DATETIME
+        if column.astype(str).str.match(REGEX_INTEGER_PATTERN).all():
+            return TYPE_INTEGER
+        if column.astype(str).str.match(REGEX_FLOAT_PATTERN).all():
+            return TYPE_FLOAT
+        if column.astype(str).str.match(REGEX_MONEY_PATTERN).all():
+            return TYPE_MONEY
+        return TYPE_STRING
+    return determine_column_type(column)
+
+
+def mk_column(kind: int, num_rows: int) -> pd.Series:
+    """
+    Columns cycle through text, dates, datetimes, ints, floats and money.
+    """
+    values = np.arange(num_rows)
+    if kind == 0:
+        column = "customer " + pd.Series(values % 5000).astype(str)
+    elif kind == 1:
+        column = pd.Series(pd.Timestamp("2020-01-01") + pd.to_timedelta(values % 1000, unit="D")).dt.strftime("%Y-%m-%d")
+    elif kind == 2:
+        column = pd.Series(pd.Timestamp("2020-01-01") + pd.to_timedelta(values, unit="s")).dt.strftime("%Y-%m-%d %H:%M:%S")
+    elif kind == 3:
+        column = pd.Series(values).astype(str)
+    elif kind == 4:
+        column = pd.Series(values / 7).round(3).astype(str)
+    else:
+        column = "$" + pd.Series(values / 4).map("{:,.2f}".format)
+    return column.astype(object)
+
+
+def main(num_rows: int, num_columns: int):
+    columns = [mk_column(i % 6, num_rows) for i in range(num_columns)]
+    print(f"{num_rows} rows x {num_columns} string columns\n")
+    print(f"{'implementation':>14} | {'time (s)':>8}")
+    types = {}
+    for name, fn in [("previous", previous_determine_column_type), ("sampled", determine_column_type)]:
+        t_start = time.perf_counter()
+        types[name] = [fn(column) for column in columns]
+        print(f"{name:>14} | {time.perf_counter() - t_start:>8.2f}")
+    assert types["previous"] == types["sampled"], types
+
+
+if __name__ == "__main__":
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_ROWS
+    num_columns = int(sys.argv[2]) if len(sys.argv) > 2 else NUM_COLUMNS
+    main(num_rows, num_columns)
@@ -0,0 +1,117 @@
+"""
+Reports the recall vs prompt size trade-off of schema pruning for a db_name,
+using its golden queries as the ground truth.
+
+For each golden query, we extract the tables and columns referenced in its SQL,
+prune the schema for its question at different values of `max_tables`, and
+measure:
+- table recall: fraction of the referenced tables that were kept
+- column recall: fraction of the referenced columns that were kept (columns are
+  matched by name within the kept tables, since they are often unqualified)
+- the number of tokens in the pruned DDL, compared to the full DDL
+
+The other settings (max_columns_per_table, max_join_hops) are read from the
+db_name's schema pruning config, if any.
+
+Run it inside the backend container:
+$ python adhoc/report_schema_pruning.py <db_name> [max_tables ...]
+"""
+
+import asyncio
+import sys
+
+import numpy as np
+import tiktoken
+from sqlglot import exp, parse_one
+from utils_embedding import get_embeddings
+from utils_golden_queries import get_all_golden_queries
+from utils_md import mk_create_ddl
+from utils_schema_context import get_schema_context
+from utils_schema_pruning import prune_schema
+
+MAX_TABLES = [3, 5, 10, 20]
+ENCODING = tiktoken.get_encoding("o200k_base")
+
+
+def get_referenced_tables_columns(sql: str) -> tuple[set[str], set[str]]:
+    """
+    Returns the lowercased table names (with their schema, if any) and column
+    names referenced in the SQL.
+    """
+    parsed = parse_one(sql)
+    cte_names = {cte.alias_or_name.lower() for cte in parsed.find_all(exp.CTE)}
+    tables = set()
+    for table in parsed.find_all(exp.Table):
+        table_name = f"{table.db}.{table.name}" if table.db else table.name
+        if table_name.lower() not in cte_names:
+            tables.add(table_name.lower())
+    columns = {column.name.lower() for column in parsed.find_all(exp.Column)}
+    return tables, columns
+
+
+def get_kept_tables_columns(metadata: list[dict[str, str]]) -> tuple[set[str], set[str]]:
+    tables = {column["table_name"].lower() for column in metadata}
+    columns = {column["column_name"].lower() for column in metadata}
+    return tables, columns
+
+
+async def main(db_name: str, max_tables_list: list[int]):
+    schema_context = await get_schema_context(db_name)
+    metadata = schema_context.metadata
+    table_descriptions = schema_context.table_descriptions
+    full_tokens = len(ENCODING.encode(schema_context.ddl))
+
+    golden_queries = await get_all_golden_queries(db_name)
+    if not golden_queries:
+        print(f"No golden queries found for {db_name}")
+        return
+    question_embeddings = await get_embeddings([gq["question"] for gq in golden_queries])
+
+    references = []
+    for golden_query, question_embedding in zip(golden_queries, question_embeddings):
+        try:
+            tables, columns = get_referenced_tables_columns(golden_query["sql"])
+        except Exception as e:
+            print(f"Skipping golden query that could not be parsed: {golden_query['question']} ({e})")
+            continue
+        references.append((question_embedding, tables, columns))
+
+    print(
+        f"{db_name}: {len(metadata)} columns, {len({c['table_name'] for c in metadata})} tables, "
+        f"{full_tokens} tokens in the full DDL, {len(references)} golden queries\n"
+    )
+    print(f"{'max_tables':>10} | {'table recall':>12} | {'column recall':>13} | {'avg tokens':>10} | {'% of full':>9}")
+    for max_tables in max_tables_list:
+        config = schema_context.pruning_config.model_copy(
+            update={"enabled": True, "min_columns": 0, "max_tables": max_tables}
+        )
+        table_recalls, column_recalls, num_tokens = [], [], []
+        for question_embedding, tables, columns in references:
+            pruned_metadata, pruned_table_descriptions = await prune_schema(
+                question_embedding=question_embedding,
+                metadata=metadata,
+                table_descriptions=table_descriptions,
+                join_hints=schema_context.join_hints,
+                config=config,
+                db_name=db_name,
+            )
+            kept_tables, kept_columns = get_kept_tables_columns(pruned_metadata)
+            if tables:
+                table_recalls.append(len(tables & kept_tables) / len(tables))
+            if columns:
+                column_recalls.append(len(columns & kept_columns) / len(columns))
+            ddl = mk_create_ddl(pruned_metadata, pruned_table_descriptions)
+            num_tokens.append(len(ENCODING.encode(ddl)))
+        avg_tokens = np.mean(num_tokens)
+        print(
+            f"{max_tables:>10} | {np.mean(table_recalls):>12.3f} | {np.mean(column_recalls):>13.3f} "
+            f"| {avg_tokens:>10.0f} | {avg_tokens / full_tokens:>9.1%}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python adhoc/report_schema_pruning.py <db_name> [max_tables ...]")
+        sys.exit(1)
+    max_tables_list = [int(max_tables) for max_tables in sys.argv[2:]] or MAX_TABLES
+    asyncio.run(main(sys.argv[1], max_tables_list))
@@ -33,6 +33,7 @@ from request_models import (
     ResetPasswordRequest,
     UserRequest
 )
+from utils_cache import get_all_cache_stats
 from utils_logging import LOGGER
 
 router = APIRouter()
@@ -286,6 +287,17 @@ async def get_users(request: UserRequest):
     return {"users": users_list}
 
 
+@router.post("/admin/get_cache_stats")
+async def get_cache_stats(request: UserRequest):
+    """
+    Get the hit / miss stats of all in-process caches in the worker serving this request.
+    """
+    if not await validate_admin_privileges(request.token):
+        return ADMIN_REQUIRED_RESPONSE
+
+    return {"cache_stats": get_all_cache_stats()}
+
+
 @router.post("/admin/update_user_status")
 async def update_user_status(request: UpdateUserStatusRequest):
     """
@@ -14,6 +14,10 @@ REDIS_PORT = os.getenv("REDIS_INTERNAL_PORT", 6379)
 redis_client = redis.Redis(
     host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True
 )
+# for values that are not utf-8 strings, e.g. packed embeddings
+redis_client_binary = redis.Redis(
+    host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=False
+)
 
 INTERNAL_DB = os.environ.get("INTERNAL_DB", None)
 
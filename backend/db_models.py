@@ -1,5 +1,6 @@
 from datetime import datetime
 import enum
+import os
 from sqlalchemy import (
     Boolean,
     Column,
@@ -10,10 +11,11 @@ from sqlalchemy import (
     MetaData,
     Text,
     Enum,
+    Float,
 )
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import declarative_base, mapped_column
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import HALFVEC, Vector
 from datetime import datetime
 
 base_metadata = MetaData()
@@ -123,12 +125,170 @@ class Instructions(Base):
     join_hints = Column(JSONB)
 
 
+class SchemaPruning(Base):
+    """
+    Stores the schema pruning config for each db_name (see
+    request_models.SchemaPruningConfig). Schemas are not pruned for db_names
+    without a row here.
+    """
+
+    __tablename__ = "schema_pruning"
+    db_name = Column(Text, primary_key=True)
+    enabled = Column(Boolean, default=False)
+    max_tables = Column(Integer)
+    max_columns_per_table = Column(Integer)
+    min_columns = Column(Integer)
+    max_join_hops = Column(Integer)
+
+
+class SchemaFormat(Base):
+    """
+    Stores the format used to render the schema of each db_name in our prompts
+    (see utils_md.mk_schema_prompt). db_names without a row here use "ddl".
+    """
+
+    __tablename__ = "schema_format"
+    db_name = Column(Text, primary_key=True)
+    schema_format = Column(Text, nullable=False)
+
+
+class QueryRowLimit(Base):
+    """
+    Stores the max number of rows fetched from each db_name per query (see
+    utils_query_results). db_names without a row here use QUERY_MAX_ROWS.
+    """
+
+    __tablename__ = "query_row_limit"
+    db_name = Column(Text, primary_key=True)
+    max_rows = Column(Integer, nullable=False)
+
+
+class QueryCacheTTL(Base):
+    """
+    Stores how long the results of queries on each db_name are cached for, in
+    seconds (see utils_query_cache). A ttl of 0 disables the cache for the
+    db_name. db_names without a row here use QUERY_CACHE_TTL.
+    """
+
+    __tablename__ = "query_cache_ttl"
+    db_name = Column(Text, primary_key=True)
+    ttl = Column(Integer, nullable=False)
+
+
+class QueryTimeout(Base):
+    """
+    Stores the max number of seconds that a query on each db_name can run for
+    (see utils_query_results). db_names without a row here use QUERY_TIMEOUT.
+    """
+
+    __tablename__ = "query_timeout"
+    db_name = Column(Text, primary_key=True)
+    timeout = Column(Integer, nullable=False)
+
+
+class QueryPreflight(Base):
+    """
+    Stores the query preflight config for each db_name (see
+    request_models.QueryPreflightConfig). Queries are not estimated before
+    they are run for db_names without a row here.
+    """
+
+    __tablename__ = "query_preflight"
+    db_name = Column(Text, primary_key=True)
+    enabled = Column(Boolean, default=False)
+    max_cost = Column(Float)
+
+
+# Embeddings have a fixed number of dimensions so that they can be indexed.
+# Set GOLDEN_QUERIES_EMBEDDING_TYPE=halfvec to store them at half precision,
+# which halves the storage needed for the embeddings and their index.
+EMBEDDING_DIMENSIONS = 512
+GOLDEN_QUERIES_EMBEDDING_TYPE = os.getenv("GOLDEN_QUERIES_EMBEDDING_TYPE", "vector")
+if GOLDEN_QUERIES_EMBEDDING_TYPE not in ("vector", "halfvec"):
+    raise ValueError(
+        f"GOLDEN_QUERIES_EMBEDDING_TYPE must be 'vector' or 'halfvec', got '{GOLDEN_QUERIES_EMBEDDING_TYPE}'"
+    )
+
+
 class GoldenQueries(Base):
+    """
+    Stores the golden (question, sql) pairs for each db_name, along with the
+    embedding of the question. The embeddings have an HNSW index for
+    approximate nearest neighbour search by cosine distance.
+    """
+
     __tablename__ = "golden_queries"
     db_name = Column(Text, primary_key=True)
     question = Column(Text, primary_key=True)
     sql = Column(Text)
-    embedding = mapped_column(Vector())
+    embedding = mapped_column(
+        HALFVEC(EMBEDDING_DIMENSIONS)
+        if GOLDEN_QUERIES_EMBEDDING_TYPE == "halfvec"
+        else Vector(EMBEDDING_DIMENSIONS)
+    )
+
+    __table_args__ = (
+        Index(
+            "golden_queries_embedding_idx",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": f"{GOLDEN_QUERIES_EMBEDDING_TYPE}_cosine_ops"},
+        ),
+    )
+
+
+class ColumnEmbeddings(Base):
+    """
+    Stores 1 embedding per column in the metadata of each db_name, computed from
+    the column name, data type, column description and table description.
+    embedding_text_hash is the hash of the text that was embedded, so that only
+    columns whose text has changed are re-embedded when the metadata or table
+    descriptions are updated.
+    """
+
+    __tablename__ = "column_embeddings"
+    db_name = Column(Text, primary_key=True)
+    table_name = Column(Text, primary_key=True)
+    column_name = Column(Text, primary_key=True)
+    embedding_text_hash = Column(Text)
+    embedding = mapped_column(Vector(EMBEDDING_DIMENSIONS))
+
+    __table_args__ = (
+        Index(
+            "column_embeddings_embedding_idx",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "vector_cosine_ops"},
+        ),
+    )
+
+
+class InstructionChunks(Base):
+    """
+    Stores the sql_instructions of each db_name split into chunks (roughly 1
+    rule each), with their embeddings, so that only the chunks relevant to a
+    question have to be pasted into our prompts. Pinned chunks are always
+    included. chunk_index is the position of the chunk in the instructions.
+    """
+
+    __tablename__ = "instruction_chunks"
+    db_name = Column(Text, primary_key=True)
+    chunk_index = Column(Integer, primary_key=True)
+    content = Column(Text, nullable=False)
+    pinned = Column(Boolean, default=False)
+    embedding = mapped_column(Vector(EMBEDDING_DIMENSIONS))
+
+    __table_args__ = (
+        Index(
+            "instruction_chunks_embedding_idx",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "vector_cosine_ops"},
+        ),
+    )
 
 
 # ANALYSIS DETAILS
@@ -1,12 +1,21 @@
 """Database credential utility functions."""
 
+import copy
 import traceback
 from typing import Dict, Tuple
-from defog.query import async_execute_query_once
 from sqlalchemy import delete, select, update, insert
 from utils_md import get_metadata
 from db_config import engine
 from db_models import Metadata, Project, PDFFiles
+from utils_cache import (
+    LRUCache,
+    bump_db_creds_version,
+    bump_schema_version,
+    get_db_creds_version,
+    register_cache_stats,
+)
+from utils_column_embeddings import schedule_column_embeddings_refresh
+from utils_connection_pool import execute_query, invalidate_pools
 from utils_logging import LOGGER
 from defog import Defog
 import os
@@ -17,14 +26,55 @@ from sqlalchemy.ext.asyncio import AsyncSession
 home_dir = os.path.expanduser("~")
 defog_path = os.path.join(home_dir, ".defog")
 
+# the db type and creds of each db_name are cached per worker. The version
+# counter in redis invalidates them across workers as soon as they are changed
+# through update_db_type_creds or delete_db_info, and the short ttl bounds how
+# stale they can be if the project table is modified directly.
+DB_CREDS_CACHE_TTL = float(os.getenv("DB_CREDS_CACHE_TTL", 30))
+DB_CREDS_CACHE = LRUCache(max_size=256, ttl=DB_CREDS_CACHE_TTL)
+register_cache_stats("db_creds", DB_CREDS_CACHE.stats)
 
-async def get_db_type_creds(db_name: str) -> Tuple[str, Dict[str, str]] | None:
+
+async def load_db_type_creds(db_name: str) -> Tuple[str, Dict[str, str]] | None:
     async with engine.begin() as conn:
         row = await conn.execute(
             select(Project.db_type, Project.db_creds).where(Project.db_name == db_name)
         )
         row = row.fetchone()
-    return row
+    return tuple(row) if row else None
+
+
+async def get_db_type_creds(db_name: str) -> Tuple[str, Dict[str, str]] | None:
+    """
+    Get the db type and creds of a db_name, or None if it doesn't exist.
+    They are served from DB_CREDS_CACHE when possible. The creds are copied, so
+    that callers can't modify the cached creds.
+    """
+    version = get_db_creds_version(db_name)
+    if version is None:
+        # redis is unavailable, so we can't tell if our cached creds are stale
+        return await load_db_type_creds(db_name)
+
+    cached = DB_CREDS_CACHE.get(db_name)
+    if cached is None or cached[0] != version:
+        res = await load_db_type_creds(db_name)
+        if res is None:
+            # not cached, so that the db_name is found as soon as it is added
+            return None
+        # if the version was bumped while we were loading, the stale creds
+        # will be replaced on the next call since their version no longer matches
+        cached = (version, res)
+        DB_CREDS_CACHE.set(db_name, cached)
+    db_type, db_creds = cached[1]
+    return db_type, copy.deepcopy(db_creds)
+
+
+def invalidate_db_type_creds(db_name: str):
+    """
+    Invalidate the cached db type and creds of a db_name, in all workers.
+    """
+    DB_CREDS_CACHE.delete(db_name)
+    bump_db_creds_version(db_name)
 
 
 async def get_db_names() -> list[str]:
@@ -54,6 +104,11 @@ async def update_db_type_creds(db_name, db_type, db_creds):
                 )
             )
 
+    invalidate_db_type_creds(db_name)
+    # close the pooled connections that use the old creds
+    if record and (record.db_type, record.db_creds) != (db_type, db_creds):
+        await invalidate_pools(record.db_type, record.db_creds)
+
     return True
 
 
@@ -65,9 +120,11 @@ async def validate_db_connection(db_type, db_creds):
     if db_type == "bigquery":
         db_creds["json_key_path"] = "./bq.json"
 
+    # the pool that this opens (for pooled db types) is reused by the queries
+    # that follow. Pools of creds that fail aren't kept.
     sql_query = "SELECT 'test';"
     try:
-        await async_execute_query_once(
+        await execute_query(
             db_type,
             db_creds,
             sql_query,
@@ -128,10 +185,16 @@ async def get_db_info(db_name):
 
 
 async def delete_db_info(db_name):
+    res = await get_db_type_creds(db_name)
+    if res:
+        await invalidate_pools(*res)
     async with engine.begin() as conn:
         await conn.execute(delete(Project).where(Project.db_name == db_name))
         # also delete from metadata table
         await conn.execute(delete(Metadata).where(Metadata.db_name == db_name))
+    invalidate_db_type_creds(db_name)
+    bump_schema_version(db_name)
+    schedule_column_embeddings_refresh(db_name)
         
         
         
@@ -1,10 +1,13 @@
+import asyncio
 import copy
 import re
 from datetime import datetime
+from typing import Awaitable, TypeVar
 
 import httpx
 import sqlparse
 from db_utils import get_db_names
+from fastapi import Request
 from utils_logging import LOG_LEVEL, LOGGER, truncate_obj
 
 
@@ -36,6 +39,41 @@ async def make_request(url, data, timeout=180, log_time=False):
     return response
 
 
+T = TypeVar("T")
+
+# seconds between checks of whether the client of a request has disconnected
+DISCONNECT_POLL_INTERVAL = 1.0
+
+
+class ClientDisconnectedError(Exception):
+    """
+    Raised by `run_until_disconnected` when the client of a request has
+    disconnected before its work was done.
+    """
+
+
+async def run_until_disconnected(request: Request, coro: Awaitable[T]) -> T:
+    """
+    Run the (long running) work of a request in a task, and cancel it if the
+    client disconnects first (e.g. if the browser tab is closed), so that the
+    queries it is running on the user's database are cancelled too.
+    Raises a ClientDisconnectedError if the client disconnected.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnectedError(f"Client disconnected from {request.url.path}")
+    finally:
+        # also when the request itself is cancelled
+        if not task.done():
+            task.cancel()
+            await asyncio.wait({task})
+
+
 def convert_nested_dict_to_list(table_metadata):
     """
     Convert a nested dictionary of table metadata to a list of dictionaries.
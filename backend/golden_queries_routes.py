@@ -5,8 +5,7 @@ from fastapi import APIRouter, Depends
 from fastapi.responses import JSONResponse
 from request_models import (GoldenQueriesDeleteRequest,
                             GoldenQueriesUpdateRequest, UserRequest)
-from utils_embedding import get_embedding
-from utils_golden_queries import delete_golden_query, get_all_golden_queries, set_golden_query
+from utils_golden_queries import delete_golden_queries, get_all_golden_queries, set_golden_queries
 from utils_logging import LOGGER
 
 router = APIRouter(
@@ -40,15 +39,13 @@ async def update_golden_queries_route(request: GoldenQueriesUpdateRequest):
     and not deleting any.
     """
     try:
-        for golden_query in request.golden_queries:
-            embedding = await get_embedding(text=golden_query.question)
-            await set_golden_query(
-                db_name=request.db_name,
-                question=golden_query.question,
-                sql=golden_query.sql,
-                question_embedding=embedding
-            )
-        return {"success": True}
+        stats = await set_golden_queries(
+            db_name=request.db_name,
+            golden_queries=[
+                golden_query.model_dump() for golden_query in request.golden_queries
+            ],
+        )
+        return {"success": True, **stats}
     except Exception as e:
         LOGGER.error(f"Error updating golden queries: {e}")
         LOGGER.error(traceback.format_exc())
@@ -63,8 +60,7 @@ async def delete_golden_queries_route(request: GoldenQueriesDeleteRequest):
     Deletes a list of golden queries for a given db_name.
     """
     try:
-        for question in request.questions:
-            await delete_golden_query(db_name=request.db_name, question=question)
+        await delete_golden_queries(db_name=request.db_name, questions=request.questions)
         return {"success": True}
     except Exception as e:
         LOGGER.error(f"Error deleting golden queries: {e}")
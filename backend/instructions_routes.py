@@ -1,7 +1,11 @@
 from auth_utils import validate_user_request
 from fastapi import APIRouter, Depends
 from request_models import InstructionsUpdateRequest, UserRequest
-from utils_instructions import get_instructions, set_instructions
+from utils_instructions import (
+    get_instructions,
+    refresh_instruction_chunks,
+    set_instructions,
+)
 
 router = APIRouter(
     dependencies=[Depends(validate_user_request)],
@@ -21,3 +25,14 @@ async def update_instructions_route(request: InstructionsUpdateRequest):
         db_name=request.db_name, instructions_text=request.instructions
     )
     return {"success": True}
+
+
+@router.post("/integration/refresh_instruction_chunks")
+async def refresh_instruction_chunks_route(request: UserRequest):
+    """
+    Split the instructions of a given database into chunks and embed them.
+    This happens automatically whenever the instructions are updated, so it is
+    only needed to backfill existing databases.
+    """
+    num_chunks = await refresh_instruction_chunks(db_name=request.db_name)
+    return {"num_chunks": num_chunks}
@@ -15,13 +15,23 @@ from db_utils import (
 )
 from db_config import redis_client
 from auth_utils import validate_user, validate_user_request
-from defog.query import async_execute_query_once
 from fastapi import APIRouter, Depends, Request
 from fastapi.responses import JSONResponse
 
-from request_models import UserRequest
+from request_models import (
+    QueryCacheTTLUpdateRequest,
+    QueryPreflightConfig,
+    QueryPreflightConfigUpdateRequest,
+    QueryRowLimitUpdateRequest,
+    QueryTimeoutUpdateRequest,
+    UserRequest,
+)
+from utils_connection_pool import execute_query
 from utils_logging import LOGGER
 from utils_md import check_metadata_validity, get_metadata, set_metadata
+from utils_query_cache import get_query_cache_ttl, set_query_cache_ttl
+from utils_query_preflight import get_query_preflight_config, set_query_preflight_config
+from utils_query_results import get_max_rows, get_query_timeout, set_max_rows, set_query_timeout
 
 home_dir = os.path.expanduser("~")
 defog_path = os.path.join(home_dir, ".defog")
@@ -187,7 +197,7 @@ async def preview_table(request: Request):
         sql_query = f"SELECT * FROM `{table_name}` LIMIT 10"
 
     try:
-        colnames, data = await async_execute_query_once(db_type, db_creds, sql_query)
+        colnames, data = await execute_query(db_type, db_creds, sql_query)
     except Exception as e:
         return {"error": f"Error executing query: {str(e)}"}
 
@@ -412,3 +422,70 @@ async def get_tables_and_files(req: UserRequest):
             status_code=500,
             content={"error": str(e)},
         )
+
+
+@router.post("/integration/get_query_row_limit")
+async def get_query_row_limit_route(req: UserRequest) -> dict[str, int]:
+    """
+    Get the max number of rows fetched per query from a given database.
+    """
+    return {"max_rows": await get_max_rows(req.db_name)}
+
+
+@router.post("/integration/set_query_row_limit")
+async def set_query_row_limit_route(req: QueryRowLimitUpdateRequest) -> None:
+    """
+    Set the max number of rows fetched per query from a given database, or
+    reset it to the default if max_rows is not set.
+    """
+    await set_max_rows(req.db_name, req.max_rows)
+
+
+@router.post("/integration/get_query_cache_ttl")
+async def get_query_cache_ttl_route(req: UserRequest) -> dict[str, int]:
+    """
+    Get how long query results from a given database are cached for, in seconds.
+    """
+    return {"ttl": await get_query_cache_ttl(req.db_name)}
+
+
+@router.post("/integration/set_query_cache_ttl")
+async def set_query_cache_ttl_route(req: QueryCacheTTLUpdateRequest) -> None:
+    """
+    Set how long query results from a given database are cached for, in
+    seconds (0 disables the cache), or reset it to the default if ttl is not set.
+    """
+    await set_query_cache_ttl(req.db_name, req.ttl)
+
+
+@router.post("/integration/get_query_timeout")
+async def get_query_timeout_route(req: UserRequest) -> dict[str, float]:
+    """
+    Get the max number of seconds that a query on a given database can run for.
+    """
+    return {"timeout": await get_query_timeout(req.db_name)}
+
+
+@router.post("/integration/set_query_timeout")
+async def set_query_timeout_route(req: QueryTimeoutUpdateRequest) -> None:
+    """
+    Set the max number of seconds that a query on a given database can run
+    for, or reset it to the default if timeout is not set.
+    """
+    await set_query_timeout(req.db_name, req.timeout)
+
+
+@router.post("/integration/get_query_preflight_config")
+async def get_query_preflight_config_route(req: UserRequest) -> QueryPreflightConfig:
+    """
+    Get the query preflight config for a given database.
+    """
+    return await get_query_preflight_config(req.db_name)
+
+
+@router.post("/integration/set_query_preflight_config")
+async def set_query_preflight_config_route(req: QueryPreflightConfigUpdateRequest) -> None:
+    """
+    Set the query preflight config for a given database.
+    """
+    await set_query_preflight_config(req.db_name, req.config)
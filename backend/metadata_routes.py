@@ -14,6 +14,9 @@ from request_models import (
     MetadataGenerateRequest,
     MetadataGetRequest,
     MetadataUpdateRequest,
+    SchemaFormatUpdateRequest,
+    SchemaPruningConfig,
+    SchemaPruningConfigUpdateRequest,
     TableDescription,
     TableDescriptionsUpdateRequest,
     UserRequest,
@@ -24,9 +27,17 @@ from utils_instructions import (
     get_join_hints,
     set_join_hints,
 )
+from utils_column_embeddings import refresh_column_embeddings
 from utils_join_hints import JoinHints, infer_join_hints
 from utils_logging import LOGGER
-from utils_md import check_metadata_validity, get_metadata, set_metadata
+from utils_md import (
+    check_metadata_validity,
+    get_metadata,
+    get_schema_format,
+    set_metadata,
+    set_schema_format,
+)
+from utils_schema_pruning import get_schema_pruning_config, set_schema_pruning_config
 from utils_table_descriptions import (
     delete_table_descriptions,
     get_all_table_descriptions,
@@ -209,3 +220,46 @@ async def infer_join_hints_route(req: UserRequest) -> JoinHints:
         req.db_name, metadata, table_descriptions, instructions
     )
     return join_hints
+
+
+@router.post("/integration/get_schema_pruning_config")
+async def get_schema_pruning_config_route(req: UserRequest) -> SchemaPruningConfig:
+    """
+    Get the schema pruning config for a given database.
+    """
+    return await get_schema_pruning_config(req.db_name)
+
+
+@router.post("/integration/set_schema_pruning_config")
+async def set_schema_pruning_config_route(req: SchemaPruningConfigUpdateRequest) -> None:
+    """
+    Set the schema pruning config for a given database.
+    """
+    await set_schema_pruning_config(req.db_name, req.config)
+
+
+@router.post("/integration/get_schema_format")
+async def get_schema_format_route(req: UserRequest) -> dict[str, str]:
+    """
+    Get the format used to render the schema of a given database in prompts.
+    """
+    return {"schema_format": await get_schema_format(req.db_name)}
+
+
+@router.post("/integration/set_schema_format")
+async def set_schema_format_route(req: SchemaFormatUpdateRequest) -> None:
+    """
+    Set the format used to render the schema of a given database in prompts,
+    either "ddl" (CREATE TABLE statements) or "compact".
+    """
+    await set_schema_format(req.db_name, req.schema_format)
+
+
+@router.post("/integration/refresh_column_embeddings")
+async def refresh_column_embeddings_route(req: UserRequest) -> dict[str, int]:
+    """
+    Embed any columns of a given database that don't have an up to date
+    embedding yet. This happens automatically whenever the metadata or table
+    descriptions are updated, so it is only needed to backfill existing databases.
+    """
+    return await refresh_column_embeddings(req.db_name)
@@ -178,6 +178,9 @@ class GenerateReportRequest(BaseModel):
     clarifications: List[Clarification] = []
     use_websearch: bool = True
     use_multi_agent: bool = True  # Toggle to enable multi-agent approach
+    # summarize database results with too many rows locally, rather than with
+    # a second, aggregated query
+    summarize_large_results: bool = False
 
     model_config = {
         "json_schema_extra": {
@@ -254,6 +257,7 @@ async def generate_report(req: GenerateReportRequest):
         post_tool_func=post_tool_func,
         pdf_file_ids=pdf_file_ids,
         use_websearch=req.use_websearch,
+        summarize_large_results=req.summarize_large_results,
     )
     
     main_content = analysis_response.report
@@ -22,9 +22,11 @@ async def data_fetcher_and_aggregator(
     db_name: str,
     hard_filters: list = [],
     previous_context: list = [],
+    use_cache: bool = True,
 ) -> Tuple[str, pd.DataFrame, str]:
     """
     This function generates a SQL query and runs it to get the answer.
+    Set use_cache to False to run the query even if its results are cached.
 
     IMPORTANT NOTE: Changing this function directly will NOT change the behavior of the tool immediately. You will have to rebuild the docker image to see changes in effect. This is because the tool code is compiled into a string that lives inside a postgres database, and that code string is then run to execute the tool.
     """
@@ -75,13 +77,14 @@ async def data_fetcher_and_aggregator(
                 db_name=db_name,
                 sql_query=query,
                 question=question,
+                use_cache=use_cache,
             )
         except Exception as e:
             raise Exception("Execution error: " + str(e) + "The SQL was: \n" + query)
     except Exception as e:
         err = str(e)
-    finally:
-        return err, df, sql_query
+    # not returned in a finally block, so that cancellation propagates
+    return err, df, sql_query
 
 
 send_email_input_metadata = {
@@ -46,6 +46,11 @@ class AnalysisData(BaseModel):
     output: Optional[str] = None
     error: Optional[str] = None
     pdf_search_results: Optional[list] = None
+    # whether the query returned more rows than the row limit, so that the output only has the first rows
+    truncated: Optional[bool] = None
+    # whether the output was served from the query result cache, and how old it is in seconds
+    cached: Optional[bool] = None
+    cache_age: Optional[float] = None
 
 
 class RerunEditedInputs(BaseModel):
@@ -59,3 +64,5 @@ class RerunRequest(BaseModel):
     db_name: str
     analysis_id: str
     edited_inputs: Optional[RerunEditedInputs] = None
+    # set to False to rerun the query even if its results are cached
+    cache: bool = True
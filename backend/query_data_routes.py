@@ -5,6 +5,7 @@ import logging
 from typing import List, Optional
 from fastapi import APIRouter, Request, Depends
 from fastapi.responses import JSONResponse
+from generic_utils import ClientDisconnectedError, run_until_disconnected
 from pydantic import BaseModel
 from file_upload_routes import upload_files_to_db
 from request_models import File, UserRequest
@@ -128,6 +129,9 @@ async def generate_analysis(request: Request):
     Each parent analysis has a user_question and analysis_id, steps:
      - `user_question` - contains the question asked by the user.
      - `sql` - is the sql generated in the parent analysis.
+
+    If the client disconnects before the data is fetched, the query is cancelled
+    on the user's database and the analysis is not updated.
     """
     try:
         LOGGER.info("Generating step")
@@ -202,7 +206,9 @@ async def generate_analysis(request: Request):
             previous_context=previous_context,
         )
 
-        err, df, sql_query = await data_fetcher_and_aggregator(**inputs)
+        err, df, sql_query = await run_until_disconnected(
+            request, data_fetcher_and_aggregator(**inputs)
+        )
 
         analysis_data.sql = None
 
@@ -215,6 +221,9 @@ async def generate_analysis(request: Request):
             deduplicated = deduplicate_columns(df)
 
             analysis_data.output = deduplicated.to_csv(float_format="%.3f", index=False)
+            analysis_data.truncated = df.attrs.get("truncated")
+            analysis_data.cached = df.attrs.get("cached")
+            analysis_data.cache_age = df.attrs.get("cache_age")
             analysis_data.error = None
 
         err, updated_analysis = await update_analysis_data(
@@ -223,6 +232,10 @@ async def generate_analysis(request: Request):
         )
 
         return JSONResponse(content=updated_analysis)
+    except ClientDisconnectedError as e:
+        LOGGER.info(str(e))
+        # nginx's "client closed request", although no one is listening
+        return JSONResponse(status_code=499, content=str(e))
     except Exception as e:
         LOGGER.error(e)
         traceback.print_exc()
@@ -411,7 +424,9 @@ async def rerun_endpoint(request: RerunRequest):
                 f"Question changed, rerunning from scratch with new question: {edited_inputs.question}"
             )
             new_inputs["question"] = edited_inputs.question
-            err, df, sql_query = await data_fetcher_and_aggregator(**new_inputs)
+            err, df, sql_query = await data_fetcher_and_aggregator(
+                **new_inputs, use_cache=request.cache
+            )
 
             analysis_data.sql = None
 
@@ -427,6 +442,9 @@ async def rerun_endpoint(request: RerunRequest):
                 analysis_data.output = deduplicated.to_csv(
                     float_format="%.3f", index=False
                 )
+                analysis_data.truncated = df.attrs.get("truncated")
+                analysis_data.cached = df.attrs.get("cached")
+                analysis_data.cache_age = df.attrs.get("cache_age")
                 analysis_data.error = None
         elif edited_inputs.sql:
             LOGGER.info("Question unchanged, rerunning the sql")
@@ -437,6 +455,7 @@ async def rerun_endpoint(request: RerunRequest):
                     db_name=db_name,
                     sql_query=new_query,
                     question=old_question,
+                    use_cache=request.cache,
                 )
 
                 analysis_data.sql = sql_query
@@ -447,6 +466,9 @@ async def rerun_endpoint(request: RerunRequest):
                 analysis_data.output = deduplicated.to_csv(
                     float_format="%.3f", index=False
                 )
+                analysis_data.truncated = df.attrs.get("truncated")
+                analysis_data.cached = df.attrs.get("cached")
+                analysis_data.cache_age = df.attrs.get("cache_age")
                 analysis_data.error = None
             except Exception as e:
                 analysis_data.error = str(e)
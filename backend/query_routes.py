@@ -1,10 +1,12 @@
 import traceback
 from auth_utils import validate_user_request
+from db_utils import get_db_type_creds
 from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse
-from request_models import GenerateSQLQueryRequest
+from fastapi.responses import JSONResponse, StreamingResponse
+from request_models import ExecuteSQLQueryRequest, GenerateSQLQueryRequest
 from utils_logging import LOGGER
-from utils_sql import generate_sql_query
+from utils_query_results import get_max_rows, get_query_timeout, stream_query_results
+from utils_sql import generate_sql_query, safe_sql
 
 
 router = APIRouter(
@@ -29,6 +31,11 @@ async def generate_sql_query_route(request: GenerateSQLQueryRequest):
             previous_context=request.previous_context,
             hard_filters=request.hard_filters,
             num_golden_queries=request.num_golden_queries,
+            cache=request.cache,
+            hedge_provider=request.hedge_provider,
+            hedge_model_name=request.hedge_model_name,
+            hedge_delay=request.hedge_delay,
+            schema_format=request.schema_format,
         )
         if resp is None:
             return JSONResponse(
@@ -39,8 +46,40 @@ async def generate_sql_query_route(request: GenerateSQLQueryRequest):
         return {
             "sql": sql,
             "error": error,
+            "cached": resp.get("cached", False),
+            # the golden question whose SQL was reused, if any
+            "golden_query": resp.get("golden_query", None),
+            # the model that generated the SQL, if an LLM was called
+            "model_name": resp.get("model_name", None),
+            # input / cached input / output tokens of the LLM request, if any
+            "usage": resp.get("usage", None),
+            # which request won and what the hedge request cost, if hedging
+            "hedge": resp.get("hedge", None),
         }
     except Exception as e:
         LOGGER.error(f"[generate_sql_query] ERROR: {e}")
         LOGGER.error(traceback.format_exc())
         return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+@router.post("/execute_sql_query")
+async def execute_sql_query_route(request: ExecuteSQLQueryRequest):
+    """
+    Run a SQL query on a database and stream the results as newline-delimited
+    JSON: a line with the `columns`, a line with the `rows` of each chunk, and
+    a last line with the `row_count` and whether the results were `truncated`
+    at the row limit of the database (or with the `error`, e.g. if the query
+    timed out).
+    """
+    res = await get_db_type_creds(request.db_name)
+    if not res:
+        return JSONResponse(status_code=400, content={"error": "no db creds found"})
+    if not safe_sql(request.sql):
+        return JSONResponse(status_code=400, content={"error": "Unsafe SQL query"})
+    db_type, db_creds = res
+    max_rows = await get_max_rows(request.db_name, request.max_rows)
+    timeout = await get_query_timeout(request.db_name, request.timeout)
+    return StreamingResponse(
+        stream_query_results(db_type, db_creds, request.sql, max_rows=max_rows, timeout=timeout),
+        media_type="application/x-ndjson",
+    )
@@ -1,5 +1,5 @@
 from typing import Any, Literal, Optional
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class UserRequest(BaseModel):
@@ -127,6 +127,104 @@ class JoinHintsUpdateRequest(UserRequest):
     join_hints: list[list[str]] | None = None
 
 
+class SchemaPruningConfig(BaseModel):
+    """
+    Controls how the schema is pruned before it is pasted into the SQL
+    generation prompt. Pruning only kicks in for schemas with more than
+    `min_columns` columns.
+    """
+
+    enabled: bool = False
+    max_tables: int = Field(10, ge=1)
+    max_columns_per_table: int = Field(30, ge=1)
+    min_columns: int = Field(200, ge=0)
+    # tables that are at most this many joins away from each other (according
+    # to the join hints) also pull in the tables in between them
+    max_join_hops: int = Field(2, ge=1)
+
+
+class SchemaPruningConfigUpdateRequest(UserRequest):
+    """
+    Request model for updating the schema pruning config.
+    """
+
+    config: SchemaPruningConfig
+
+
+# how the schema is rendered in our prompts: as CREATE TABLE statements, or in
+# a compact format that groups columns by data type (see utils_md.mk_compact_ddl)
+SchemaFormat = Literal["ddl", "compact"]
+
+
+class SchemaFormatUpdateRequest(UserRequest):
+    """
+    Request model for updating the schema format of a database.
+    """
+
+    schema_format: SchemaFormat
+
+
+class QueryRowLimitUpdateRequest(UserRequest):
+    """
+    Request model for updating the max number of rows fetched per query from
+    a database. Set max_rows to None to use the default (QUERY_MAX_ROWS).
+    """
+
+    max_rows: int | None = Field(None, ge=1)
+
+
+class QueryCacheTTLUpdateRequest(UserRequest):
+    """
+    Request model for updating how long query results from a database are
+    cached for, in seconds. 0 disables the cache for the database, and None
+    resets it to the default (QUERY_CACHE_TTL).
+    """
+
+    ttl: int | None = Field(None, ge=0)
+
+
+class QueryTimeoutUpdateRequest(UserRequest):
+    """
+    Request model for updating the max number of seconds that a query on a
+    database can run for. Set timeout to None to use the default (QUERY_TIMEOUT).
+    """
+
+    timeout: int | None = Field(None, ge=1)
+
+
+class QueryPreflightConfig(BaseModel):
+    """
+    Controls whether text_to_sql_tool estimates the rows and cost of a query
+    with EXPLAIN before running it (see utils_query_preflight). Queries whose
+    estimated cost is over `max_cost` are not run. The cost is in the planner's
+    units for postgres, redshift and mysql, and in bytes processed for bigquery.
+    """
+
+    enabled: bool = False
+    max_cost: float | None = Field(None, gt=0)
+
+
+class QueryPreflightConfigUpdateRequest(UserRequest):
+    """
+    Request model for updating the query preflight config.
+    """
+
+    config: QueryPreflightConfig
+
+
+class ExecuteSQLQueryRequest(UserRequest):
+    """
+    Request model for running a SQL query on a database, and streaming the
+    results back as newline-delimited JSON.
+    """
+
+    sql: str
+    # lowers the row limit of the db_name for this request
+    max_rows: int | None = Field(None, ge=1)
+    # lowers the query timeout of the db_name for this request, in seconds
+    timeout: float | None = Field(None, gt=0)
+
+
 class GoldenQuery(BaseModel):
     question: str
     sql: str
@@ -177,6 +275,20 @@ class GenerateSQLQueryRequest(UserRequest):
     num_golden_queries: int = 4
     model_name: str | None = None
 
+    # set to "bypass" to always generate a fresh query instead of returning
+    # a previously generated query for the exact same inputs
+    cache: Literal["use", "bypass"] = "use"
+
+    # if set, a second request is sent to hedge_model_name when the first one
+    # hasn't returned valid SQL within hedge_delay seconds, and the first valid
+    # SQL wins. hedge_provider defaults to the provider of the first request.
+    hedge_provider: str | None = None
+    hedge_model_name: str | None = None
+    hedge_delay: float = Field(5.0, ge=0)
+
+    # overrides the schema format of the db_name for this request
+    schema_format: SchemaFormat | None = None
+
     model_config = {
         "json_schema_extra": {
             "examples": [
@@ -1,10 +1,11 @@
+import asyncio
 import os
 from contextlib import asynccontextmanager
 
-from db_models import Base, Users
+from db_models import EMBEDDING_DIMENSIONS, Base, GoldenQueries, Users
 from fastapi import FastAPI
 from sqlalchemy import Engine, insert, text
-from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
 from sqlalchemy.ext.automap import automap_base
 from utils_logging import LOGGER
 
@@ -17,6 +18,43 @@ from utils_logging import LOGGER
 ################################################################################
 
 
+async def migrate_golden_queries_embedding(conn: AsyncConnection):
+    """
+    Convert golden_queries.embedding to the fixed-dimension type declared in the
+    model (vector or halfvec, see GOLDEN_QUERIES_EMBEDDING_TYPE), and create its
+    HNSW index if it doesn't exist yet.
+    """
+    column_type = GoldenQueries.__table__.c.embedding.type.compile(dialect=conn.dialect)
+    current_type = await conn.execute(text(
+        "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+        "WHERE attrelid = 'golden_queries'::regclass AND attname = 'embedding'"
+    ))
+    current_type = current_type.scalar()
+
+    if current_type and current_type.lower() != column_type.lower():
+        LOGGER.info(f"Converting golden_queries.embedding from {current_type} to {column_type}")
+        # the index's operator class depends on the column type, so it has to be rebuilt
+        await conn.execute(text("DROP INDEX IF EXISTS golden_queries_embedding_idx;"))
+        # embeddings with a different number of dimensions can't be converted.
+        # we clear them, and they will be re-embedded the next time the golden
+        # queries are updated.
+        cleared = await conn.execute(text(
+            f"UPDATE golden_queries SET embedding = NULL "
+            f"WHERE vector_dims(embedding::vector) != {EMBEDDING_DIMENSIONS};"
+        ))
+        if cleared.rowcount:
+            LOGGER.warning(
+                f"Cleared {cleared.rowcount} golden query embeddings that did not have {EMBEDDING_DIMENSIONS} dimensions"
+            )
+        await conn.execute(text(
+            f"ALTER TABLE golden_queries ALTER COLUMN embedding TYPE {column_type} "
+            f"USING embedding::{column_type};"
+        ))
+
+    for index in GoldenQueries.__table__.indexes:
+        await conn.run_sync(lambda sync_conn: index.create(sync_conn, checkfirst=True))
+
+
 async def init_db(engine: AsyncEngine):
     """
     Initialize database tables and update existing tables if their structure has changed.
@@ -132,6 +170,8 @@ async def init_db(engine: AsyncEngine):
                     if extra_columns:
                         LOGGER.warning(f"Table {table_name} has extra columns in the database that are not in the model: {extra_columns}")
                         LOGGER.warning("These columns will not be automatically dropped to prevent data loss")
+
+            await migrate_golden_queries_embedding(conn)
     except Exception as e:
         LOGGER.error(f"Error initializing database: {str(e)}")
         raise
@@ -198,6 +238,8 @@ async def lifespan(app: FastAPI):
     try:
         # Run validation on current llm sdk version to ensure models used are supported
         from db_config import engine
+        from utils_connection_pool import sweep_idle_pools
+        from utils_token_budget import preload_encodings
 
         LOGGER.info("Running startup events...")
 
@@ -206,6 +248,12 @@ async def lifespan(app: FastAPI):
         
         # Create admin user if doesn't exist
         await create_admin_user()
+
+        # tokenizers are loaded in the background so that startup doesn't wait
+        # on their download. Prompts are budgeted with estimates until then.
+        preload_encodings_task = asyncio.create_task(preload_encodings())
+        # close the connection pools of dbs that are no longer queried
+        sweep_idle_pools_task = asyncio.create_task(sweep_idle_pools())
         
         LOGGER.info("All startup events completed successfully")
 
@@ -215,6 +263,8 @@ async def lifespan(app: FastAPI):
         yield
 
         LOGGER.info("Shutting down...")
+        preload_encodings_task.cancel()
+        sweep_idle_pools_task.cancel()
     except Exception as e:
         LOGGER.error(f"Startup failed: {str(e)}")
         raise
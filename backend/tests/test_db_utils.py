@@ -0,0 +1,64 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import db_utils
+from db_utils import DB_CREDS_CACHE, delete_db_info, get_db_type_creds
+
+CREDS = {"host": "localhost", "user": "postgres", "password": "secret"}
+
+
+class TestGetDbTypeCreds(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        DB_CREDS_CACHE.clear()
+        self.version = 0
+        self.load = patch.object(
+            db_utils, "load_db_type_creds", AsyncMock(return_value=("postgres", CREDS))
+        ).start()
+        patch.object(db_utils, "get_db_creds_version", lambda db_name: self.version).start()
+
+    def tearDown(self):
+        patch.stopall()
+        DB_CREDS_CACHE.clear()
+
+    async def test_cached(self):
+        self.assertEqual(await get_db_type_creds("my_db"), ("postgres", CREDS))
+        self.assertEqual(await get_db_type_creds("my_db"), ("postgres", CREDS))
+        self.assertEqual(self.load.await_count, 1)
+
+    async def test_version_bump_reloads(self):
+        await get_db_type_creds("my_db")
+        self.version = 1
+        await get_db_type_creds("my_db")
+        self.assertEqual(self.load.await_count, 2)
+
+    async def test_redis_unavailable(self):
+        self.version = None
+        await get_db_type_creds("my_db")
+        await get_db_type_creds("my_db")
+        self.assertEqual(self.load.await_count, 2)
+
+    async def test_missing_db_is_not_cached(self):
+        self.load.return_value = None
+        self.assertIsNone(await get_db_type_creds("my_db"))
+        self.load.return_value = ("postgres", CREDS)
+        self.assertEqual(await get_db_type_creds("my_db"), ("postgres", CREDS))
+
+    async def test_returns_copy(self):
+        _, db_creds = await get_db_type_creds("my_db")
+        db_creds["password"] = "changed"
+        self.assertEqual((await get_db_type_creds("my_db"))[1]["password"], "secret")
+
+    async def test_delete_invalidates(self):
+        await get_db_type_creds("my_db")
+        bump = patch.object(db_utils, "bump_db_creds_version").start()
+        patch.object(db_utils, "invalidate_pools", AsyncMock()).start()
+        patch.object(db_utils, "bump_schema_version").start()
+        patch.object(db_utils, "schedule_column_embeddings_refresh").start()
+        patch.object(db_utils, "engine").start()
+        await delete_db_info("my_db")
+        bump.assert_called_once_with("my_db")
+        self.assertEqual(len(DB_CREDS_CACHE), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import generic_utils
+from generic_utils import ClientDisconnectedError, run_until_disconnected
+
+
+def fake_request(disconnected: bool):
+    request = MagicMock()
+    request.is_disconnected = AsyncMock(return_value=disconnected)
+    return request
+
+
+class TestRunUntilDisconnected(unittest.IsolatedAsyncioTestCase):
+    async def test_returns_result(self):
+        async def work():
+            await asyncio.sleep(0.01)
+            return "done"
+
+        self.assertEqual(await run_until_disconnected(fake_request(False), work()), "done")
+
+    async def test_cancels_on_disconnect(self):
+        cancelled = []
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        with patch.object(generic_utils, "DISCONNECT_POLL_INTERVAL", 0.01):
+            with self.assertRaises(ClientDisconnectedError):
+                await run_until_disconnected(fake_request(True), work())
+        self.assertEqual(cancelled, [True])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import tool_code_utilities
+from tool_code_utilities import fetch_query_into_df
+from utils_query_results import QueryResults
+from utils_sql_validation import SQLValidationResult
+
+
+class TestFetchQueryIntoDf(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patch.object(
+            tool_code_utilities, "get_db_type_creds", AsyncMock(return_value=("postgres", {}))
+        ).start()
+        patch.object(tool_code_utilities, "get_max_rows", AsyncMock(return_value=100)).start()
+        self.fetch = patch.object(
+            tool_code_utilities,
+            "fetch_cached_query_results",
+            AsyncMock(return_value=QueryResults.from_rows(["a"], [[1]])),
+        ).start()
+        self.retry = patch.object(
+            tool_code_utilities,
+            "retry_query_after_error",
+            AsyncMock(return_value={"sql": "SELECT a FROM fixed", "error": None}),
+        ).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def mock_validation(self, result: SQLValidationResult):
+        patch.object(tool_code_utilities, "validate_sql_for_db", AsyncMock(return_value=result)).start()
+
+    async def test_unknown_tables_are_run(self):
+        self.mock_validation(
+            SQLValidationResult("SELECT a FROM pg_catalog.pg_tables", warnings=["not checked"])
+        )
+        df, sql = await fetch_query_into_df("db", "SELECT a FROM pg_catalog.pg_tables")
+        self.assertEqual(sql, "SELECT a FROM pg_catalog.pg_tables")
+        self.assertEqual(df["a"].tolist(), [1])
+        self.assertFalse(df.attrs["truncated"])
+        self.retry.assert_not_awaited()
+
+    async def test_truncated(self):
+        self.mock_validation(SQLValidationResult("SELECT a FROM t"))
+        self.fetch.return_value = QueryResults.from_rows(["a"], [[1]], truncated=True)
+        df, _ = await fetch_query_into_df("db", "SELECT a FROM t")
+        self.assertTrue(df.attrs["truncated"])
+
+    async def test_validation_errors_are_fixed_before_running(self):
+        self.mock_validation(SQLValidationResult("SELECT b FROM t", errors=["Column `b` does not exist in `t`"]))
+        _, sql = await fetch_query_into_df("db", "SELECT b FROM t")
+        self.assertEqual(sql, "SELECT a FROM fixed")
+        self.assertEqual(self.fetch.await_args.kwargs["sql"], "SELECT a FROM fixed")
+
+    async def test_unfixable_validation_errors(self):
+        self.mock_validation(SQLValidationResult("SELECT b FROM t", errors=["Column `b` does not exist in `t`"]))
+        self.retry.return_value = {"sql": None, "error": "No metadata found"}
+        with self.assertRaisesRegex(ValueError, "Could not fix the SQL query"):
+            await fetch_query_into_df("db", "SELECT b FROM t")
+        self.fetch.assert_not_awaited()
+
+    async def test_unknown_tables_are_suggested_after_query_errors(self):
+        warning = "Table `customer` is not in the metadata (did you mean `customers`?), so it was not checked"
+        self.mock_validation(SQLValidationResult("SELECT a FROM customer", warnings=[warning]))
+        self.fetch.side_effect = [
+            RuntimeError("relation customer does not exist"),
+            QueryResults.from_rows(["a"], [[1]]),
+        ]
+        _, sql = await fetch_query_into_df("db", "SELECT a FROM customer")
+        self.assertEqual(sql, "SELECT a FROM fixed")
+        error = self.retry.await_args.kwargs["error"]
+        self.assertTrue(error.startswith("relation customer does not exist"))
+        self.assertIn(warning, error)
+
+    async def test_unfixable_query_errors(self):
+        self.mock_validation(SQLValidationResult("SELECT a FROM t"))
+        self.fetch.side_effect = RuntimeError("relation t does not exist")
+        self.retry.return_value = {"sql": None, "error": "No metadata found"}
+        with self.assertRaisesRegex(ValueError, "relation t does not exist"):
+            await fetch_query_into_df("db", "SELECT a FROM t")
+        self.assertEqual(self.fetch.await_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import utils_cache
+from utils_cache import LRUCache, get_query_setting, invalidate_query_setting
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_set(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("b", "default"), "default")
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # touch "a" so that "b" becomes the least recently used entry
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl(self):
+        cache = LRUCache(max_size=2, ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_stats(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+        self.assertAlmostEqual(stats["hit_rate"], 2 / 3)
+
+
+
+class TestGetQuerySetting(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patch.object(utils_cache, "QUERY_SETTINGS_CACHE", LRUCache(max_size=8)).start()
+        self.version = patch.object(utils_cache, "get_version", return_value=0).start()
+        self.bump = patch.object(utils_cache, "bump_version").start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    async def test_cached_until_version_changes(self):
+        load = AsyncMock(side_effect=[100, 200])
+        self.assertEqual(await get_query_setting("max_rows", "db", load), 100)
+        self.assertEqual(await get_query_setting("max_rows", "db", load), 100)
+        self.assertEqual(load.await_count, 1)
+        # another worker changed the setting
+        self.version.return_value = 1
+        self.assertEqual(await get_query_setting("max_rows", "db", load), 200)
+        self.assertEqual(load.await_count, 2)
+
+    async def test_invalidate(self):
+        load = AsyncMock(side_effect=[100, 200])
+        await get_query_setting("max_rows", "db", load)
+        invalidate_query_setting("max_rows", "db")
+        self.bump.assert_called_once_with(utils_cache.QUERY_SETTINGS_VERSION_NAMESPACE, "db")
+        self.assertEqual(await get_query_setting("max_rows", "db", load), 200)
+
+    async def test_not_cached_without_redis(self):
+        self.version.return_value = None
+        load = AsyncMock(side_effect=[100, 200])
+        self.assertEqual(await get_query_setting("max_rows", "db", load), 100)
+        self.assertEqual(await get_query_setting("max_rows", "db", load), 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import utils_column_embeddings
+from utils_column_embeddings import (
+    COLUMN_EMBEDDINGS_REFRESH_TASKS,
+    schedule_column_embeddings_refresh,
+)
+
+
+class TestScheduleColumnEmbeddingsRefresh(unittest.IsolatedAsyncioTestCase):
+    def tearDown(self):
+        patch.stopall()
+
+    async def test_refresh_runs_in_background(self):
+        refresh = patch.object(utils_column_embeddings, "refresh_column_embeddings", AsyncMock()).start()
+        task = schedule_column_embeddings_refresh("my_db")
+        refresh.assert_not_awaited()
+        await task
+        refresh.assert_awaited_once_with("my_db")
+        self.assertNotIn("my_db", COLUMN_EMBEDDINGS_REFRESH_TASKS)
+
+    async def test_refreshes_during_a_refresh_are_coalesced(self):
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_refresh(db_name):
+            started.set()
+            await release.wait()
+
+        refresh = patch.object(
+            utils_column_embeddings, "refresh_column_embeddings", AsyncMock(side_effect=slow_refresh)
+        ).start()
+        task = schedule_column_embeddings_refresh("my_db")
+        await started.wait()
+        self.assertIs(schedule_column_embeddings_refresh("my_db"), task)
+        self.assertIs(schedule_column_embeddings_refresh("my_db"), task)
+        release.set()
+        await task
+        # one refresh for the first call, and one more for the calls made during it
+        self.assertEqual(refresh.await_count, 2)
+
+    async def test_errors_are_logged(self):
+        patch.object(
+            utils_column_embeddings, "refresh_column_embeddings", AsyncMock(side_effect=RuntimeError("db is down"))
+        ).start()
+        with self.assertLogs(utils_column_embeddings.LOGGER, level="ERROR"):
+            await schedule_column_embeddings_refresh("my_db")
+        self.assertNotIn("my_db", COLUMN_EMBEDDINGS_REFRESH_TASKS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,307 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import utils_connection_pool
+from utils_connection_pool import (
+    POOL_LOCKS,
+    POOLS,
+    PoolEntry,
+    QueryTimeoutError,
+    execute_query,
+    get_creds_key,
+    invalidate_pools,
+    is_connection_error,
+    is_timeout_error,
+    run_query_in_chunks,
+    stream_query,
+    sweep_idle_pools,
+)
+
+CREDS = {"host": "localhost", "port": 5432, "user": "u", "password": "p", "database": "d"}
+
+
+class TestGetCredsKey(unittest.TestCase):
+    def test_key_ignores_order(self):
+        reordered = dict(reversed(list(CREDS.items())))
+        self.assertEqual(get_creds_key("postgres", CREDS), get_creds_key("postgres", reordered))
+
+    def test_key_changes_with_creds(self):
+        self.assertNotEqual(
+            get_creds_key("postgres", CREDS),
+            get_creds_key("postgres", {**CREDS, "password": "new"}),
+        )
+        self.assertNotEqual(get_creds_key("postgres", CREDS), get_creds_key("redshift", CREDS))
+
+    def test_key_does_not_contain_creds(self):
+        self.assertNotIn("localhost", get_creds_key("postgres", CREDS))
+
+
+class TestIsConnectionError(unittest.TestCase):
+    def test_connection_errors(self):
+        self.assertTrue(is_connection_error(ConnectionResetError()))
+        self.assertTrue(is_connection_error(type("InterfaceError", (Exception,), {})()))
+        self.assertTrue(is_connection_error(type("OperationalError", (Exception,), {})(2006, "gone away")))
+
+    def test_query_errors(self):
+        self.assertFalse(is_connection_error(ValueError("syntax error")))
+        self.assertFalse(is_connection_error(type("OperationalError", (Exception,), {})(1054, "unknown column")))
+
+
+class TestIsTimeoutError(unittest.TestCase):
+    def test_timeout_errors(self):
+        self.assertTrue(is_timeout_error(type("QueryCanceledError", (Exception,), {})("statement timeout")))
+        self.assertTrue(is_timeout_error(type("OperationalError", (Exception,), {})(3024, "max execution time exceeded")))
+        self.assertTrue(is_timeout_error(type("OperationalError", (Exception,), {})("HYT00", "query timeout expired")))
+
+    def test_other_errors(self):
+        self.assertFalse(is_timeout_error(ValueError("syntax error")))
+        self.assertFalse(is_timeout_error(type("OperationalError", (Exception,), {})(2006, "gone away")))
+
+
+class TestExecuteQuery(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        POOLS.clear()
+        self.create_pool = patch.object(utils_connection_pool, "create_pool", AsyncMock(side_effect=lambda *_: object())).start()
+        self.close_pool = patch.object(utils_connection_pool, "close_pool", AsyncMock()).start()
+        self.run_query = patch.object(utils_connection_pool, "run_query", AsyncMock(return_value=(["a"], [[1]]))).start()
+
+    def tearDown(self):
+        patch.stopall()
+        POOLS.clear()
+
+    async def test_pool_is_reused(self):
+        self.assertEqual(await execute_query("postgres", CREDS, "SELECT a"), (["a"], [[1]]))
+        await execute_query("postgres", CREDS, "SELECT a")
+        self.assertEqual(self.create_pool.await_count, 1)
+        self.assertEqual(self.run_query.await_count, 2)
+        await execute_query("postgres", {**CREDS, "database": "other"}, "SELECT a")
+        self.assertEqual(self.create_pool.await_count, 2)
+        self.assertEqual(len(POOLS), 2)
+
+    async def test_unpooled_db_type(self):
+        with patch.object(utils_connection_pool, "async_execute_query_once", AsyncMock(return_value=(["b"], [[2]]))) as execute_once:
+            self.assertEqual(await execute_query("snowflake", CREDS, "SELECT b"), (["b"], [[2]]))
+        execute_once.assert_awaited_once_with("snowflake", CREDS, "SELECT b")
+        self.create_pool.assert_not_awaited()
+
+    async def test_retry_on_connection_error(self):
+        self.run_query.side_effect = [ConnectionResetError(), (["a"], [[1]])]
+        self.assertEqual(await execute_query("postgres", CREDS, "SELECT a"), (["a"], [[1]]))
+        self.assertEqual(self.create_pool.await_count, 2)
+        self.close_pool.assert_awaited_once()
+
+    async def test_no_retry_on_query_error(self):
+        self.run_query.side_effect = ValueError("syntax error")
+        with self.assertRaises(ValueError):
+            await execute_query("postgres", CREDS, "SELEC a")
+        self.assertEqual(self.run_query.await_count, 1)
+        self.assertEqual(len(POOLS), 1)
+
+    async def test_health_check_failure_recreates_pool(self):
+        await execute_query("postgres", CREDS, "SELECT a")
+        entry = POOLS[get_creds_key("postgres", CREDS)]
+        entry.last_checked -= utils_connection_pool.DB_POOL_HEALTH_CHECK_INTERVAL + 1
+        self.run_query.side_effect = [ConnectionRefusedError(), (["a"], [[1]])]
+        await execute_query("postgres", CREDS, "SELECT a")
+        self.assertEqual(self.create_pool.await_count, 2)
+        self.assertIsNot(POOLS[get_creds_key("postgres", CREDS)], entry)
+
+    async def test_idle_pools_are_closed(self):
+        await execute_query("postgres", CREDS, "SELECT a")
+        POOLS[get_creds_key("postgres", CREDS)].last_used = time.monotonic() - utils_connection_pool.DB_POOL_IDLE_TIMEOUT - 1
+        await execute_query("mysql", CREDS, "SELECT a")
+        self.assertEqual(list(POOLS), [get_creds_key("mysql", CREDS)])
+        self.close_pool.assert_awaited_once()
+
+    async def test_idle_pools_are_swept(self):
+        await execute_query("postgres", CREDS, "SELECT a")
+        POOLS[get_creds_key("postgres", CREDS)].last_used = time.monotonic() - utils_connection_pool.DB_POOL_IDLE_TIMEOUT - 1
+        with patch.object(utils_connection_pool, "DB_POOL_SWEEP_INTERVAL", 0.01):
+            sweep = asyncio.create_task(sweep_idle_pools())
+            await asyncio.sleep(0.05)
+            sweep.cancel()
+        self.assertEqual(POOLS, {})
+        self.close_pool.assert_awaited_once()
+
+    async def test_invalidate_pools(self):
+        await execute_query("postgres", CREDS, "SELECT a")
+        await invalidate_pools("postgres", CREDS)
+        self.assertEqual(POOLS, {})
+        self.assertNotIn(get_creds_key("postgres", CREDS), POOL_LOCKS)
+        self.close_pool.assert_awaited_once()
+        await execute_query("postgres", CREDS, "SELECT a")
+        self.assertEqual(self.create_pool.await_count, 2)
+
+    async def test_invalidate_pools_in_use(self):
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_query(*_):
+            started.set()
+            await release.wait()
+            return ["a"], [[1]]
+
+        self.run_query.side_effect = slow_query
+        query = asyncio.create_task(execute_query("postgres", CREDS, "SELECT a"))
+        await started.wait()
+        await invalidate_pools("postgres", CREDS)
+        # the pool is only closed once the query using it is done
+        self.assertEqual(POOLS, {})
+        self.close_pool.assert_not_awaited()
+        release.set()
+        self.assertEqual(await query, (["a"], [[1]]))
+        self.close_pool.assert_awaited_once()
+
+    async def test_invalidated_query_is_not_retried(self):
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def failing_query(*_):
+            started.set()
+            await release.wait()
+            raise type("InterfaceError", (Exception,), {})("pool is closing")
+
+        self.run_query.side_effect = failing_query
+        query = asyncio.create_task(execute_query("postgres", CREDS, "SELECT a"))
+        await started.wait()
+        await invalidate_pools("postgres", CREDS)
+        release.set()
+        with self.assertRaisesRegex(Exception, "pool is closing"):
+            await query
+        # no new pool is created for the invalidated creds
+        self.assertEqual(self.create_pool.await_count, 1)
+        self.assertEqual(POOLS, {})
+        self.close_pool.assert_awaited_once()
+
+
+class TestStreamQuery(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        POOLS.clear()
+        patch.object(utils_connection_pool, "create_pool", AsyncMock(side_effect=lambda *_: object())).start()
+        patch.object(utils_connection_pool, "close_pool", AsyncMock()).start()
+
+    def tearDown(self):
+        patch.stopall()
+        POOLS.clear()
+
+    async def test_unpooled_db_type_is_chunked(self):
+        with patch.object(utils_connection_pool, "async_execute_query_once", AsyncMock(return_value=(["a"], [[1], [2], [3]]))):
+            chunks = [chunk async for chunk in stream_query("snowflake", CREDS, "SELECT a", chunk_size=2)]
+        self.assertEqual(chunks, [(["a"], [[1], [2]]), (["a"], [[3]])])
+
+    async def test_retry_before_first_chunk(self):
+        attempts = []
+
+        async def run_query_in_chunks(entry, query, chunk_size, timeout=None):
+            attempts.append(entry)
+            if len(attempts) == 1:
+                raise ConnectionResetError()
+            yield ["a"], [[1]]
+
+        with patch.object(utils_connection_pool, "run_query_in_chunks", run_query_in_chunks):
+            chunks = [chunk async for chunk in stream_query("postgres", CREDS, "SELECT a", chunk_size=2)]
+        self.assertEqual(chunks, [(["a"], [[1]])])
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(POOLS[get_creds_key("postgres", CREDS)].in_use, 0)
+
+    async def test_timeout_is_not_retried(self):
+        attempts = []
+
+        async def run_query_in_chunks(entry, query, chunk_size, timeout=None):
+            attempts.append(timeout)
+            raise type("QueryCanceledError", (Exception,), {})("canceling statement due to statement timeout")
+            yield
+
+        with patch.object(utils_connection_pool, "run_query_in_chunks", run_query_in_chunks):
+            with self.assertRaises(QueryTimeoutError):
+                [chunk async for chunk in stream_query("postgres", CREDS, "SELECT a", chunk_size=2, timeout=30)]
+        self.assertEqual(attempts, [30])
+
+
+class FakeMysqlCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.query = None
+
+    async def execute(self, query):
+        self.query = query
+        self.conn.queries.append(query)
+        if not query.startswith(("SET", "KILL")):
+            await asyncio.sleep(10)
+
+    async def close(self):
+        self.conn.closed_cursors.append(self.query)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def __await__(self):
+        yield from []
+        return self
+
+
+class FakeMysqlConnection:
+    def __init__(self, thread_id, queries):
+        self.queries = queries
+        self.closed = False
+        self.closed_cursors = []
+        self._thread_id = thread_id
+
+    def thread_id(self):
+        return self._thread_id
+
+    def cursor(self, *args):
+        return FakeMysqlCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeMysqlPool:
+    def __init__(self):
+        self.queries = []
+        self.conns = []
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                conn = FakeMysqlConnection(len(pool.conns) + 1, pool.queries)
+                pool.conns.append(conn)
+                return conn
+
+            async def __aexit__(self, *args):
+                pass
+
+        return Acquire()
+
+
+class TestRunQueryInChunks(unittest.IsolatedAsyncioTestCase):
+    async def test_mysql_timeout_and_cancel(self):
+        pool = FakeMysqlPool()
+        entry = PoolEntry("mysql", pool, asyncio.get_running_loop(), time.monotonic(), time.monotonic())
+
+        async def consume():
+            return [chunk async for chunk in run_query_in_chunks(entry, "SELECT a FROM t", 10, timeout=1.5)]
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(
+            pool.queries,
+            ["SET SESSION MAX_EXECUTION_TIME = 1500", "SELECT a FROM t", "KILL QUERY 1"],
+        )
+        # the connection of the killed query is closed, rather than reading
+        # the rest of its results and reusing it
+        self.assertTrue(pool.conns[0].closed)
+        self.assertNotIn("SELECT a FROM t", pool.conns[0].closed_cursors)
+
+
+if __name__ == "__main__":
+    unittest.main()
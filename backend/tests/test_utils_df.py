@@ -3,7 +3,8 @@ from decimal import Decimal
 import unittest
 import pandas as pd
 from pandas.testing import assert_series_equal
-from utils_df import determine_column_type, mk_df, get_columns_summary
+from utils_df import determine_column_type, mk_df, mk_df_from_arrow, get_columns_summary, summarize_df
+from utils_query_results import QueryResults
 
 
 class TestDetermineColumnType(unittest.TestCase):
@@ -64,6 +65,21 @@ class TestDetermineColumnType(unittest.TestCase):
             assert determine_column_type(series) == "money"
 
 
+class TestDetermineColumnTypeSampling(unittest.TestCase):
+    def test_guess_from_sample_is_checked(self):
+        # the first 1000 values look like ints, but the column has a float
+        data = pd.Series([str(i) for i in range(2000)] + ["1.5"])
+        self.assertEqual(determine_column_type(data), "float64")
+        data = pd.Series([str(i) for i in range(2000)] + ["apple"])
+        self.assertEqual(determine_column_type(data), "string")
+
+    def test_guess_from_sample(self):
+        data = pd.Series(["2021-01-01"] * 2000)
+        self.assertEqual(determine_column_type(data), "date")
+        data = pd.Series(["apple"] + ["1"] * 2000)
+        self.assertEqual(determine_column_type(data), "string")
+
+
 class TestMkDf(unittest.TestCase):
 
     def test_string_column(self):
@@ -317,3 +333,75 @@ datetime_col,count
         self.assertNotEqual(numeric_summary, '')
         self.assertEqual(non_numeric_summary, '')
         self.assertEqual(date_summary, '')
+
+
+class TestMkDfFromArrow(unittest.TestCase):
+    def assert_same_as_mk_df(self, data, columns):
+        df = mk_df_from_arrow(QueryResults.from_rows(columns, data).table)
+        pd.testing.assert_frame_equal(df, mk_df(data, columns))
+
+    def test_strings(self):
+        self.assert_same_as_mk_df(
+            [
+                ["a", "1", "1.5", "2021-01-01", "2021-01-01 12:00:00", "$1,234.56"],
+                ["b", "2", "2.5", "2021-01-02", "2021-01-02 13:00:00", "$2,345.67"],
+            ],
+            ["string", "int", "float", "date", "datetime", "money"],
+        )
+
+    def test_typed_values(self):
+        self.assert_same_as_mk_df(
+            [
+                [Decimal("2023"), 11926004, 1.5, datetime.date(2021, 1, 1), datetime.datetime(2021, 1, 1, 12)],
+                [Decimal("2024"), 7813075, None, datetime.date(2021, 1, 2), datetime.datetime(2021, 1, 2, 13)],
+            ],
+            ["year", "activations", "ratio", "date", "datetime"],
+        )
+
+    def test_decimals_become_floats(self):
+        df = mk_df_from_arrow(QueryResults.from_rows(["a"], [[None], [Decimal("-34.48")]]).table)
+        self.assertTrue(pd.api.types.is_float_dtype(df["a"]))
+        self.assertAlmostEqual(df["a"][1], -34.48)
+
+    def test_lists_are_kept(self):
+        df = mk_df_from_arrow(QueryResults.from_rows(["a", "b"], [[[1, 2], "x"], [[3], "y"]]).table)
+        self.assertEqual(df["a"].tolist(), [[1, 2], [3]])
+
+    def test_duplicate_columns(self):
+        df = mk_df_from_arrow(QueryResults.from_rows(["a", "a"], [["1", "x"], ["2", "y"]]).table)
+        self.assertTrue(pd.api.types.is_integer_dtype(df.iloc[:, 0]))
+        self.assertTrue(pd.api.types.is_object_dtype(df.iloc[:, 1]))
+
+
+class TestSummarizeDf(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame(
+            {
+                "region": ["north", "south", "north", "east", None, "north"],
+                "amount": [10.0, 20.0, 30.0, 40.0, 50.0, 60.0],
+                "ordered_at": pd.to_datetime(
+                    ["2024-01-05", "2024-01-20", "2024-02-03", "2024-03-15", "2024-04-01", "2024-06-30"]
+                ),
+            }
+        )
+
+    def test_sections(self):
+        summary = summarize_df(self.df)
+        self.assertTrue(summary.startswith("Summary of 6 rows"))
+        self.assertIn("Numeric columns:\n,amount\ncount,6.00\nmean,35.00", summary)
+        # nulls are not counted as a value
+        self.assertIn("Column region (3 distinct values), most frequent values:\nregion,count\nnorth,3\n", summary)
+        self.assertIn(
+            "Rollup by ordered_at (per month):\nordered_at,row_count,sum_amount\n2024-01,2,30.00\n2024-02,1,30.00\n",
+            summary,
+        )
+
+    def test_top_n(self):
+        summary = summarize_df(self.df, top_n=1)
+        self.assertIn("region,count\nnorth,3\n\n", summary)
+
+    def test_time_buckets(self):
+        df = pd.DataFrame({"at": pd.date_range("2024-01-01", periods=48, freq="h", tz="UTC")})
+        self.assertIn("Rollup by at (per hour):\nat,row_count\n2024-01-01 00:00,1\n", summarize_df(df))
+        df = pd.DataFrame({"at": pd.date_range("2015-01-01", periods=10, freq="YS")})
+        self.assertIn("Rollup by at (per year):\nat,row_count\n2015,1\n", summarize_df(df))
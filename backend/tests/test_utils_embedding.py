@@ -0,0 +1,43 @@
+import unittest
+
+from utils_embedding import (
+    get_embedding_cache_key,
+    normalize_embedding_text,
+    pack_embedding,
+    unpack_embedding,
+)
+
+
+class TestEmbeddingCacheHelpers(unittest.TestCase):
+    def test_normalize_embedding_text(self):
+        self.assertEqual(
+            normalize_embedding_text("  how many\n users   are there? "),
+            "how many users are there?",
+        )
+
+    def test_cache_key_ignores_whitespace(self):
+        key1 = get_embedding_cache_key("how many users", "text-embedding-3-small", 512)
+        key2 = get_embedding_cache_key(" how  many users\n", "text-embedding-3-small", 512)
+        self.assertEqual(key1, key2)
+
+    def test_cache_key_depends_on_model_and_dimensions(self):
+        key = get_embedding_cache_key("how many users", "text-embedding-3-small", 512)
+        self.assertNotEqual(
+            key, get_embedding_cache_key("how many users", "text-embedding-3-large", 512)
+        )
+        self.assertNotEqual(
+            key, get_embedding_cache_key("how many users", "text-embedding-3-small", 256)
+        )
+        self.assertNotEqual(
+            key, get_embedding_cache_key("how many orders", "text-embedding-3-small", 512)
+        )
+
+    def test_pack_unpack_embedding(self):
+        embedding = [0.5, -0.25, 0.125, 0.0]
+        packed = pack_embedding(embedding)
+        self.assertEqual(len(packed), 4 * len(embedding))
+        self.assertEqual(unpack_embedding(packed), embedding)
+
+
+if __name__ == "__main__":
+    unittest.main()
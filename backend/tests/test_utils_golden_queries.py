@@ -0,0 +1,111 @@
+import unittest
+
+from utils_golden_queries import (
+    GoldenQuery,
+    adapt_golden_query_sql,
+    match_golden_query,
+    split_question_literals,
+)
+
+
+def mk_golden_query(question: str, sql: str, similarity: float = None) -> GoldenQuery:
+    return GoldenQuery(db_name="test_db", question=question, sql=sql, similarity=similarity)
+
+
+class TestSplitQuestionLiterals(unittest.TestCase):
+    def test_split(self):
+        template, literals = split_question_literals(
+            "Top 10 customers in 'New York' in 2023?"
+        )
+        self.assertEqual(template, "top <literal> customers in <literal> in <literal>")
+        self.assertEqual(
+            literals, [("number", "10"), ("string", "New York"), ("number", "2023")]
+        )
+
+    def test_trailing_punctuation(self):
+        template, literals = split_question_literals("Total sales in 2023.")
+        self.assertEqual(template, "total sales in <literal>")
+        self.assertEqual(literals, [("number", "2023")])
+
+
+class TestAdaptGoldenQuerySql(unittest.TestCase):
+    def test_same_literals(self):
+        golden_query = mk_golden_query(
+            "How many users signed up in 2023?",
+            "SELECT COUNT(*) FROM users WHERE EXTRACT(YEAR FROM created_at) = 2023",
+        )
+        self.assertEqual(
+            adapt_golden_query_sql("how many users signed up in 2023", golden_query),
+            golden_query.sql,
+        )
+
+    def test_substitute_number(self):
+        golden_query = mk_golden_query(
+            "Show the top 10 products by revenue",
+            "SELECT name FROM products ORDER BY revenue DESC LIMIT 10",
+        )
+        self.assertEqual(
+            adapt_golden_query_sql("Show the top 5 products by revenue", golden_query),
+            "SELECT name FROM products ORDER BY revenue DESC LIMIT 5",
+        )
+
+    def test_substitute_string(self):
+        golden_query = mk_golden_query(
+            "How many customers are in 'New York'?",
+            "SELECT COUNT(*) FROM customers WHERE city = 'New York'",
+        )
+        self.assertEqual(
+            adapt_golden_query_sql("How many customers are in 'Boston'?", golden_query),
+            "SELECT COUNT(*) FROM customers WHERE city = 'Boston'",
+        )
+
+    def test_ambiguous_literal(self):
+        # 2023 occurs twice in the SQL, so we can't tell which one to replace
+        golden_query = mk_golden_query(
+            "Revenue in 2023",
+            "SELECT SUM(amount) FROM orders WHERE year = 2023 AND fiscal_year = 2023",
+        )
+        self.assertIsNone(adapt_golden_query_sql("Revenue in 2024", golden_query))
+
+    def test_literal_inside_date(self):
+        golden_query = mk_golden_query(
+            "Revenue in 2023",
+            "SELECT SUM(amount) FROM orders WHERE order_date >= '2023-01-01'",
+        )
+        self.assertIsNone(adapt_golden_query_sql("Revenue in 2024", golden_query))
+
+    def test_different_wording(self):
+        golden_query = mk_golden_query(
+            "Revenue in 2023",
+            "SELECT SUM(amount) FROM orders WHERE year = 2023",
+        )
+        self.assertIsNone(adapt_golden_query_sql("Net revenue in 2023", golden_query))
+
+    def test_different_wording_and_literals(self):
+        golden_query = mk_golden_query(
+            "Revenue in 2023",
+            "SELECT SUM(amount) FROM orders WHERE year = 2023",
+        )
+        self.assertIsNone(adapt_golden_query_sql("Number of orders in 2024", golden_query))
+
+
+class TestMatchGoldenQuery(unittest.TestCase):
+    def test_match(self):
+        golden_queries = [
+            mk_golden_query("Revenue in 2023", "SELECT 1", similarity=0.97),
+            mk_golden_query("Revenue by month", "SELECT 2", similarity=0.99),
+        ]
+        golden_query, sql = match_golden_query(
+            "Revenue by month", golden_queries, threshold=0.95
+        )
+        self.assertEqual(golden_query.question, "Revenue by month")
+        self.assertEqual(sql, "SELECT 2")
+
+    def test_below_threshold(self):
+        golden_queries = [mk_golden_query("Revenue in 2023", "SELECT 1", similarity=0.9)]
+        self.assertIsNone(match_golden_query("Revenue in 2023", golden_queries, threshold=0.95))
+        self.assertIsNone(match_golden_query("Revenue in 2023", [], threshold=0.95))
+
+
+if __name__ == "__main__":
+    unittest.main()
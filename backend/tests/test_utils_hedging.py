@@ -0,0 +1,103 @@
+import asyncio
+import unittest
+
+from utils_hedging import run_hedged
+
+
+def mk_request(result, delay: float, calls: list, name: str):
+    async def request():
+        calls.append(name)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            calls.append(f"{name} cancelled")
+            raise
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return request
+
+
+class TestRunHedged(unittest.IsolatedAsyncioTestCase):
+    async def test_primary_fast(self):
+        calls = []
+        hedged = await run_hedged(
+            mk_request("primary", 0.01, calls, "primary"),
+            mk_request("hedge", 0.01, calls, "hedge"),
+            delay=0.2,
+        )
+        self.assertEqual(hedged.result, "primary")
+        self.assertEqual(hedged.winner, "primary")
+        self.assertFalse(hedged.hedge_fired)
+        self.assertEqual(calls, ["primary"])
+
+    async def test_hedge_wins(self):
+        calls = []
+        hedged = await run_hedged(
+            mk_request("primary", 1, calls, "primary"),
+            mk_request("hedge", 0.01, calls, "hedge"),
+            delay=0.05,
+        )
+        self.assertEqual(hedged.result, "hedge")
+        self.assertEqual(hedged.winner, "hedge")
+        self.assertTrue(hedged.hedge_fired)
+        # the cancelled request has finished by the time run_hedged returns
+        self.assertEqual(calls, ["primary", "hedge", "primary cancelled"])
+        self.assertEqual(hedged.cancelled, ["primary"])
+        self.assertEqual(hedged.outcomes, {"hedge": "hedge"})
+
+    async def test_primary_wins_after_hedge_fired(self):
+        calls = []
+        hedged = await run_hedged(
+            mk_request("primary", 0.1, calls, "primary"),
+            mk_request("hedge", 1, calls, "hedge"),
+            delay=0.05,
+        )
+        self.assertEqual(hedged.winner, "primary")
+        self.assertTrue(hedged.hedge_fired)
+        self.assertEqual(hedged.outcomes, {"primary": "primary"})
+        self.assertEqual(hedged.cancelled, ["hedge"])
+        self.assertEqual(calls, ["primary", "hedge", "hedge cancelled"])
+
+    async def test_primary_fails_fast(self):
+        calls = []
+        hedged = await run_hedged(
+            mk_request(ValueError("bad"), 0.01, calls, "primary"),
+            mk_request("hedge", 0.01, calls, "hedge"),
+            delay=1,
+        )
+        self.assertEqual(hedged.winner, "hedge")
+        self.assertIsInstance(hedged.outcomes["primary"], ValueError)
+        self.assertEqual(hedged.cancelled, [])
+
+    async def test_is_success(self):
+        calls = []
+        hedged = await run_hedged(
+            mk_request("invalid", 0.01, calls, "primary"),
+            mk_request("invalid too", 0.01, calls, "hedge"),
+            delay=1,
+            is_success=lambda result: result == "valid",
+        )
+        self.assertIsNone(hedged.winner)
+        self.assertEqual(hedged.result, "invalid")
+        self.assertEqual(hedged.outcomes, {"primary": "invalid", "hedge": "invalid too"})
+
+    async def test_cancelled_from_outside(self):
+        calls = []
+        task = asyncio.create_task(
+            run_hedged(
+                mk_request("primary", 1, calls, "primary"),
+                mk_request("hedge", 1, calls, "hedge"),
+                delay=0.01,
+            )
+        )
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(calls, ["primary", "hedge", "primary cancelled", "hedge cancelled"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from utils_instructions import get_relevant_instructions, split_instructions
+
+
+class TestSplitInstructions(unittest.TestCase):
+    def test_split_instructions(self):
+        instructions = """# Revenue
+- revenue excludes refunds
+  and taxes
+- [always] never query the audit schema
+
+1. dates are in UTC
+2) the fiscal year starts in April
+
+Free text that
+continues on the next line
+"""
+        self.assertEqual(
+            split_instructions(instructions),
+            [
+                ("# Revenue\n- revenue excludes refunds\n  and taxes", False),
+                ("- never query the audit schema", True),
+                ("1. dates are in UTC", False),
+                ("2) the fiscal year starts in April", False),
+                ("Free text that\ncontinues on the next line", False),
+            ],
+        )
+
+    def test_split_instructions_empty(self):
+        self.assertEqual(split_instructions(""), [])
+        self.assertEqual(split_instructions("\n\n[always]\n"), [])
+
+    def test_split_long_chunk(self):
+        instructions = "\n".join(["x" * 100] * 40)
+        chunks = split_instructions(instructions)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(content) <= 1500 for content, _ in chunks))
+        self.assertEqual("\n".join(content for content, _ in chunks), instructions)
+
+
+class TestGetRelevantInstructions(unittest.IsolatedAsyncioTestCase):
+    async def test_short_instructions(self):
+        with patch(
+            "utils_instructions.get_closest_instruction_chunks", AsyncMock()
+        ) as mock_get_chunks:
+            result = await get_relevant_instructions("db", "question", "short rules")
+        self.assertEqual(result, "short rules")
+        mock_get_chunks.assert_not_called()
+
+    @patch("utils_instructions.get_embedding", AsyncMock(return_value=[0.1, 0.2]))
+    async def test_long_instructions(self):
+        instructions = "- rule\n" * 1000
+        with patch(
+            "utils_instructions.get_closest_instruction_chunks",
+            AsyncMock(return_value=["- pinned rule", "- relevant rule"]),
+        ) as mock_get_chunks:
+            result = await get_relevant_instructions("db", "question", instructions)
+        self.assertEqual(result, "- pinned rule\n\n- relevant rule")
+        mock_get_chunks.assert_awaited_once_with("db", [0.1, 0.2], 10)
+
+    @patch("utils_instructions.get_embedding", AsyncMock(return_value=[0.1, 0.2]))
+    async def test_fallback(self):
+        instructions = "- rule\n" * 1000
+        # no chunks yet
+        with patch(
+            "utils_instructions.get_closest_instruction_chunks",
+            AsyncMock(return_value=[]),
+        ):
+            self.assertEqual(
+                await get_relevant_instructions("db", "question", instructions),
+                instructions,
+            )
+        # retrieval failed
+        with patch(
+            "utils_instructions.get_closest_instruction_chunks",
+            AsyncMock(side_effect=Exception("db down")),
+        ):
+            self.assertEqual(
+                await get_relevant_instructions("db", "question", instructions),
+                instructions,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,11 @@
-from utils_md import mk_create_table_ddl, mk_create_ddl
+from utils_md import (
+    COMPACT_SCHEMA_HEADER,
+    abbreviate_data_type,
+    mk_compact_ddl,
+    mk_create_ddl,
+    mk_create_table_ddl,
+    mk_schema_prompt,
+)
 from request_models import TableDescription
 
 def test_mk_create_table_ddl_basic():
@@ -195,4 +202,47 @@ CREATE TABLE IF NOT EXISTS company.company (
 );
 """
     result = mk_create_ddl(metadata)
-    assert result == expected
\ No newline at end of file
+    assert result == expected
+def test_abbreviate_data_type():
+    assert abbreviate_data_type("INTEGER") == "int"
+    assert abbreviate_data_type("character varying(255)") == "varchar(255)"
+    assert abbreviate_data_type("timestamp without time zone") == "timestamp"
+    assert abbreviate_data_type("timestamp  with time zone") == "timestamptz"
+    assert abbreviate_data_type("numeric(10, 2)") == "numeric(10,2)"
+    assert abbreviate_data_type("bigint[]") == "int8[]"
+    assert abbreviate_data_type("INTEGER NOT NULL") == "int not null"
+    assert abbreviate_data_type("interval") == "interval"
+    assert abbreviate_data_type("VARIANT") == "variant"
+
+def test_mk_compact_ddl():
+    metadata = [
+        {"table_name": "sales.orders", "column_name": "id", "data_type": "integer", "column_description": "primary key"},
+        {"table_name": "sales.orders", "column_name": "customer_id", "data_type": "integer", "column_description": "id of the customer"},
+        {"table_name": "sales.orders", "column_name": "created at", "data_type": "timestamp without time zone", "column_description": ""},
+        {"table_name": "sales.orders", "column_name": "status", "data_type": "character varying(20)", "column_description": "pending or shipped"},
+        {"table_name": "sales.customers", "column_name": "customer_id", "data_type": "integer", "column_description": "id of the customer"},
+        {"table_name": "sales.customers", "column_name": "name", "data_type": "text"},
+    ]
+    table_descriptions = [
+        TableDescription(table_name="sales.orders", table_description="Orders placed by customers")
+    ]
+    expected = COMPACT_SCHEMA_HEADER + """sales.orders: Orders placed by customers
+  int: id (primary key), customer_id [1]
+  timestamp: "created at"
+  varchar(20): status (pending or shipped)
+sales.customers:
+  int: customer_id [1]
+  text: name
+
+[1] id of the customer
+"""
+    result = mk_compact_ddl(metadata, table_descriptions)
+    assert result == expected
+
+def test_mk_schema_prompt():
+    metadata = [
+        {"table_name": "users", "column_name": "id", "data_type": "int"},
+    ]
+    assert mk_schema_prompt(metadata) == mk_create_ddl(metadata)
+    assert mk_schema_prompt(metadata, [], "ddl") == mk_create_ddl(metadata)
+    assert mk_schema_prompt(metadata, [], "compact") == mk_compact_ddl(metadata)
@@ -0,0 +1,140 @@
+import datetime
+import unittest
+from decimal import Decimal
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import utils_query_cache
+from utils_query_cache import (
+    deserialize_query_results,
+    fetch_cached_query_results,
+    get_query_cache_key,
+    serialize_query_results,
+)
+from utils_query_results import QueryResults
+
+DB_CREDS = {"host": "localhost", "user": "postgres", "password": "secret"}
+
+
+class TestQueryCacheKey(unittest.TestCase):
+    def get_key(self, sql="SELECT a FROM t", **kwargs):
+        inputs = {"db_name": "my_db", "db_type": "postgres", "db_creds": DB_CREDS, "max_rows": 100}
+        inputs.update(kwargs)
+        return get_query_cache_key(sql=sql, **inputs)
+
+    def test_key_ignores_formatting(self):
+        self.assertEqual(self.get_key(), self.get_key("select a\n  from t -- all of a"))
+
+    def test_key_depends_on_inputs(self):
+        key = self.get_key()
+        self.assertNotEqual(key, self.get_key("SELECT b FROM t"))
+        self.assertNotEqual(key, self.get_key(db_name="other_db"))
+        self.assertNotEqual(key, self.get_key(db_creds={**DB_CREDS, "password": "new"}))
+        self.assertNotEqual(key, self.get_key(max_rows=10))
+
+    def test_key_does_not_contain_creds(self):
+        self.assertNotIn("secret", self.get_key())
+
+    def test_no_key_for_volatile_queries(self):
+        for sql in [
+            "SELECT * FROM t WHERE created_at > NOW() - INTERVAL '1 day'",
+            "SELECT * FROM t WHERE created_at::date = CURRENT_DATE",
+            "SELECT CURRENT_TIMESTAMP, a FROM t",
+            "SELECT * FROM t ORDER BY RANDOM() LIMIT 10",
+            "SELECT gen_random_uuid(), a FROM t",
+            "SELECT * FROM t WHERE created_at > clock_timestamp()",
+            # not parseable, so the function names are matched instead
+            "SELECT * FROM t WHERE created_at > now( AND",
+        ]:
+            with self.subTest(sql=sql):
+                self.assertIsNone(self.get_key(sql))
+        self.assertIsNone(self.get_key("SELECT GETDATE(), a FROM t", db_type="sqlserver"))
+        self.assertIsNone(self.get_key("SELECT * FROM t WHERE d < SYSDATE()", db_type="snowflake"))
+        # columns and tables that happen to be named like volatile functions are fine
+        self.assertIsNotNone(self.get_key("SELECT t.now, random_id FROM t"))
+
+
+class TestSerializeQueryResults(unittest.TestCase):
+    def test_round_trip(self):
+        results = QueryResults.from_rows(
+            ["id", "name", "price", "created_at", "id"],
+            [
+                [1, "a", Decimal("1.50"), datetime.date(2024, 1, 1), 2],
+                [2, None, Decimal("2.25"), datetime.date(2024, 1, 2), 3],
+            ],
+            truncated=True,
+        )
+        cached = deserialize_query_results(serialize_query_results(results))
+        self.assertTrue(cached.table.equals(results.table))
+        self.assertEqual(cached.columns, results.columns)
+        self.assertTrue(cached.truncated)
+        self.assertTrue(cached.cached)
+        self.assertGreaterEqual(cached.cache_age, 0)
+
+    def test_no_rows(self):
+        cached = deserialize_query_results(serialize_query_results(QueryResults.from_rows(["a"], [])))
+        self.assertEqual((cached.columns, cached.rows), (["a"], []))
+
+
+class TestFetchCachedQueryResults(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.store = {}
+        redis_client = MagicMock()
+        redis_client.get.side_effect = self.store.get
+        redis_client.set.side_effect = lambda key, value, ex: self.store.__setitem__(key, value)
+        self.fetch = AsyncMock(return_value=QueryResults.from_rows(["a"], [[1], [2]]))
+        self.patches = [
+            patch.object(utils_query_cache, "redis_client_binary", redis_client),
+            patch.object(utils_query_cache, "fetch_query_results", self.fetch),
+            patch.object(utils_query_cache, "get_query_cache_ttl", AsyncMock(return_value=60)),
+            patch.object(utils_query_cache, "get_query_timeout", AsyncMock(return_value=30)),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    async def fetch_results(self, **kwargs):
+        return await fetch_cached_query_results("my_db", "postgres", DB_CREDS, "SELECT a FROM t", **kwargs)
+
+    async def test_hit(self):
+        first = await self.fetch_results()
+        second = await self.fetch_results()
+        self.assertEqual(self.fetch.await_count, 1)
+        self.assertFalse(first.cached)
+        self.assertIsNone(first.cache_age)
+        self.assertTrue(second.cached)
+        self.assertEqual(second.rows, [[1], [2]])
+        self.assertEqual(self.fetch.await_args.kwargs["timeout"], 30)
+
+    async def test_bypass(self):
+        await self.fetch_results()
+        results = await self.fetch_results(use_cache=False)
+        self.assertEqual(self.fetch.await_count, 2)
+        self.assertFalse(results.cached)
+
+    async def test_volatile_queries_are_not_cached(self):
+        for _ in range(2):
+            results = await fetch_cached_query_results(
+                "my_db", "postgres", DB_CREDS, "SELECT a FROM t WHERE d = CURRENT_DATE"
+            )
+            self.assertFalse(results.cached)
+        self.assertEqual(self.fetch.await_count, 2)
+        self.assertEqual(self.store, {})
+
+    async def test_max_bytes(self):
+        with patch.object(utils_query_cache, "QUERY_CACHE_MAX_BYTES", 10):
+            await self.fetch_results()
+        self.assertEqual(self.store, {})
+
+    async def test_disabled_for_db(self):
+        with patch.object(utils_query_cache, "get_query_cache_ttl", AsyncMock(return_value=0)):
+            await self.fetch_results()
+            await self.fetch_results()
+        self.assertEqual(self.fetch.await_count, 2)
+        self.assertEqual(self.store, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
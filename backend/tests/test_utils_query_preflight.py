@@ -0,0 +1,77 @@
+import json
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import utils_query_preflight
+from utils_query_preflight import (
+    QueryEstimate,
+    estimate_query,
+    get_cost_error,
+    parse_mysql_explain,
+    parse_postgres_explain,
+)
+
+POSTGRES_EXPLAIN = [
+    "HashAggregate  (cost=2041.00..2043.50 rows=200 width=40)",
+    "  Group Key: customer_id",
+    "  ->  Seq Scan on orders  (cost=0.00..1541.00 rows=100000 width=12)",
+]
+REDSHIFT_EXPLAIN = [
+    "XN HashAggregate  (cost=0.00..1234.56 rows=75 width=8)",
+    "  ->  XN Seq Scan on orders  (cost=0.00..1000.00 rows=100000 width=8)",
+]
+
+
+class TestParseExplain(unittest.TestCase):
+    def test_postgres(self):
+        self.assertEqual(parse_postgres_explain(POSTGRES_EXPLAIN), QueryEstimate(rows=200, cost=2043.5))
+
+    def test_redshift(self):
+        self.assertEqual(parse_postgres_explain(REDSHIFT_EXPLAIN), QueryEstimate(rows=75, cost=1234.56))
+
+    def test_postgres_no_cost(self):
+        self.assertIsNone(parse_postgres_explain(["Result"]))
+
+    def test_mysql(self):
+        explain = json.dumps({"query_block": {"select_id": 1, "cost_info": {"query_cost": "10093.50"}}})
+        self.assertEqual(parse_mysql_explain(explain), QueryEstimate(rows=None, cost=10093.5))
+        self.assertIsNone(parse_mysql_explain(json.dumps({"query_block": {}})))
+
+
+class TestGetCostError(unittest.TestCase):
+    def test_over_max_cost(self):
+        error = get_cost_error(QueryEstimate(rows=10, cost=5000), max_cost=1000)
+        self.assertIn("5,000", error)
+        self.assertIn("1,000", error)
+
+    def test_allowed(self):
+        self.assertIsNone(get_cost_error(QueryEstimate(rows=10, cost=500), max_cost=1000))
+        self.assertIsNone(get_cost_error(QueryEstimate(rows=10, cost=5000), max_cost=None))
+        self.assertIsNone(get_cost_error(QueryEstimate(rows=10), max_cost=1000))
+        self.assertIsNone(get_cost_error(None, max_cost=1000))
+
+
+class TestEstimateQuery(unittest.IsolatedAsyncioTestCase):
+    async def test_postgres(self):
+        execute_query = AsyncMock(return_value=(["QUERY PLAN"], [[line] for line in POSTGRES_EXPLAIN]))
+        with patch.object(utils_query_preflight, "execute_query", execute_query):
+            estimate = await estimate_query("postgres", {}, "SELECT customer_id, SUM(x) FROM orders GROUP BY 1;")
+        self.assertEqual(estimate, QueryEstimate(rows=200, cost=2043.5))
+        execute_query.assert_awaited_once_with(
+            "postgres", {}, "EXPLAIN SELECT customer_id, SUM(x) FROM orders GROUP BY 1"
+        )
+
+    async def test_unsupported_db_type(self):
+        execute_query = AsyncMock()
+        with patch.object(utils_query_preflight, "execute_query", execute_query):
+            self.assertIsNone(await estimate_query("snowflake", {}, "SELECT 1"))
+        execute_query.assert_not_awaited()
+
+    async def test_explain_error(self):
+        execute_query = AsyncMock(side_effect=ValueError("syntax error"))
+        with patch.object(utils_query_preflight, "execute_query", execute_query):
+            self.assertIsNone(await estimate_query("mysql", {}, "SELEC 1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+import asyncio
+import datetime
+import json
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+import pyarrow as pa
+import utils_query_results
+from utils_connection_pool import QueryTimeoutError
+from utils_query_results import (
+    add_row_limit,
+    fetch_query_results,
+    stream_query_results,
+    to_arrow_array,
+    unify_arrow_chunks,
+)
+
+
+def fake_stream_query(rows, chunk_size_override=None):
+    closed = []
+
+    async def stream_query(db_type, db_creds, query, chunk_size, timeout=None):
+        chunk_size = chunk_size_override or chunk_size
+        try:
+            yield ["a"], rows[:chunk_size]
+            for i in range(chunk_size, len(rows), chunk_size):
+                yield ["a"], rows[i : i + chunk_size]
+        finally:
+            closed.append(query)
+
+    return stream_query, closed
+
+
+class TestAddRowLimit(unittest.TestCase):
+    def test_adds_limit(self):
+        self.assertEqual(
+            add_row_limit("SELECT a FROM t", "postgres", 100),
+            "SELECT\n  a\nFROM t\nLIMIT 101",
+        )
+
+    def test_lowers_larger_limit(self):
+        self.assertEqual(
+            add_row_limit("SELECT a FROM t LIMIT 500 OFFSET 10", "postgres", 100),
+            "SELECT\n  a\nFROM t\nLIMIT 101\nOFFSET 10",
+        )
+
+    def test_keeps_smaller_limit(self):
+        sql = "SELECT a FROM t ORDER BY a LIMIT 10"
+        self.assertEqual(add_row_limit(sql, "postgres", 100), sql)
+        sql = "SELECT TOP 10 a FROM t"
+        self.assertEqual(add_row_limit(sql, "sqlserver", 100), sql)
+
+    def test_sqlserver_top(self):
+        self.assertEqual(
+            add_row_limit("SELECT a FROM t", "sqlserver", 100),
+            "SELECT\nTOP 101\n  a\nFROM t",
+        )
+
+    def test_union(self):
+        self.assertTrue(
+            add_row_limit("SELECT a FROM t UNION SELECT b FROM u", "postgres", 5).endswith("LIMIT 6")
+        )
+
+    def test_unparseable_sql(self):
+        sql = "SELECT a FROM t WHERE ((("
+        self.assertEqual(add_row_limit(sql, "postgres", 100), sql)
+
+
+class TestFetchQueryResults(unittest.IsolatedAsyncioTestCase):
+    async def test_truncated(self):
+        stream_query, closed = fake_stream_query([[i] for i in range(25)])
+        with patch.object(utils_query_results, "stream_query", stream_query):
+            results = await fetch_query_results("postgres", {}, "SELECT a FROM t", max_rows=10, chunk_size=4)
+        self.assertEqual(results.columns, ["a"])
+        self.assertEqual(results.rows, [[i] for i in range(10)])
+        self.assertTrue(results.truncated)
+        # stops fetching once there are more than max_rows rows
+        self.assertEqual(len(closed), 1)
+        self.assertIn("LIMIT 11", closed[0])
+
+    async def test_not_truncated(self):
+        stream_query, _ = fake_stream_query([[i] for i in range(10)])
+        with patch.object(utils_query_results, "stream_query", stream_query):
+            results = await fetch_query_results("postgres", {}, "SELECT a FROM t", max_rows=10, chunk_size=4)
+        self.assertEqual(len(results.rows), 10)
+        self.assertFalse(results.truncated)
+
+    async def test_no_rows(self):
+        stream_query, _ = fake_stream_query([])
+        with patch.object(utils_query_results, "stream_query", stream_query):
+            results = await fetch_query_results("postgres", {}, "SELECT a FROM t", max_rows=10)
+        self.assertEqual((results.columns, results.rows, results.truncated), (["a"], [], False))
+
+    async def test_timeout(self):
+        timeouts, closed = [], []
+
+        async def stream_query(db_type, db_creds, query, chunk_size, timeout=None):
+            timeouts.append(timeout)
+            try:
+                yield ["a"], [[1]]
+                await asyncio.sleep(10)
+                yield ["a"], [[2]]
+            finally:
+                closed.append(query)
+
+        with patch.object(utils_query_results, "stream_query", stream_query):
+            with self.assertRaises(QueryTimeoutError) as cm:
+                await fetch_query_results("postgres", {}, "SELECT a FROM t", timeout=0.05)
+        self.assertEqual(cm.exception.timeout, 0.05)
+        # the timeout is also passed to the database, and the query is closed
+        self.assertEqual(timeouts, [0.05])
+        self.assertEqual(len(closed), 1)
+
+    async def test_other_timeout_errors(self):
+        async def stream_query(*args):
+            raise TimeoutError("connection timed out")
+            yield
+
+        with patch.object(utils_query_results, "stream_query", stream_query):
+            with self.assertRaises(TimeoutError) as cm:
+                await fetch_query_results("postgres", {}, "SELECT a FROM t", timeout=10)
+        self.assertNotIsInstance(cm.exception, QueryTimeoutError)
+
+
+class TestArrowResults(unittest.IsolatedAsyncioTestCase):
+    async def test_column_types(self):
+        rows = [[i, f"name {i}", Decimal(f"{i}.50"), datetime.date(2024, 1, 1 + i)] for i in range(5)]
+
+        async def stream_query(db_type, db_creds, query, chunk_size, timeout=None):
+            yield ["id", "name", "price", "created_at"], rows[:3]
+            yield ["id", "name", "price", "created_at"], rows[3:]
+
+        with patch.object(utils_query_results, "stream_query", stream_query):
+            results = await fetch_query_results("postgres", {}, "SELECT * FROM t", max_rows=10)
+        self.assertEqual(
+            [field.type for field in results.table.schema],
+            [pa.int64(), pa.string(), pa.float64(), pa.date32()],
+        )
+        self.assertEqual(results.table.num_rows, 5)
+
+    def test_unify_chunks(self):
+        # chunks with only nulls take the type of the other chunks
+        column = unify_arrow_chunks([to_arrow_array([None, None]), to_arrow_array([1, 2])])
+        self.assertEqual((column.type, column.to_pylist()), (pa.int64(), [None, None, 1, 2]))
+        # ints and floats become floats
+        column = unify_arrow_chunks([to_arrow_array([1]), to_arrow_array([1.5])])
+        self.assertEqual((column.type, column.to_pylist()), (pa.float64(), [1.0, 1.5]))
+        # other mixed types become strings
+        column = unify_arrow_chunks([to_arrow_array([1]), to_arrow_array(["a"])])
+        self.assertEqual((column.type, column.to_pylist()), (pa.string(), ["1", "a"]))
+        column = unify_arrow_chunks([to_arrow_array([1, "a", None])])
+        self.assertEqual((column.type, column.to_pylist()), (pa.string(), ["1", "a", None]))
+
+
+class TestStreamQueryResults(unittest.IsolatedAsyncioTestCase):
+    async def collect(self, rows, max_rows, chunk_size):
+        stream_query, _ = fake_stream_query(rows)
+        with patch.object(utils_query_results, "stream_query", stream_query):
+            return [
+                json.loads(line)
+                async for line in stream_query_results("postgres", {}, "SELECT a FROM t", max_rows, chunk_size)
+            ]
+
+    async def test_ndjson_chunks(self):
+        lines = await self.collect([[i] for i in range(7)], max_rows=10, chunk_size=3)
+        self.assertEqual(
+            lines,
+            [
+                {"columns": ["a"]},
+                {"rows": [[0], [1], [2]]},
+                {"rows": [[3], [4], [5]]},
+                {"rows": [[6]]},
+                {"row_count": 7, "truncated": False},
+            ],
+        )
+
+    async def test_ndjson_truncated(self):
+        lines = await self.collect([[i] for i in range(20)], max_rows=5, chunk_size=3)
+        self.assertEqual(
+            lines,
+            [
+                {"columns": ["a"]},
+                {"rows": [[0], [1], [2]]},
+                {"rows": [[3], [4]]},
+                {"row_count": 5, "truncated": True},
+            ],
+        )
+
+    async def test_ndjson_error(self):
+        async def stream_query(*args):
+            raise ValueError("relation t does not exist")
+            yield
+
+        with patch.object(utils_query_results, "stream_query", stream_query):
+            lines = [line async for line in stream_query_results("postgres", {}, "SELECT a FROM t")]
+        self.assertEqual([json.loads(line) for line in lines], [{"error": "relation t does not exist"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import utils_schema_context
+from request_models import SchemaPruningConfig
+from utils_schema_context import load_schema_context
+
+METADATA = [{"table_name": "t", "column_name": "a", "data_type": "int", "column_description": ""}]
+
+
+class TestLoadSchemaContext(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patch.object(utils_schema_context, "get_metadata", AsyncMock(return_value=METADATA)).start()
+        patch.object(utils_schema_context, "get_all_table_descriptions", AsyncMock(return_value=[])).start()
+        patch.object(utils_schema_context, "get_instructions", AsyncMock(return_value="be nice")).start()
+        patch.object(utils_schema_context, "get_join_hints", AsyncMock(return_value=[["t.a", "u.a"]])).start()
+        patch.object(utils_schema_context, "get_schema_pruning_config", AsyncMock(return_value=SchemaPruningConfig(enabled=True))).start()
+        patch.object(utils_schema_context, "get_schema_format", AsyncMock(return_value="compact")).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    async def test_loads_all_parts(self):
+        context = await load_schema_context("my_db", version=3)
+        self.assertEqual((context.version, context.instructions, context.schema_format), (3, "be nice", "compact"))
+        self.assertTrue(context.pruning_config.enabled)
+
+    async def test_optional_parts_fall_back_to_defaults(self):
+        for name in ["get_instructions", "get_join_hints", "get_schema_pruning_config", "get_schema_format"]:
+            patch.object(utils_schema_context, name, AsyncMock(side_effect=RuntimeError("db is down"))).start()
+        context = await load_schema_context("my_db")
+        self.assertEqual(context.instructions, "")
+        self.assertIsNone(context.join_hints)
+        self.assertEqual(context.pruning_config, SchemaPruningConfig())
+        self.assertEqual(context.schema_format, "ddl")
+        self.assertEqual(context.metadata, METADATA)
+
+    async def test_metadata_errors_are_raised(self):
+        patch.object(utils_schema_context, "get_metadata", AsyncMock(side_effect=RuntimeError("db is down"))).start()
+        with self.assertRaises(RuntimeError):
+            await load_schema_context("my_db")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import numpy as np
+from request_models import SchemaPruningConfig, TableDescription
+from utils_column_embeddings import ColumnSimilarity
+from utils_schema_pruning import (
+    add_join_path_tables,
+    find_join_path,
+    get_join_key_columns,
+    mk_join_graph,
+    prune_schema,
+    score_columns,
+)
+
+JOIN_HINTS = [
+    ["orders.customer_id", "customers.id"],
+    ["orders.product_id", "products.id"],
+    ["products.supplier_id", "sc.suppliers.id"],
+]
+
+
+def mk_metadata(table_columns: dict[str, list[str]]) -> list[dict[str, str]]:
+    return [
+        {
+            "table_name": table_name,
+            "column_name": column_name,
+            "data_type": "text",
+            "column_description": "",
+        }
+        for table_name, column_names in table_columns.items()
+        for column_name in column_names
+    ]
+
+
+class TestJoinGraph(unittest.TestCase):
+    def test_mk_join_graph(self):
+        graph = mk_join_graph(JOIN_HINTS)
+        self.assertEqual(graph["orders"], {"customers", "products"})
+        self.assertEqual(graph["products"], {"orders", "sc.suppliers"})
+        self.assertEqual(graph["sc.suppliers"], {"products"})
+        self.assertEqual(mk_join_graph(None), {})
+
+    def test_find_join_path(self):
+        graph = mk_join_graph(JOIN_HINTS)
+        self.assertEqual(
+            find_join_path(graph, "customers", "products", max_hops=2),
+            ["customers", "orders", "products"],
+        )
+        self.assertIsNone(find_join_path(graph, "customers", "sc.suppliers", max_hops=2))
+        self.assertEqual(
+            find_join_path(graph, "customers", "sc.suppliers", max_hops=3),
+            ["customers", "orders", "products", "sc.suppliers"],
+        )
+        self.assertIsNone(find_join_path(graph, "customers", "unknown", max_hops=3))
+
+    def test_add_join_path_tables(self):
+        graph = mk_join_graph(JOIN_HINTS)
+        self.assertEqual(
+            add_join_path_tables(["customers", "products"], graph, max_hops=2),
+            ["customers", "products", "orders"],
+        )
+        self.assertEqual(
+            add_join_path_tables(["customers", "sc.suppliers"], graph, max_hops=2),
+            ["customers", "sc.suppliers"],
+        )
+
+    def test_get_join_key_columns(self):
+        self.assertEqual(
+            get_join_key_columns(JOIN_HINTS, {"orders", "customers"}),
+            {("orders", "customer_id"), ("customers", "id")},
+        )
+
+
+class TestPruneSchema(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.metadata = mk_metadata(
+            {
+                "customers": ["id", "name", "city"],
+                "orders": ["id", "customer_id", "product_id", "amount"],
+                "products": ["id", "name", "price"],
+                "logs": ["id", "message"],
+            }
+        )
+        self.table_descriptions = [
+            TableDescription(table_name="customers", table_description="Customers"),
+            TableDescription(table_name="logs", table_description="App logs"),
+        ]
+        # customers.city and products.price are most relevant to the question
+        scores = {("customers", "city"): 0.9, ("products", "price"): 0.8}
+        self.scores = np.array(
+            [scores.get((c["table_name"], c["column_name"]), 0.1) for c in self.metadata]
+        )
+
+    async def test_disabled(self):
+        pruned_metadata, pruned_table_descriptions = await prune_schema(
+            [1.0], self.metadata, self.table_descriptions, JOIN_HINTS, SchemaPruningConfig()
+        )
+        self.assertEqual(pruned_metadata, self.metadata)
+        self.assertEqual(pruned_table_descriptions, self.table_descriptions)
+
+    async def test_prune(self):
+        config = SchemaPruningConfig(
+            enabled=True, max_tables=2, max_columns_per_table=1, min_columns=0
+        )
+        with patch(
+            "utils_schema_pruning.score_columns", AsyncMock(return_value=self.scores)
+        ):
+            pruned_metadata, pruned_table_descriptions = await prune_schema(
+                [1.0], self.metadata, self.table_descriptions, JOIN_HINTS, config
+            )
+        self.assertEqual(
+            [(c["table_name"], c["column_name"]) for c in pruned_metadata],
+            [
+                ("customers", "id"),
+                ("customers", "city"),
+                ("orders", "id"),
+                ("orders", "customer_id"),
+                ("orders", "product_id"),
+                ("products", "id"),
+                ("products", "price"),
+            ],
+        )
+        self.assertEqual(
+            [td.table_name for td in pruned_table_descriptions], ["customers"]
+        )
+
+    async def test_score_columns_from_index(self):
+        closest_columns = [
+            ColumnSimilarity(table_name="customers", column_name="city", similarity=0.9),
+            ColumnSimilarity(table_name="products", column_name="price", similarity=0.8),
+        ]
+        with patch(
+            "utils_schema_pruning.get_closest_columns",
+            AsyncMock(return_value=closest_columns),
+        ) as mock_get_closest_columns, patch(
+            "utils_schema_pruning.get_embeddings"
+        ) as mock_get_embeddings:
+            scores = await score_columns(
+                [1.0], self.metadata, self.table_descriptions, db_name="test_db", num_candidates=2
+            )
+        mock_get_closest_columns.assert_awaited_once_with("test_db", [1.0], 2)
+        mock_get_embeddings.assert_not_called()
+        expected = np.where(self.scores == 0.1, -1.0, self.scores)
+        np.testing.assert_allclose(scores, expected, rtol=1e-6)
+
+    async def test_score_columns_without_index(self):
+        embeddings = [[1.0, 0.0] if c["column_name"] == "city" else [0.0, 2.0] for c in self.metadata]
+        with patch(
+            "utils_schema_pruning.get_closest_columns", AsyncMock(return_value=[])
+        ), patch(
+            "utils_schema_pruning.get_embeddings", AsyncMock(return_value=embeddings)
+        ):
+            scores = await score_columns(
+                [3.0, 0.0], self.metadata, self.table_descriptions, db_name="test_db"
+            )
+        np.testing.assert_allclose(
+            scores, [1.0 if c["column_name"] == "city" else 0.0 for c in self.metadata]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,20 @@
+import asyncio
+import pandas as pd
 import pytest
 
 from typing import List
-from utils_sql import add_hard_filters
+from unittest.mock import AsyncMock, patch
+from utils_sql import (
+    GENERATE_SQL_SYSTEM_PROMPT,
+    GENERATE_SQL_USER_PROMPT,
+    add_cache_breakpoints,
+    add_hard_filters,
+    add_schema_to_tables,
+    compare_query_results,
+    estimate_input_cost_in_cents,
+    get_messages,
+    postprocess_sql,
+)
 from request_models import HardFilter
 
 @pytest.mark.parametrize(
@@ -181,3 +194,166 @@ def test_add_sql_filters_no_match():
     # We expect the result to be the same as the original
     result = add_hard_filters(sql, hard_filters)
     assert result.strip().lower() == sql.strip().lower()
+
+
+def mk_generate_sql_messages(layout: str, previous_context=None, question="how many users?"):
+    return get_messages(
+        db_type="postgres",
+        date_today="2025-01-01",
+        instructions="Only count active users.",
+        user_question=question,
+        table_metadata_ddl="CREATE TABLE users (id int, active boolean);",
+        system_prompt=GENERATE_SQL_SYSTEM_PROMPT,
+        user_prompt=GENERATE_SQL_USER_PROMPT,
+        previous_context=previous_context,
+        golden_queries_prompt="Example question 1: how many orders?",
+        layout=layout,
+    )
+
+
+def test_get_messages_cache_aware_layout():
+    previous_context = [{"question": "list users", "sql": "SELECT * FROM users"}]
+    default_messages = mk_generate_sql_messages("default", previous_context)
+    messages = mk_generate_sql_messages("cache_aware", previous_context)
+
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "user"]
+    # the schema and instructions are in the stable prefix
+    assert "CREATE TABLE users" in messages[0]["content"]
+    assert "Only count active users." in messages[0]["content"]
+    assert "CREATE TABLE users" not in messages[-1]["content"]
+    # the golden queries and question are in the last message
+    assert messages[-1]["content"].startswith("Example question 1: how many orders?")
+    assert "how many users?" in messages[-1]["content"]
+    # the previous context is unchanged
+    assert messages[1:3] == default_messages[1:3]
+
+
+def test_get_messages_cache_aware_prefix_is_stable():
+    messages = mk_generate_sql_messages("cache_aware", question="how many users?")
+    follow_up_messages = mk_generate_sql_messages(
+        "cache_aware",
+        previous_context=[{"question": "how many users?", "sql": "SELECT COUNT(*) FROM users"}],
+        question="and how many are active?",
+    )
+    assert messages[0] == follow_up_messages[0]
+
+
+def test_add_cache_breakpoints():
+    messages = mk_generate_sql_messages(
+        "cache_aware", [{"question": "list users", "sql": "SELECT * FROM users"}]
+    )
+    assert add_cache_breakpoints(messages, "openai") is messages
+
+    anthropic_messages = add_cache_breakpoints(messages, "anthropic")
+    for i in [0, 2]:
+        assert anthropic_messages[i]["content"] == [
+            {
+                "type": "text",
+                "text": messages[i]["content"],
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
+    assert anthropic_messages[1] == messages[1]
+    assert anthropic_messages[3] == messages[3]
+    # the original messages are not modified
+    assert isinstance(messages[0]["content"], str)
+
+
+def test_estimate_input_cost_in_cents():
+    messages = mk_generate_sql_messages("default", [])
+    cost = estimate_input_cost_in_cents(messages, "gpt-4.1")
+    assert cost is not None and cost > 0
+    longer_messages = mk_generate_sql_messages(
+        "default", [{"question": "list users", "sql": "SELECT * FROM users"}]
+    )
+    assert estimate_input_cost_in_cents(longer_messages, "gpt-4.1") > cost
+    # the pricing of unknown models isn't known
+    assert estimate_input_cost_in_cents(messages, "my-own-model") is None
+
+
+def test_postprocess_sql():
+    sql, err = postprocess_sql(
+        "SELECT t.a / NULLIF(t.b, 0) AS ratio FROM my_table t WHERE t.c > = 1",
+        "postgres",
+        [HardFilter(table_name="my_table", column_name="foo", operator="=", value="bar")],
+    )
+    assert err is None
+    assert " ".join(sql.split()) == (
+        "SELECT t.a / NULLIF(1.0 * t.b, 0) AS ratio FROM my_table AS t "
+        "WHERE t.c >= 1 AND t.foo = 'bar'"
+    )
+    # the NULLIF fix is not applied twice
+    sql, err = postprocess_sql("SELECT a / NULLIF(1.0 * b, 0) FROM t", "postgres")
+    assert " ".join(sql.split()) == "SELECT a / NULLIF(1.0 * b, 0) FROM t"
+
+
+def test_postprocess_sql_schema():
+    sql, err = postprocess_sql(
+        "WITH c AS (SELECT * FROM orders) SELECT * FROM c JOIN other.users u ON c.id = u.id",
+        "postgres",
+        schema="sales",
+    )
+    assert err is None
+    assert "FROM sales.orders" in sql
+    assert "FROM c" in sql
+    assert "JOIN other.users AS u" in sql
+    assert add_schema_to_tables("SELECT * FROM t", "s") == "SELECT * FROM s.t"
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "DELETE FROM my_table",
+        "DROP TABLE my_table",
+        "SELECT * INTO new_table FROM my_table",
+        "UPDATE my_table SET a = 1",
+        "INSERT INTO my_table SELECT * FROM other_table",
+    ],
+)
+def test_postprocess_sql_unsafe(sql: str):
+    assert postprocess_sql(sql, "postgres") == (None, "Unsafe SQL query")
+
+
+def test_postprocess_sql_unparseable():
+    # sqlglot can't parse this, so we fall back to cleaning the SQL as text
+    sql, err = postprocess_sql("SELECT a FROM t WHERE ((", "postgres")
+    assert err is None
+    assert sql.startswith("SELECT a")
+    # unless there are hard filters to add
+    sql, err = postprocess_sql(
+        "SELECT a FROM t WHERE ((",
+        "postgres",
+        [HardFilter(table_name="t", column_name="foo", operator="=", value="bar")],
+    )
+    assert sql is None
+    assert err.startswith("Failed to add hard filters")
+
+
+def mk_df(values: list[int], truncated: bool = False) -> pd.DataFrame:
+    df = pd.DataFrame({"a": values})
+    df.attrs["truncated"] = truncated
+    return df
+
+
+@pytest.mark.parametrize(
+    "gold_truncated, gen_truncated, expected",
+    [
+        (False, False, {"correct": True}),
+        (True, False, {"correct": False, "inconclusive": True}),
+        (False, True, {"correct": False, "inconclusive": True}),
+    ],
+)
+def test_compare_query_results_truncated(gold_truncated: bool, gen_truncated: bool, expected: dict):
+    # results truncated at the row limit can't be compared
+    with patch("utils_sql.execute_sql", AsyncMock(return_value=(mk_df([1, 2], gold_truncated), None))):
+        result = asyncio.run(
+            compare_query_results(
+                query_gold="SELECT a FROM t",
+                query_gen="SELECT a FROM t",
+                df_gen=mk_df([1, 2], gen_truncated),
+                question="what are the a's?",
+                db_type="postgres",
+                db_creds={},
+            )
+        )
+    assert result == expected
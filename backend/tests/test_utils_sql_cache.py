@@ -0,0 +1,74 @@
+import unittest
+from unittest.mock import patch
+
+from request_models import HardFilter
+from utils_sql_cache import get_sql_cache_key
+from utils_token_budget import TokenBudget
+
+
+@patch("utils_sql_cache.get_golden_queries_version", return_value=1)
+@patch("utils_sql_cache.get_schema_version", return_value=1)
+class TestSqlCacheKey(unittest.TestCase):
+    def get_key(self, **kwargs):
+        inputs = {
+            "question": "how many users are there?",
+            "db_name": "my_db",
+            "db_type": "postgres",
+            "hard_filters": [],
+            "previous_context": [],
+            "provider": "openai",
+            "model_name": "o3-mini",
+            "num_golden_queries": 4,
+            "date_today": "2025-01-01",
+            "token_budget": TokenBudget(),
+            "prompt_layout": "default",
+        }
+        inputs.update(kwargs)
+        return get_sql_cache_key(**inputs)
+
+    def test_key_ignores_whitespace(self, *_):
+        self.assertEqual(
+            self.get_key(), self.get_key(question="  how many users\nare there? ")
+        )
+
+    def test_key_depends_on_inputs(self, *_):
+        key = self.get_key()
+        self.assertNotEqual(key, self.get_key(question="how many orders are there?"))
+        self.assertNotEqual(key, self.get_key(db_type="mysql"))
+        self.assertNotEqual(key, self.get_key(model_name="gpt-4.1"))
+        self.assertNotEqual(key, self.get_key(hedge_provider="anthropic", hedge_model_name="claude-3-7-sonnet"))
+        self.assertNotEqual(
+            self.get_key(hedge_provider="openai", hedge_model_name="gpt-4.1"),
+            self.get_key(hedge_provider="anthropic", hedge_model_name="gpt-4.1"),
+        )
+        self.assertNotEqual(
+            key,
+            self.get_key(
+                hard_filters=[
+                    HardFilter(table_name="users", column_name="id", operator="=", value="1")
+                ]
+            ),
+        )
+        self.assertNotEqual(
+            key,
+            self.get_key(previous_context=[{"question": "show users", "sql": "SELECT * FROM users"}]),
+        )
+        self.assertNotEqual(key, self.get_key(date_today="2025-01-02"))
+        self.assertNotEqual(key, self.get_key(token_budget=TokenBudget(ddl=1_000)))
+        self.assertNotEqual(key, self.get_key(prompt_layout="cache_aware"))
+
+    def test_key_depends_on_versions(self, mock_schema_version, mock_golden_queries_version):
+        key = self.get_key()
+        mock_schema_version.return_value = 2
+        self.assertNotEqual(key, self.get_key())
+        mock_schema_version.return_value = 1
+        mock_golden_queries_version.return_value = 2
+        self.assertNotEqual(key, self.get_key())
+
+    def test_no_key_without_versions(self, mock_schema_version, _):
+        mock_schema_version.return_value = None
+        self.assertIsNone(self.get_key())
+
+
+if __name__ == "__main__":
+    unittest.main()
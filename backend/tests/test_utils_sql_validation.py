@@ -0,0 +1,140 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from utils_sql_validation import (
+    get_close_match,
+    get_validation_error,
+    get_validation_hints,
+    validate_sql,
+    validate_sql_for_db,
+)
+
+METADATA = [
+    {"table_name": "public.orders", "column_name": column_name, "data_type": "int"}
+    for column_name in ["order_id", "customer_id", "amount", "status"]
+] + [
+    {"table_name": "public.customers", "column_name": column_name, "data_type": "text"}
+    for column_name in ["customer_id", "name", "segment"]
+] + [
+    {"table_name": "sales_2024", "column_name": "amount", "data_type": "int"},
+]
+
+
+def normalize(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+class TestValidateSQL(unittest.TestCase):
+    def assertValid(self, sql: str):
+        result = validate_sql(sql, "postgres", METADATA)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.fixes, [])
+        self.assertEqual(result.sql, sql)
+
+    def test_valid_queries(self):
+        self.assertValid("SELECT o.order_id, o.amount FROM orders o")
+        self.assertValid("SELECT customer_id, SUM(amount) AS total FROM public.orders GROUP BY customer_id ORDER BY total")
+        self.assertValid(
+            "WITH c AS (SELECT customer_id, SUM(amount) AS amt FROM orders GROUP BY customer_id) "
+            "SELECT c.amt, cu.name FROM c JOIN customers cu ON cu.customer_id = c.customer_id"
+        )
+        # correlated subquery
+        self.assertValid(
+            "SELECT name FROM customers cu WHERE EXISTS "
+            "(SELECT 1 FROM orders o WHERE o.customer_id = cu.customer_id AND status = 'shipped')"
+        )
+        self.assertValid("SELECT segment FROM customers UNION ALL SELECT status FROM orders")
+        # columns that can't be checked are assumed to be valid
+        self.assertValid("SELECT g FROM generate_series(1, 10) AS g")
+        self.assertValid("SELECT x.anything FROM (SELECT * FROM orders) x")
+
+    def test_fix_misspelled_column(self):
+        result = validate_sql("SELECT o.ammount FROM orders o", "postgres", METADATA)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.fixes, ["Replaced column `o.ammount` with `o.amount`"])
+        self.assertEqual(normalize(result.sql), "SELECT o.amount FROM orders AS o")
+
+        result = validate_sql(
+            "SELECT custmer_id, COUNT(*) FROM orders GROUP BY custmer_id", "postgres", METADATA
+        )
+        self.assertEqual(result.errors, [])
+        self.assertEqual(
+            normalize(result.sql),
+            "SELECT customer_id, COUNT(*) FROM orders GROUP BY customer_id",
+        )
+
+    def test_misspelled_table_is_suggested(self):
+        # `customer` may be a different table that exists in the db, so it is
+        # never replaced
+        result = validate_sql("SELECT name FROM customer", "postgres", METADATA)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.fixes, [])
+        self.assertEqual(
+            result.warnings,
+            ["Table `customer` is not in the metadata (did you mean `public.customers`?), so it was not checked"],
+        )
+        self.assertEqual(result.sql, "SELECT name FROM customer")
+        self.assertIn("did you mean `public.customers`?", get_validation_hints(result))
+
+    def test_unresolvable(self):
+        result = validate_sql("SELECT o.discount FROM orders o", "postgres", METADATA)
+        self.assertEqual(result.errors, ["Column `discount` does not exist in `o`"])
+        self.assertEqual(result.sql, "SELECT o.discount FROM orders o")
+
+        result = validate_sql("SELECT discount FROM orders", "postgres", METADATA)
+        self.assertEqual(
+            result.errors,
+            ["Column `discount` does not exist in any of the tables in the query"],
+        )
+
+        self.assertIn("- Column `discount` does not exist", get_validation_error(result))
+
+    def test_unknown_tables(self):
+        # tables that aren't in the metadata may still exist, so they are only
+        # warnings, and their columns aren't checked
+        result = validate_sql("SELECT * FROM invoices", "postgres", METADATA)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.warnings, ["Table `invoices` is not in the metadata, so it was not checked"])
+
+        result = validate_sql("SELECT tablename FROM pg_catalog.pg_tables", "postgres", METADATA)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(len(result.warnings), 1)
+
+        # tables with different digits are never fuzzy matched
+        result = validate_sql("SELECT amount FROM sales_2023", "postgres", METADATA)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.sql, "SELECT amount FROM sales_2023")
+
+        # columns of known tables are still checked
+        result = validate_sql(
+            "SELECT o.discount, i.amount FROM orders o JOIN invoices i ON o.order_id = i.order_id",
+            "postgres",
+            METADATA,
+        )
+        self.assertEqual(result.errors, ["Column `discount` does not exist in `o`"])
+        self.assertEqual(result.warnings, ["Table `invoices` is not in the metadata, so it was not checked"])
+
+    def test_skipped(self):
+        # no metadata, or SQL that sqlglot can't parse
+        self.assertEqual(validate_sql("SELECT a FROM b", "postgres", []).errors, [])
+        self.assertEqual(validate_sql("SELECT a FROM b WHERE ((", "postgres", METADATA).errors, [])
+
+    def test_get_close_match(self):
+        self.assertEqual(get_close_match("custmer_id", ["customer_id", "name"]), "customer_id")
+        self.assertIsNone(get_close_match("foo", ["customer_id", "name"]))
+        # ambiguous
+        self.assertIsNone(get_close_match("col_a", ["col_ab", "col_ac"]))
+
+
+class TestValidateSQLForDB(unittest.IsolatedAsyncioTestCase):
+    async def test_metadata_unavailable(self):
+        with patch(
+            "utils_sql_validation.get_schema_context",
+            AsyncMock(side_effect=Exception("db down")),
+        ):
+            result = await validate_sql_for_db("db", "postgres", "SELECT o.discount FROM orders o")
+        self.assertEqual(result.errors, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
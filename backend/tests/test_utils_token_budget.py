@@ -0,0 +1,279 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from request_models import TableDescription
+from utils_golden_queries import GoldenQuery
+import utils_token_budget
+from utils_md import mk_compact_ddl, mk_create_ddl
+from utils_token_budget import (
+    TokenBudget,
+    count_schema_tokens,
+    count_tokens,
+    fit_prompt_to_budget,
+    get_encoding,
+    get_golden_query_text,
+    get_question_answer_text,
+    load_encoding,
+    trim_golden_queries,
+    trim_previous_context,
+    truncate_ddl,
+    truncate_text,
+)
+
+MODEL_NAME = "gpt-4.1"
+
+
+def mk_metadata(table_names: list[str], num_columns: int = 5) -> list[dict[str, str]]:
+    return [
+        {
+            "table_name": table_name,
+            "column_name": f"column_{i}",
+            "data_type": "text",
+            "column_description": f"description of column {i} in {table_name}",
+        }
+        for table_name in table_names
+        for i in range(num_columns)
+    ]
+
+
+class FakeEncoding:
+    """
+    Stands in for a loaded tokenizer, with one token per word.
+    """
+
+    name = "fake"
+
+    def encode(self, text: str, disallowed_special=()) -> list[str]:
+        return text.split()
+
+
+class TestGetEncoding(unittest.TestCase):
+    def setUp(self):
+        patch.object(utils_token_budget, "ENCODINGS", {}).start()
+        patch.object(utils_token_budget, "ENCODING_FAILURES", {}).start()
+        self.encoding_for_model = patch.object(
+            utils_token_budget.tiktoken, "encoding_for_model"
+        ).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_failures_are_not_cached(self):
+        self.encoding_for_model.side_effect = [OSError("download failed"), "encoding"]
+        self.assertIsNone(get_encoding("my-model"))
+        # within the retry interval, the failure is remembered
+        self.assertIsNone(get_encoding("my-model"))
+        self.assertEqual(self.encoding_for_model.call_count, 1)
+        with patch.object(utils_token_budget, "ENCODING_RETRY_INTERVAL", 0):
+            self.assertEqual(get_encoding("my-model"), "encoding")
+        self.assertEqual(get_encoding("my-model"), "encoding")
+        self.assertEqual(self.encoding_for_model.call_count, 2)
+
+
+class TestGetEncodingAsync(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patch.object(utils_token_budget, "ENCODINGS", {}).start()
+        patch.object(utils_token_budget, "ENCODING_FAILURES", {}).start()
+        patch.object(utils_token_budget, "ENCODING_LOAD_TASKS", {}).start()
+        self.encoding_for_model = patch.object(
+            utils_token_budget.tiktoken, "encoding_for_model", return_value="encoding"
+        ).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    async def test_loads_in_background(self):
+        # token counts are estimated until the tokenizer has loaded
+        self.assertIsNone(get_encoding("my-model"))
+        self.assertEqual(count_tokens("12345678", "my-model"), 2)
+        await utils_token_budget.ENCODING_LOAD_TASKS["my-model"]
+        self.assertEqual(get_encoding("my-model"), "encoding")
+        self.assertEqual(self.encoding_for_model.call_count, 1)
+        self.assertEqual(utils_token_budget.ENCODING_LOAD_TASKS, {})
+
+
+class TestCountSchemaTokens(unittest.TestCase):
+    def setUp(self):
+        patch.object(utils_token_budget, "ENCODINGS", {MODEL_NAME: FakeEncoding()}).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_token_counts_are_cached(self):
+        metadata = mk_metadata(["a", "b"])
+        token_counts = {}
+        header_tokens, table_tokens = count_schema_tokens(
+            metadata, [], MODEL_NAME, "compact", token_counts
+        )
+        self.assertEqual(len(token_counts), 1)
+        with patch.object(
+            utils_token_budget, "mk_schema_prompt", wraps=utils_token_budget.mk_schema_prompt
+        ) as mk_schema_prompt:
+            self.assertEqual(
+                count_schema_tokens(metadata, [], MODEL_NAME, "compact", token_counts),
+                (header_tokens, table_tokens),
+            )
+            self.assertEqual(mk_schema_prompt.call_count, 0)
+            # a table with some of its columns pruned is counted again
+            _, pruned_table_tokens = count_schema_tokens(
+                metadata[:3], [], MODEL_NAME, "compact", token_counts
+            )
+            self.assertEqual(mk_schema_prompt.call_count, 1)
+        self.assertLess(pruned_table_tokens["a"], table_tokens["a"])
+        # without token_counts, nothing is cached
+        self.assertEqual(
+            count_schema_tokens(metadata, [], MODEL_NAME, "compact"),
+            (header_tokens, table_tokens),
+        )
+
+
+class TestTrimSections(unittest.TestCase):
+    def test_trim_previous_context(self):
+        previous_context = [
+            {"question": f"question {i}", "sql": f"SELECT {i} FROM my_table"} for i in range(5)
+        ]
+        last_two_tokens = sum(
+            count_tokens(get_question_answer_text(qa), MODEL_NAME) for qa in previous_context[-2:]
+        )
+        self.assertEqual(
+            trim_previous_context(previous_context, last_two_tokens, MODEL_NAME),
+            previous_context[-2:],
+        )
+        self.assertEqual(trim_previous_context(previous_context, 0, MODEL_NAME), [])
+
+    def test_trim_golden_queries(self):
+        golden_queries = [
+            GoldenQuery(db_name="db", question="q1", sql="SELECT 1", similarity=0.7),
+            GoldenQuery(db_name="db", question="q2", sql="SELECT 2", similarity=0.9),
+            GoldenQuery(db_name="db", question="q3", sql="SELECT 3", similarity=0.8),
+        ]
+        max_tokens = count_tokens(get_golden_query_text(golden_queries[1]), MODEL_NAME) + count_tokens(
+            get_golden_query_text(golden_queries[2]), MODEL_NAME
+        )
+        trimmed = trim_golden_queries(golden_queries, max_tokens, MODEL_NAME)
+        self.assertEqual([gq.question for gq in trimmed], ["q2", "q3"])
+
+    def test_truncate_text(self):
+        text = "\n".join(f"rule number {i}" for i in range(100))
+        self.assertEqual(truncate_text(text, 10_000, MODEL_NAME), text)
+        truncated = truncate_text(text, 20, MODEL_NAME)
+        self.assertTrue(text.startswith(truncated))
+        self.assertLessEqual(count_tokens(truncated, MODEL_NAME), 20)
+        self.assertTrue(truncated.endswith("\n"))
+
+    def test_truncate_ddl(self):
+        metadata = mk_metadata(["a", "b", "c"])
+        table_descriptions = [TableDescription(table_name="b", table_description="table b")]
+        table_tokens = count_tokens(mk_create_ddl(mk_metadata(["a"])), MODEL_NAME)
+        # room for 2 tables, so the least relevant one is dropped
+        truncated_metadata, truncated_table_descriptions = truncate_ddl(
+            metadata,
+            table_descriptions,
+            int(table_tokens * 2.5),
+            MODEL_NAME,
+            table_scores={"a": 0.1, "b": 0.9, "c": 0.5},
+        )
+        self.assertEqual(
+            sorted({column["table_name"] for column in truncated_metadata}), ["b", "c"]
+        )
+        self.assertEqual(truncated_table_descriptions, table_descriptions)
+        # without scores, tables are kept in order
+        truncated_metadata, _ = truncate_ddl(
+            metadata, table_descriptions, int(table_tokens * 1.5), MODEL_NAME
+        )
+        self.assertEqual({column["table_name"] for column in truncated_metadata}, {"a"})
+
+    def test_truncate_compact_ddl(self):
+        # the compact header is only counted once, so all 3 tables fit in the
+        # tokens of the full compact schema
+        metadata = mk_metadata(["a", "b", "c"])
+        max_tokens = count_tokens(mk_compact_ddl(metadata), MODEL_NAME)
+        truncated_metadata, _ = truncate_ddl(
+            metadata, [], max_tokens, MODEL_NAME, schema_format="compact"
+        )
+        self.assertEqual(truncated_metadata, metadata)
+
+
+class TestFitPromptToBudget(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        # load the tokenizer up front, so that counts aren't estimated while
+        # it loads in the background
+        load_encoding(MODEL_NAME)
+
+    async def test_within_budget(self):
+        metadata = mk_metadata(["a", "b"])
+        budgeted_prompt = await fit_prompt_to_budget(
+            model_name=MODEL_NAME,
+            question="how many rows are in a?",
+            fixed_text="system prompt",
+            metadata=metadata,
+            instructions="some instructions",
+            previous_context=[{"question": "q", "sql": "SELECT 1"}],
+        )
+        self.assertEqual(budgeted_prompt.cuts, [])
+        self.assertEqual(budgeted_prompt.metadata, metadata)
+        self.assertEqual(budgeted_prompt.ddl, mk_create_ddl(metadata))
+        self.assertEqual(budgeted_prompt.instructions, "some instructions")
+
+    async def test_total_budget(self):
+        metadata = mk_metadata(["a", "b", "c"])
+        ddl = mk_create_ddl(metadata)
+        previous_context = [
+            {"question": f"question {i}", "sql": f"SELECT {i} FROM a"} for i in range(10)
+        ]
+        previous_context_tokens = sum(
+            count_tokens(get_question_answer_text(qa), MODEL_NAME) for qa in previous_context
+        )
+        # the previous context has to go, and then 1 table
+        budget = TokenBudget(total=count_tokens(ddl, MODEL_NAME) * 3 // 4)
+        with patch(
+            "utils_token_budget.get_table_scores",
+            AsyncMock(return_value={"a": 0.9, "b": 0.1, "c": 0.5}),
+        ):
+            budgeted_prompt = await fit_prompt_to_budget(
+                model_name=MODEL_NAME,
+                question="how many rows are in a?",
+                fixed_text="",
+                metadata=metadata,
+                ddl=ddl,
+                previous_context=previous_context,
+                budget=budget,
+            )
+        self.assertGreater(previous_context_tokens, 0)
+        self.assertEqual(budgeted_prompt.previous_context, [])
+        self.assertEqual(
+            sorted({column["table_name"] for column in budgeted_prompt.metadata}), ["a", "c"]
+        )
+        self.assertLessEqual(budgeted_prompt.num_tokens, budget.total)
+        self.assertEqual(len(budgeted_prompt.cuts), 2)
+
+    async def test_cached_token_counts(self):
+        patch.object(utils_token_budget, "ENCODINGS", {MODEL_NAME: FakeEncoding()}).start()
+        self.addCleanup(patch.stopall)
+        metadata = mk_metadata(["a", "b", "c"])
+        token_counts = {}
+        budget = TokenBudget(ddl=count_tokens(mk_create_ddl(metadata), MODEL_NAME) * 3 // 4)
+        with patch(
+            "utils_token_budget.get_table_scores",
+            AsyncMock(return_value={"a": 0.9, "b": 0.1, "c": 0.5}),
+        ):
+            for _ in range(2):
+                budgeted_prompt = await fit_prompt_to_budget(
+                    model_name=MODEL_NAME,
+                    question="how many rows are in a?",
+                    fixed_text="",
+                    metadata=metadata,
+                    budget=budget,
+                    token_counts=token_counts,
+                )
+                self.assertEqual(
+                    sorted({column["table_name"] for column in budgeted_prompt.metadata}),
+                    ["a", "c"],
+                )
+        self.assertEqual(len(token_counts), 1)
+        self.assertEqual(len(next(iter(token_counts.values())).tables), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import column, select, table
+
+import utils_vector_search
+from utils_vector_search import parse_pgvector_version, search_hnsw_index
+
+
+def mk_search(limit: int):
+    return (
+        select(column("a"))
+        .select_from(table("t"))
+        .where(column("db_name") == "db")
+        .order_by(column("distance"))
+        .limit(limit)
+    )
+
+
+class FakeConnection:
+    """
+    Records the SQL executed, and returns `search_results` in turn for each
+    search (any statement that isn't a SET, a count or the pgvector version
+    lookup). Counts of the matching rows return `num_matching`.
+    """
+
+    def __init__(self, version: str | None, search_results: list[list], num_matching: int = 0):
+        self.version = version
+        self.search_results = list(search_results)
+        self.num_matching = num_matching
+        self.executed = []
+
+    async def execute(self, stmt):
+        sql = str(stmt)
+        self.executed.append(sql)
+        result = MagicMock()
+        if "pg_extension" in sql:
+            result.scalar_one_or_none.return_value = self.version
+        elif "count(*)" in sql:
+            result.scalar_one.return_value = self.num_matching
+        elif not sql.startswith("SET"):
+            result.all.return_value = self.search_results.pop(0)
+        return result
+
+
+class TestSearchHnswIndex(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patch.object(utils_vector_search, "ITERATIVE_SCAN_SUPPORTED", None).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    async def test_iterative_scan(self):
+        conn = FakeConnection("0.8.0", [[("a",)]])
+        rows = await search_hnsw_index(conn, mk_search(4), limit=4, ef_search=100)
+        self.assertEqual(rows, [("a",)])
+        self.assertIn("SET LOCAL hnsw.ef_search = 100", conn.executed)
+        self.assertIn("SET LOCAL hnsw.iterative_scan = strict_order", conn.executed)
+        self.assertNotIn("SET LOCAL enable_indexscan = off", conn.executed)
+
+    async def test_exact_fallback_without_iterative_scan(self):
+        conn = FakeConnection("0.7.4", [[("a",)], [("a",), ("b",)]], num_matching=5)
+        rows = await search_hnsw_index(conn, mk_search(2), limit=2, ef_search=100)
+        self.assertEqual(rows, [("a",), ("b",)])
+        self.assertNotIn("SET LOCAL hnsw.iterative_scan = strict_order", conn.executed)
+        self.assertIn("SET LOCAL enable_indexscan = off", conn.executed)
+
+    async def test_no_fallback_without_more_matching_rows(self):
+        # the db_name only has 1 row, so the index scan already found everything
+        conn = FakeConnection("0.7.4", [[("a",)]], num_matching=1)
+        rows = await search_hnsw_index(conn, mk_search(2), limit=2, ef_search=100)
+        self.assertEqual(rows, [("a",)])
+        self.assertNotIn("SET LOCAL enable_indexscan = off", conn.executed)
+
+    async def test_no_fallback_with_enough_rows(self):
+        conn = FakeConnection("0.7.4", [[("a",), ("b",)]])
+        rows = await search_hnsw_index(conn, mk_search(2), limit=2, ef_search=1)
+        self.assertEqual(rows, [("a",), ("b",)])
+        self.assertIn("SET LOCAL hnsw.ef_search = 2", conn.executed)
+        self.assertNotIn("SET LOCAL enable_indexscan = off", conn.executed)
+
+    async def test_version_checked_once(self):
+        conn = FakeConnection("0.8.0", [[], []])
+        await search_hnsw_index(conn, mk_search(1), limit=1, ef_search=100)
+        await search_hnsw_index(conn, mk_search(1), limit=1, ef_search=100)
+        self.assertEqual(sum("pg_extension" in sql for sql in conn.executed), 1)
+
+    def test_parse_pgvector_version(self):
+        self.assertEqual(parse_pgvector_version("0.8.0"), (0, 8, 0))
+        self.assertGreater(parse_pgvector_version("0.10.1"), (0, 8))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,53 +2,119 @@
 # top level for a cleaner import statement
 # from tool_code_utilities import xx
 
-from defog.query import async_execute_query_once
 import re
 import pandas as pd
 from db_utils import get_db_type_creds
+from utils_df import arrow_to_df
+from utils_connection_pool import QueryTimeoutError
+from utils_logging import LOGGER
+from utils_query_cache import fetch_cached_query_results
+from utils_query_results import get_max_rows
 from utils_sql import safe_sql, retry_query_after_error
+from utils_sql_validation import (
+    get_validation_error,
+    get_validation_hints,
+    validate_sql_for_db,
+)
 from typing import Tuple
 
 
+async def fix_sql_query(question: str, sql_query: str, error_msg: str, db_name: str) -> str:
+    """
+    Ask the LLM to fix a sql query given its error.
+    Raises a ValueError if it couldn't be fixed.
+    """
+    fixed = await retry_query_after_error(
+        question=question,
+        sql=sql_query,
+        error=error_msg,
+        db_name=db_name,
+    )
+    if fixed["sql"] is None:
+        raise ValueError(f"Could not fix the SQL query after the error `{error_msg}`: {fixed['error']}")
+    return fixed["sql"]
+
+
 async def fetch_query_into_df(
     db_name: str,
     sql_query: str,
     question: str = None,
+    max_rows: int = None,
+    use_cache: bool = True,
+    timeout: float = None,
 ) -> Tuple[pd.DataFrame, str]:
     """
     Runs a sql query and stores the results in a pandas dataframe.
+    The query is validated against the db's metadata first, and fixed (once)
+    by the LLM if it references columns that don't exist in the metadata's
+    tables, or if it fails to run. Tables that aren't in the metadata are left
+    for the db to check. A ValueError is raised if the query can't be fixed.
+    At most max_rows rows are fetched, capped at the db's row limit
+    (see utils_query_results.get_max_rows). Whether the query returned more
+    rows than that is stored in the `truncated` attr of the df.
+    Results are served from the query result cache of the db when possible,
+    unless use_cache is False (see utils_query_cache). Whether they were, and
+    how old they are, is stored in the `cached` and `cache_age` attrs of the df.
+    Queries time out after the db's timeout, or after timeout seconds if that
+    is lower, with a QueryTimeoutError (see utils_query_results.get_query_timeout).
+    Timed out queries are not retried.
     """
     db_type, db_creds = await get_db_type_creds(db_name)
+    max_rows = await get_max_rows(db_name, max_rows)
 
     # make sure not unsafe
     if not safe_sql(sql_query):
         raise ValueError("Unsafe SQL Query")
 
+    # check the tables and columns against the stored metadata before running
+    # the query. Misspelled columns are fixed locally, and missing columns of
+    # known tables are fixed by the LLM without a round trip to the db.
+    # Unknown tables are left to the db, and suggested if the query fails.
+    validation = await validate_sql_for_db(db_name, db_type, sql_query)
+    sql_query = validation.sql
+    retried = False
+    if validation.errors:
+        error_msg = get_validation_error(validation)
+        LOGGER.info(f"Fixing SQL that failed validation: {error_msg}")
+        sql_query = await fix_sql_query(question, sql_query, error_msg, db_name)
+        retried = True
+
     try:
-        colnames, data = await async_execute_query_once(
-            query=sql_query,
+        results = await fetch_cached_query_results(
+            db_name=db_name,
             db_type=db_type,
             db_creds=db_creds,
+            sql=sql_query,
+            max_rows=max_rows,
+            use_cache=use_cache,
+            timeout=timeout,
         )
+    except QueryTimeoutError:
+        raise
     except Exception as e:
+        if retried:
+            raise
         # retry exactly once
-        error_msg = str(e)
-        sql_query = (
-            await retry_query_after_error(
-                question=question,
-                sql=sql_query,
-                error=error_msg,
-                db_name=db_name,
-            )
-        )["sql"]
+        sql_query = await fix_sql_query(
+            question, sql_query, str(e) + get_validation_hints(validation), db_name
+        )
 
-        colnames, data = await async_execute_query_once(
-            query=sql_query,
+        results = await fetch_cached_query_results(
+            db_name=db_name,
             db_type=db_type,
             db_creds=db_creds,
+            sql=sql_query,
+            max_rows=max_rows,
+            use_cache=use_cache,
+            timeout=timeout,
         )
 
-    df = pd.DataFrame(data, columns=colnames)
+    if results.truncated:
+        LOGGER.warning(f"Query returned more than {max_rows} rows, only the first {max_rows} were fetched")
+    df = arrow_to_df(results.table)
+    df.attrs["truncated"] = results.truncated
+    df.attrs["cached"] = results.cached
+    df.attrs["cache_age"] = results.cache_age
 
     # if this df has any columns that have lists, remove those columns
     for col in df.columns:
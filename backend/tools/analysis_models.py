@@ -45,6 +45,16 @@ class AnswerQuestionFromDatabaseOutput(BaseModel):
     df_truncated: Optional[bool] = Field(
         default=None, description="Whether the dataframe was truncated"
     )
+    summary: Optional[str] = Field(
+        default=None,
+        description="Summary of all the rows fetched (numeric statistics, most frequent values and rollups by time), if there were too many to return in full",
+    )
+    cached: Optional[bool] = Field(
+        default=None, description="Whether the data was served from the query result cache"
+    )
+    cache_age: Optional[float] = Field(
+        default=None, description="How old the cached data is, in seconds"
+    )
     error: Optional[str] = Field(default=None, description="Error message if any")
 
 
@@ -4,6 +4,7 @@ import numpy as np
 import json
 import uuid
 import time
+from contextvars import ContextVar
 from typing import Any, Callable
 
 from tools.analysis_models import (
@@ -14,19 +15,29 @@ from tools.analysis_models import (
     AnswerQuestionViaPDFCitationsInput,
     GenerateReportFromQuestionOutput,
 )
+from utils_connection_pool import QueryTimeoutError
+from utils_df import mk_df_from_arrow, summarize_df
 from utils_logging import LOG_LEVEL, LOGGER
-from utils_md import get_metadata, mk_create_ddl
+from utils_query_cache import fetch_cached_query_results
+from utils_query_preflight import estimate_query, get_cost_error, get_query_preflight_config
+from utils_query_results import get_max_rows
+from utils_schema_context import get_schema_context
 from utils_sql import generate_sql_query
 from db_utils import get_db_type_creds
 from defog.llm.utils import chat_async
 from defog.llm.web_search import web_search_tool as web_search
 from defog.llm.citations import citations_tool
 from defog.llm.code_interp import code_interpreter_tool as code_interpreter
-from defog.query import async_execute_query_once
 from anthropic import AsyncAnthropic
 from utils_oracle import get_pdf_content
 
 
+# whether text_to_sql_tool summarizes results with too many rows locally, rather
+# than asking for an aggregated query. It is set per report by
+# multi_agent_report_generation, since tools only take the input from the LLM.
+SUMMARIZE_LARGE_RESULTS: ContextVar[bool] = ContextVar("summarize_large_results", default=False)
+
+
 async def text_to_sql_tool(
     input: AnswerQuestionFromDatabaseInput,
 ) -> AnswerQuestionFromDatabaseOutput:
@@ -51,27 +62,64 @@ async def text_to_sql_tool(
         return AnswerQuestionFromDatabaseOutput(question=question, error=error_msg)
     sql = sql_response["sql"]
 
-    # execute SQL
+    # execute SQL, fetching at most max_rows_displayed rows (and one more, to
+    # know if the data needs to be aggregated). When summarizing large results
+    # locally, fetch up to the row limit of the db instead, to summarize them.
+    db_max_rows = await get_max_rows(db_name)
+    max_rows_displayed = min(50, db_max_rows)
+    summarize_large_results = SUMMARIZE_LARGE_RESULTS.get()
+    max_rows = db_max_rows if summarize_large_results else max_rows_displayed
     db_type, db_creds = await get_db_type_creds(db_name)
-    try:
-        colnames, rows = await async_execute_query_once(
-            db_type=db_type, db_creds=db_creds, query=sql
-        )
-    except Exception as e:
-        error_msg = f"Error executing SQL: {e}. Rephrase the question by incorporating specific details of the error to address it."
-        LOGGER.error(error_msg)
-        return AnswerQuestionFromDatabaseOutput(
-            question=question, sql=sql, error=error_msg
+
+    # if enabled for the db, estimate the query before running it, to refuse it
+    # if it is too expensive, and to ask for an aggregated query straight away
+    # (rather than after running it) if it returns too many rows
+    preflight_config = await get_query_preflight_config(db_name)
+    needs_aggregation = False
+    if preflight_config.enabled:
+        estimate = await estimate_query(db_type, db_creds, sql)
+        LOGGER.info(f"Estimated rows and cost of the SQL: {estimate}")
+        cost_error = get_cost_error(estimate, preflight_config.max_cost)
+        if cost_error:
+            error_msg = f"Error executing SQL: {cost_error}. Rephrase the question so that it needs less data, e.g. by filtering on a narrower time range or aggregating the data."
+            LOGGER.error(error_msg)
+            return AnswerQuestionFromDatabaseOutput(
+                question=question, sql=sql, error=error_msg
+            )
+        needs_aggregation = (
+            not summarize_large_results
+            and estimate is not None
+            and estimate.rows is not None
+            and estimate.rows > max_rows_displayed
         )
 
-    if LOG_LEVEL == "DEBUG":
-        LOGGER.debug(f"Column names:\n{colnames}\n")
-        first_20_rows_str = "\n".join([str(row) for row in rows[:20]])
-        LOGGER.debug(f"First 20 rows:\n{first_20_rows_str}\n")
+    if not needs_aggregation:
+        try:
+            results = await fetch_cached_query_results(
+                db_name=db_name, db_type=db_type, db_creds=db_creds, sql=sql, max_rows=max_rows
+            )
+            colnames, rows = results.columns, results.rows
+        except QueryTimeoutError as e:
+            error_msg = f"Error executing SQL: {e}. Rephrase the question so that it needs less data, e.g. by filtering on a narrower time range or aggregating the data."
+            LOGGER.error(error_msg)
+            return AnswerQuestionFromDatabaseOutput(
+                question=question, sql=sql, error=error_msg
+            )
+        except Exception as e:
+            error_msg = f"Error executing SQL: {e}. Rephrase the question by incorporating specific details of the error to address it."
+            LOGGER.error(error_msg)
+            return AnswerQuestionFromDatabaseOutput(
+                question=question, sql=sql, error=error_msg
+            )
+
+        if LOG_LEVEL == "DEBUG":
+            LOGGER.debug(f"Column names:\n{colnames}\n")
+            first_20_rows_str = "\n".join([str(row) for row in rows[:20]])
+            LOGGER.debug(f"First 20 rows:\n{first_20_rows_str}\n")
+        needs_aggregation = results.truncated and not summarize_large_results
 
     # aggregate data if too large
-    max_rows_displayed = 50
-    if len(rows) > max_rows_displayed:
+    if needs_aggregation:
         agg_question = (
             question
             + f" Aggregate or limit the data appropriately or place the data in meaningful buckets such that the result is within a reasonable size (max {max_rows_displayed} rows) and useful for analysis."
@@ -93,9 +141,26 @@ async def text_to_sql_tool(
             LOGGER.error(error_msg)
             return AnswerQuestionFromDatabaseOutput(question=question, sql=agg_sql, error=error_msg)
         db_type, db_creds = res
+        if preflight_config.enabled:
+            cost_error = get_cost_error(
+                await estimate_query(db_type, db_creds, agg_sql), preflight_config.max_cost
+            )
+            if cost_error:
+                error_msg = f"Error executing aggregate SQL: {cost_error}. Rephrase the question so that it needs less data, e.g. by filtering on a narrower time range."
+                LOGGER.error(error_msg)
+                return AnswerQuestionFromDatabaseOutput(
+                    question=question, sql=agg_sql, error=error_msg
+                )
         try:
-            colnames, rows = await async_execute_query_once(
-                db_type=db_type, db_creds=db_creds, query=agg_sql
+            results = await fetch_cached_query_results(
+                db_name=db_name, db_type=db_type, db_creds=db_creds, sql=agg_sql, max_rows=max_rows_displayed
+            )
+            colnames, rows = results.columns, results.rows
+        except QueryTimeoutError as e:
+            error_msg = f"Error executing aggregate SQL: {e}. Rephrase the question so that it needs less data, e.g. by filtering on a narrower time range."
+            LOGGER.error(error_msg)
+            return AnswerQuestionFromDatabaseOutput(
+                question=question, sql=agg_sql, error=error_msg
             )
         except Exception as e:
             error_msg = f"Error executing aggregate SQL: {e}. Rephrase the question by incorporating specific details of the error to address it."
@@ -111,11 +176,8 @@ async def text_to_sql_tool(
             LOGGER.debug(f"First 5 aggregate rows:\n{first_5_rows_str}\n")
 
     # construct df and then convert to json string
-    df_truncated = False
+    df_truncated = results.truncated
     result_df = pd.DataFrame(rows, columns=colnames)
-    if len(rows) > max_rows_displayed:
-        result_df = result_df.head(max_rows_displayed)
-        df_truncated = True
 
     # if a column name is repeated, append the column name with a number
     colnames = result_df.columns.tolist()
@@ -126,6 +188,17 @@ async def text_to_sql_tool(
                     colnames[i] = f"{col}_{i}"
     result_df.columns = colnames
 
+    # summarize large results locally, and only return the first rows of them
+    summary = None
+    if len(result_df) > max_rows_displayed:
+        typed_df = mk_df_from_arrow(results.table)
+        typed_df.columns = colnames
+        summary = summarize_df(typed_df)
+        if results.truncated:
+            summary = f"Only the first {len(result_df)} rows were fetched.\n{summary}"
+        result_df = result_df.head(max_rows_displayed)
+        df_truncated = True
+
     result_json = result_df.to_json(orient="records", double_precision=4, date_format="iso")
     columns = result_df.columns.astype(str).tolist()
     if result_json == "[]":
@@ -140,6 +213,9 @@ async def text_to_sql_tool(
         columns=columns,
         rows=result_json,
         df_truncated=df_truncated,
+        summary=summary,
+        cached=results.cached,
+        cache_age=results.cache_age,
         error=error_msg,
     )
 
@@ -583,6 +659,7 @@ async def multi_agent_report_generation(
     post_tool_func: Callable,
     pdf_file_ids: list[int] = [],
     use_websearch: bool = False,
+    summarize_large_results: bool = False,
 ) -> GenerateReportFromQuestionOutput:
     """
     Implements a multi-agent approach to report generation using specialized agents
@@ -594,7 +671,12 @@ async def multi_agent_report_generation(
     3. Report Synthesis: Create a final polished report from all gathered insights
     
     Each phase uses Claude 3.7 Sonnet with specific instructions for its role.
+
+    If summarize_large_results is True, database results with too many rows are
+    summarized locally by text_to_sql_tool, rather than with a second,
+    aggregated query (see SUMMARIZE_LARGE_RESULTS).
     """
+    summarize_token = SUMMARIZE_LARGE_RESULTS.set(summarize_large_results)
     try:
         # Setup tools for all agents
         tools = [text_to_sql_tool, think_tool, code_interpreter_tool]
@@ -611,8 +693,8 @@ async def multi_agent_report_generation(
         tools.extend(custom_tools)
         
         # Get database metadata
-        metadata = await get_metadata(db_name)
-        metadata_str = mk_create_ddl(metadata)
+        schema_context = await get_schema_context(db_name)
+        metadata_str = schema_context.ddl
         
         # Record all SQL answers throughout the process
         all_sql_answers = []
@@ -857,4 +939,6 @@ If adding LaTeX expressions, you MUST use these specific tags exactly and consis
             sql_answers=[],
             tool_outputs=[],
         )
+    finally:
+        SUMMARIZE_LARGE_RESULTS.reset(summarize_token)
 
@@ -0,0 +1,215 @@
+########################################
+### Caching Related Functions Below ###
+########################################
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+import redis
+from db_config import redis_client
+from utils_logging import LOGGER
+
+# namespaces for the version counters that we keep in redis
+SCHEMA_VERSION_NAMESPACE = "schema_version"
+GOLDEN_QUERIES_VERSION_NAMESPACE = "golden_queries_version"
+DB_CREDS_VERSION_NAMESPACE = "db_creds_version"
+QUERY_SETTINGS_VERSION_NAMESPACE = "query_settings_version"
+
+# functions returning the stats of each cache, keyed by cache name
+CACHE_STATS_PROVIDERS: dict[str, Callable[[], dict[str, Any]]] = {}
+
+
+class LRUCache:
+    """
+    A small in-process LRU cache with an optional time-to-live per entry.
+    Keeps track of hits and misses so that callers can report hit rates.
+    This is not shared across uvicorn workers - pair it with a version counter
+    from `get_version` if the cached values can be modified by another worker.
+    """
+
+    def __init__(self, max_size: int = 128, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        inserted_at, value = entry
+        if self.ttl is not None and time.monotonic() - inserted_at > self.ttl:
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def register_cache_stats(name: str, get_stats: Callable[[], dict[str, Any]]):
+    """
+    Register a function that returns the stats (hits, misses, etc) of a cache,
+    so that they are reported by `get_all_cache_stats`.
+    """
+    CACHE_STATS_PROVIDERS[name] = get_stats
+
+
+def get_all_cache_stats() -> dict[str, dict[str, Any]]:
+    """
+    Get the stats of all registered caches in this worker.
+    """
+    return {name: get_stats() for name, get_stats in CACHE_STATS_PROVIDERS.items()}
+
+
+def get_version(namespace: str, db_name: str) -> int | None:
+    """
+    Get the current version counter for a given namespace and db_name.
+    The counter lives in redis so that it is shared across all uvicorn workers.
+    Returns 0 if the counter has never been bumped, and None if redis is
+    unavailable (callers should then skip their cache instead of risking
+    stale reads).
+    """
+    try:
+        version = redis_client.get(f"{namespace}:{db_name}")
+        return int(version) if version is not None else 0
+    except redis.RedisError as e:
+        LOGGER.warning(f"Could not read {namespace} for {db_name} from redis: {e}")
+        return None
+
+
+def bump_version(namespace: str, db_name: str) -> None:
+    """
+    Increment the version counter for a given namespace and db_name, which
+    invalidates all cached values derived from the previous version.
+    """
+    try:
+        redis_client.incr(f"{namespace}:{db_name}")
+    except redis.RedisError as e:
+        LOGGER.warning(f"Could not bump {namespace} for {db_name} in redis: {e}")
+
+
+def get_schema_version(db_name: str) -> int | None:
+    """
+    Version of the schema context (metadata, table descriptions, instructions,
+    join hints, schema pruning config and schema format) for a given db_name.
+    """
+    return get_version(SCHEMA_VERSION_NAMESPACE, db_name)
+
+
+def bump_schema_version(db_name: str) -> None:
+    """
+    Should be called whenever the metadata, table descriptions, instructions,
+    join hints, schema pruning config or schema format for a given db_name are
+    modified.
+    """
+    bump_version(SCHEMA_VERSION_NAMESPACE, db_name)
+
+
+def get_golden_queries_version(db_name: str) -> int | None:
+    """
+    Version of the golden queries for a given db_name.
+    """
+    return get_version(GOLDEN_QUERIES_VERSION_NAMESPACE, db_name)
+
+
+def bump_golden_queries_version(db_name: str) -> None:
+    """
+    Should be called whenever golden queries for a given db_name are added,
+    modified or deleted.
+    """
+    bump_version(GOLDEN_QUERIES_VERSION_NAMESPACE, db_name)
+
+
+def get_db_creds_version(db_name: str) -> int | None:
+    """
+    Version of the db type and creds of a given db_name.
+    """
+    return get_version(DB_CREDS_VERSION_NAMESPACE, db_name)
+
+
+def bump_db_creds_version(db_name: str) -> None:
+    """
+    Should be called whenever the db type or creds of a given db_name are
+    modified or deleted.
+    """
+    bump_version(DB_CREDS_VERSION_NAMESPACE, db_name)
+
+
+def get_query_settings_version(db_name: str) -> int | None:
+    """
+    Version of the per-db query settings (row limit, timeout, result cache ttl
+    and preflight config) of a given db_name.
+    """
+    return get_version(QUERY_SETTINGS_VERSION_NAMESPACE, db_name)
+
+
+def bump_query_settings_version(db_name: str) -> None:
+    """
+    Should be called whenever any of the query settings of a given db_name are
+    modified.
+    """
+    bump_version(QUERY_SETTINGS_VERSION_NAMESPACE, db_name)
+
+
+# the query settings of each db_name are read for every query, so they are
+# cached per worker, and invalidated across workers by their version counter.
+# The short ttl bounds how stale they can be if their tables are modified directly.
+QUERY_SETTINGS_CACHE_TTL = float(os.getenv("QUERY_SETTINGS_CACHE_TTL", 30))
+QUERY_SETTINGS_CACHE = LRUCache(max_size=1024, ttl=QUERY_SETTINGS_CACHE_TTL)
+register_cache_stats("query_settings", QUERY_SETTINGS_CACHE.stats)
+
+
+async def get_query_setting(name: str, db_name: str, load: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Get a query setting of a db_name from QUERY_SETTINGS_CACHE, loading it with
+    `load` if it isn't cached or was cached before the settings last changed.
+    It is loaded every time if redis is unavailable, since we then can't tell
+    if the cached setting is stale.
+    """
+    version = get_query_settings_version(db_name)
+    if version is None:
+        return await load()
+    cached = QUERY_SETTINGS_CACHE.get((name, db_name))
+    if cached is None or cached[0] != version:
+        # if the version is bumped while we are loading, the stale setting is
+        # replaced on the next call since its version no longer matches
+        cached = (version, await load())
+        QUERY_SETTINGS_CACHE.set((name, db_name), cached)
+    return cached[1]
+
+
+def invalidate_query_setting(name: str, db_name: str) -> None:
+    """
+    Invalidate a cached query setting of a db_name, in all workers.
+    """
+    QUERY_SETTINGS_CACHE.delete((name, db_name))
+    bump_query_settings_version(db_name)
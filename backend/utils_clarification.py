@@ -1,8 +1,10 @@
 from defog.llm.utils import chat_async
 from utils_logging import LOGGER
-from utils_md import get_metadata, mk_create_ddl
-from utils_instructions import get_instructions
-from request_models import ColumnMetadata
+from utils_md import mk_schema_prompt
+from utils_schema_context import get_schema_context
+from utils_instructions import get_instructions, get_relevant_instructions
+from utils_token_budget import TokenBudget, fit_prompt_to_budget
+from request_models import ColumnMetadata, SchemaFormat
 from pydantic import BaseModel
 from typing import Literal
 import warnings
@@ -23,22 +25,65 @@ async def generate_clarification(
     instructions: str | None = None,
     provider: str = "openai",
     model_name: str = "gpt-4.1",
+    token_budget: TokenBudget = None,
+    schema_format: SchemaFormat = None,
 ) -> str:
     """
     Generate clarification for a given question, using an LLM.
     if db_type, metadata, and instructions are explicitly provided, they are used as is.
     Else, we use the db_name to extract the db_type, metadata, and instructions.
+    Long instructions from the db_name are cut down to the rules relevant to the question.
+    The DDL and instructions are trimmed if the prompt would exceed token_budget.
+    The DDL is rendered in schema_format if given, else in the db_name's schema
+    format (or as DDL if the metadata is provided).
     Returns the generated clarification and the error message if any.
     """
     if metadata is None or len(metadata) == 0:
-        metadata = await get_metadata(db_name)
+        schema_context = await get_schema_context(db_name)
+        metadata = schema_context.metadata
+        table_descriptions = schema_context.table_descriptions
+        schema_token_counts = schema_context.token_counts
+        if not schema_format or schema_format == schema_context.schema_format:
+            metadata_ddl = schema_context.ddl
+            schema_format = schema_context.schema_format
+        else:
+            metadata_ddl = mk_schema_prompt(metadata, table_descriptions, schema_format)
+        if instructions is None:
+            instructions = await get_relevant_instructions(
+                db_name, question, schema_context.instructions
+            )
+    else:
+        table_descriptions = []
+        schema_token_counts = None
+        schema_format = schema_format or "ddl"
+        metadata_ddl = mk_schema_prompt(metadata, table_descriptions, schema_format)
+        if instructions is None:
+            instructions = await get_relevant_instructions(
+                db_name, question, await get_instructions(db_name)
+            )
 
-    if instructions is None:
-        instructions = await get_instructions(db_name)
+    try:
+        budgeted_prompt = await fit_prompt_to_budget(
+            model_name=model_name,
+            question=question,
+            fixed_text=CLARIFY_QUESTION_USER_PROMPT + question,
+            metadata=metadata,
+            table_descriptions=table_descriptions,
+            ddl=metadata_ddl,
+            instructions=instructions,
+            budget=token_budget,
+            db_name=db_name,
+            schema_format=schema_format,
+            token_counts=schema_token_counts,
+        )
+        metadata_ddl = budgeted_prompt.ddl
+        instructions = budgeted_prompt.instructions
+    except Exception as e:
+        LOGGER.warning(f"Error fitting prompt to token budget, using the full prompt: {str(e)}")
 
     user_prompt = CLARIFY_QUESTION_USER_PROMPT.format(
         question=question,
-        table_metadata_ddl=mk_create_ddl(metadata),
+        table_metadata_ddl=metadata_ddl,
         instructions=instructions,
     )
 
@@ -0,0 +1,208 @@
+#################################################
+### Column Embeddings Related Functions Below ###
+#################################################
+
+import asyncio
+import hashlib
+import os
+
+from db_config import engine
+from db_models import ColumnEmbeddings, Metadata, TableInfo
+from pydantic import BaseModel
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from utils_embedding import get_embeddings
+from utils_logging import LOGGER
+from utils_vector_search import search_hnsw_index
+
+# size of the candidate list used by the HNSW index when searching. It is
+# raised to the number of columns requested if that is larger, up to the
+# maximum of 1000 supported by pgvector.
+COLUMN_EMBEDDINGS_EF_SEARCH = int(os.getenv("COLUMN_EMBEDDINGS_EF_SEARCH", 100))
+
+# background refreshes in progress, keyed by db_name. This also keeps a
+# reference to each task so that it isn't garbage collected before it's done.
+COLUMN_EMBEDDINGS_REFRESH_TASKS: dict[str, asyncio.Task] = {}
+# db_names whose schema changed while their refresh was in progress, and so
+# need to be refreshed again once it's done
+COLUMN_EMBEDDINGS_REFRESH_PENDING: set[str] = set()
+
+
+class ColumnSimilarity(BaseModel):
+    table_name: str
+    column_name: str
+    similarity: float
+
+
+def get_column_embedding_text(
+    column: dict[str, str], table_description: str | None
+) -> str:
+    text = f"{column['table_name']}.{column['column_name']} ({column.get('data_type', '')})"
+    if column.get("column_description"):
+        text += f": {column['column_description']}"
+    if table_description:
+        text += f"\nTable description: {table_description}"
+    return text
+
+
+def get_embedding_text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+async def refresh_column_embeddings(db_name: str) -> dict[str, int]:
+    """
+    Bring the column embeddings of a db_name in line with its current metadata
+    and table descriptions. Only columns whose embedding text has changed (or
+    that are new) are re-embedded, and columns that no longer exist are deleted.
+    Errors are logged instead of raised, since the column embeddings are only
+    used to speed up schema selection.
+    Returns the number of columns embedded, unchanged and deleted.
+    """
+    try:
+        async with engine.begin() as conn:
+            metadata = (
+                await conn.execute(
+                    select(
+                        Metadata.table_name,
+                        Metadata.column_name,
+                        Metadata.data_type,
+                        Metadata.column_description,
+                    ).where(Metadata.db_name == db_name)
+                )
+            ).mappings().all()
+            table_descriptions = dict(
+                (
+                    await conn.execute(
+                        select(TableInfo.table_name, TableInfo.table_description).where(
+                            TableInfo.db_name == db_name
+                        )
+                    )
+                ).all()
+            )
+            existing_hashes = {
+                (row[0], row[1]): row[2]
+                for row in (
+                    await conn.execute(
+                        select(
+                            ColumnEmbeddings.table_name,
+                            ColumnEmbeddings.column_name,
+                            ColumnEmbeddings.embedding_text_hash,
+                        ).where(ColumnEmbeddings.db_name == db_name)
+                    )
+                ).all()
+            }
+
+        changed_columns = []
+        current_keys = set()
+        for column in metadata:
+            key = (column["table_name"], column["column_name"])
+            current_keys.add(key)
+            embedding_text = get_column_embedding_text(
+                column, table_descriptions.get(column["table_name"])
+            )
+            text_hash = get_embedding_text_hash(embedding_text)
+            if existing_hashes.get(key) != text_hash:
+                changed_columns.append((key, embedding_text, text_hash))
+        deleted_keys = [key for key in existing_hashes if key not in current_keys]
+
+        embeddings = await get_embeddings([c[1] for c in changed_columns])
+
+        async with engine.begin() as conn:
+            if changed_columns:
+                stmt = insert(ColumnEmbeddings)
+                await conn.execute(
+                    stmt.on_conflict_do_update(
+                        index_elements=["db_name", "table_name", "column_name"],
+                        set_={
+                            "embedding_text_hash": stmt.excluded.embedding_text_hash,
+                            "embedding": stmt.excluded.embedding,
+                        },
+                    ),
+                    [
+                        {
+                            "db_name": db_name,
+                            "table_name": table_name,
+                            "column_name": column_name,
+                            "embedding_text_hash": text_hash,
+                            "embedding": embedding,
+                        }
+                        for ((table_name, column_name), _, text_hash), embedding in zip(
+                            changed_columns, embeddings
+                        )
+                    ],
+                )
+            if deleted_keys:
+                await conn.execute(
+                    delete(ColumnEmbeddings)
+                    .where(ColumnEmbeddings.db_name == db_name)
+                    .where(
+                        tuple_(ColumnEmbeddings.table_name, ColumnEmbeddings.column_name).in_(
+                            deleted_keys
+                        )
+                    )
+                )
+    except Exception as e:
+        LOGGER.error(f"Error refreshing column embeddings for {db_name}: {str(e)}")
+        return {"num_embedded": 0, "num_unchanged": 0, "num_deleted": 0}
+
+    stats = {
+        "num_embedded": len(changed_columns),
+        "num_unchanged": len(current_keys) - len(changed_columns),
+        "num_deleted": len(deleted_keys),
+    }
+    LOGGER.info(f"Refreshed column embeddings for {db_name}: {stats}")
+    return stats
+
+
+async def run_column_embeddings_refresh(db_name: str) -> None:
+    try:
+        while True:
+            COLUMN_EMBEDDINGS_REFRESH_PENDING.discard(db_name)
+            await refresh_column_embeddings(db_name)
+            if db_name not in COLUMN_EMBEDDINGS_REFRESH_PENDING:
+                break
+    except Exception as e:
+        LOGGER.error(f"Error in background refresh of column embeddings for {db_name}: {str(e)}")
+    finally:
+        COLUMN_EMBEDDINGS_REFRESH_TASKS.pop(db_name, None)
+
+
+def schedule_column_embeddings_refresh(db_name: str) -> asyncio.Task:
+    """
+    Refresh the column embeddings of a db_name in a background task, so that
+    requests that change its schema don't wait for the columns to be embedded.
+    If a refresh is already in progress for the db_name, another one is run
+    once it's done instead of running both at once.
+    Returns the task doing the refresh.
+    """
+    task = COLUMN_EMBEDDINGS_REFRESH_TASKS.get(db_name)
+    if task is not None and not task.done():
+        COLUMN_EMBEDDINGS_REFRESH_PENDING.add(db_name)
+        return task
+    task = asyncio.create_task(run_column_embeddings_refresh(db_name))
+    COLUMN_EMBEDDINGS_REFRESH_TASKS[db_name] = task
+    return task
+
+
+async def get_closest_columns(
+    db_name: str, question_embedding: list[float], num_columns: int = 100
+) -> list[ColumnSimilarity]:
+    """
+    Get the num_columns columns of a db_name that are most similar to the
+    question, using the HNSW index on the column embeddings.
+    """
+    distance = ColumnEmbeddings.embedding.cosine_distance(question_embedding)
+    async with engine.begin() as conn:
+        rows = await search_hnsw_index(
+            conn,
+            select(ColumnEmbeddings.table_name, ColumnEmbeddings.column_name, distance)
+            .where(ColumnEmbeddings.db_name == db_name)
+            .order_by(distance)
+            .limit(num_columns),
+            limit=num_columns,
+            ef_search=COLUMN_EMBEDDINGS_EF_SEARCH,
+        )
+        return [
+            ColumnSimilarity(table_name=row[0], column_name=row[1], similarity=1 - row[2])
+            for row in rows
+        ]
@@ -0,0 +1,575 @@
+###############################################
+### Connection Pool Related Functions Below ###
+###############################################
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import time
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import Any, AsyncIterator
+
+from defog.query import async_execute_query_once
+from utils_cache import register_cache_stats
+from utils_logging import LOGGER
+
+# max number of connections in the pool of each set of db creds (per worker)
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 5))
+# pools (and pooled connections) that haven't been used for this many seconds are closed
+DB_POOL_IDLE_TIMEOUT = float(os.getenv("DB_POOL_IDLE_TIMEOUT", 300))
+# idle pools are also closed by a background sweep every this many seconds, so
+# that they don't stay open when no more queries come in
+DB_POOL_SWEEP_INTERVAL = float(os.getenv("DB_POOL_SWEEP_INTERVAL", 60))
+# pools that haven't been used for this many seconds are checked with a
+# trivial query before they are used again, and recreated if that fails
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", 30))
+# max seconds spent cancelling a query on the database, when its task is cancelled
+DB_CANCEL_TIMEOUT = 10
+
+# db types that we keep a pool for. Queries to other db types (whose drivers
+# are synchronous) open a new connection each time with `async_execute_query_once`.
+POOLED_DB_TYPES = {"postgres", "redshift", "mysql", "sqlserver", "bigquery"}
+
+POOL_STATS = {
+    "created": 0,
+    "reused": 0,
+    "closed_idle": 0,
+    "invalidated": 0,
+    "health_check_failures": 0,
+    "connection_errors": 0,
+}
+
+
+@dataclass
+class PoolEntry:
+    """
+    A pool of connections for one set of db creds, along with when it was
+    last used and checked. For bigquery, `pool` is a client, since the client
+    manages its own connections.
+    `closing` pools have been discarded, and are closed once the queries using
+    them are done. `invalidated` pools were discarded because their creds were
+    changed or deleted, so their queries are not retried.
+    """
+
+    db_type: str
+    pool: Any
+    loop: asyncio.AbstractEventLoop
+    last_used: float
+    last_checked: float
+    in_use: int = 0
+    closing: bool = False
+    invalidated: bool = False
+
+
+# pools keyed by the hash of their db type and creds
+POOLS: dict[str, PoolEntry] = {}
+POOL_LOCKS: dict[str, asyncio.Lock] = {}
+
+
+def get_pool_stats() -> dict[str, Any]:
+    return {
+        **POOL_STATS,
+        "open_pools": len(POOLS),
+        "in_use": sum(entry.in_use for entry in POOLS.values()),
+    }
+
+
+register_cache_stats("db_connection_pools", get_pool_stats)
+
+
+class QueryTimeoutError(Exception):
+    """
+    Raised when a query on the user's database runs for longer than its
+    timeout (see utils_query_results.get_query_timeout).
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        super().__init__(f"Query timed out after {timeout:g} seconds")
+
+
+def get_creds_key(db_type: str, db_creds: dict[str, Any]) -> str:
+    """
+    Hash of the db type and creds, so that the creds themselves are never used
+    as (or logged with) a key, and pools are replaced whenever the creds change.
+    """
+    key_inputs = json.dumps(
+        {"db_type": db_type, "db_creds": db_creds}, sort_keys=True, default=str
+    )
+    return hashlib.sha256(key_inputs.encode("utf-8")).hexdigest()
+
+
+def get_sqlserver_dsn(db_creds: dict[str, Any]) -> str:
+    # same connection string as async_execute_query_once
+    dsn = f"DRIVER={{ODBC Driver 18 for SQL Server}};SERVER={db_creds['server']};"
+    if db_creds.get("database"):
+        dsn += f"DATABASE={db_creds['database']};"
+    return dsn + f"UID={db_creds['user']};PWD={db_creds['password']};TrustServerCertificate=yes;Connection Timeout=120;"
+
+
+async def create_pool(db_type: str, db_creds: dict[str, Any]) -> Any:
+    if db_type in ("postgres", "redshift"):
+        import asyncpg
+
+        conn_args = dict(db_creds)
+        schema = conn_args.pop("schema", None) if db_type == "redshift" else None
+
+        async def setup(conn):
+            # connections are reset when they are returned to the pool
+            await conn.execute(f"SET search_path TO {schema}")
+
+        return await asyncpg.create_pool(
+            **conn_args,
+            min_size=1,
+            max_size=DB_POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=DB_POOL_IDLE_TIMEOUT,
+            setup=setup if schema and schema != "public" else None,
+        )
+    elif db_type == "mysql":
+        import aiomysql
+
+        conn_args = dict(db_creds)
+        conn_args["db"] = conn_args.pop("database", None)
+        # autocommit, so that reused connections don't read from a stale snapshot
+        return await aiomysql.create_pool(
+            **conn_args,
+            minsize=1,
+            maxsize=DB_POOL_MAX_SIZE,
+            pool_recycle=DB_POOL_IDLE_TIMEOUT,
+            autocommit=True,
+        )
+    elif db_type == "sqlserver":
+        import aioodbc
+
+        return await aioodbc.create_pool(
+            dsn=get_sqlserver_dsn(db_creds),
+            minsize=1,
+            maxsize=DB_POOL_MAX_SIZE,
+            pool_recycle=DB_POOL_IDLE_TIMEOUT,
+            autocommit=True,
+        )
+    elif db_type == "bigquery":
+        from google.cloud import bigquery
+
+        return await asyncio.to_thread(
+            bigquery.Client.from_service_account_json, db_creds["json_key_path"]
+        )
+    raise ValueError(f"Database type {db_type} is not pooled")
+
+
+async def close_pool(entry: PoolEntry):
+    try:
+        if entry.db_type in ("postgres", "redshift"):
+            await entry.pool.close()
+        elif entry.db_type in ("mysql", "sqlserver"):
+            entry.pool.close()
+            await entry.pool.wait_closed()
+        elif entry.db_type == "bigquery":
+            await asyncio.to_thread(entry.pool.close)
+    except Exception as e:
+        LOGGER.warning(f"Error closing {entry.db_type} connection pool: {str(e)}")
+
+
+async def run_query(entry: PoolEntry, query: str) -> tuple[list[str], list[list[Any]]]:
+    """
+    Run a query on a connection from the pool, and return the column names and rows.
+    """
+    if entry.db_type in ("postgres", "redshift"):
+        async with entry.pool.acquire() as conn:
+            results = await conn.fetch(query)
+        colnames = list(results[0].keys()) if results else []
+        if entry.db_type == "redshift":
+            # deduplicate the column names, like async_execute_query_once
+            colnames = [
+                f"{col}_{i}" if colnames.count(col) > 1 else col
+                for i, col in enumerate(colnames)
+            ]
+        return colnames, [list(row.values()) for row in results]
+    elif entry.db_type in ("mysql", "sqlserver"):
+        async with entry.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query)
+                colnames = [desc[0] for desc in cur.description]
+                rows = await cur.fetchall()
+        return colnames, [list(row) for row in rows]
+    elif entry.db_type == "bigquery":
+        query_job = await asyncio.to_thread(entry.pool.query, query)
+        results = await asyncio.to_thread(query_job.result)
+        colnames = [field.name for field in results.schema]
+        return colnames, [list(row.values()) for row in results]
+    raise ValueError(f"Database type {entry.db_type} is not pooled")
+
+
+def is_connection_error(e: Exception) -> bool:
+    """
+    Whether an error means that the connection (rather than the query) is bad,
+    in which case the pool is recreated and the query retried once.
+    """
+    if isinstance(e, (ConnectionError, OSError, asyncio.TimeoutError)):
+        return True
+    # matched by name, since the drivers are optional
+    error_types = {cls.__name__ for cls in type(e).__mro__}
+    if error_types & {"ConnectionDoesNotExistError", "PostgresConnectionError", "InterfaceError"}:
+        return True
+    # mysql's "server has gone away" and "lost connection" errors
+    if type(e).__name__ == "OperationalError" and e.args and e.args[0] in (2006, 2013):
+        return True
+    return False
+
+
+def is_timeout_error(e: Exception) -> bool:
+    """
+    Whether an error means that the database stopped the query because it
+    ran for longer than the timeout passed to `run_query_in_chunks`.
+    """
+    # postgres/redshift's "canceling statement due to statement timeout"
+    if type(e).__name__ == "QueryCanceledError":
+        return True
+    # mysql's "maximum statement execution time exceeded", and sql server's
+    # "query timeout expired"
+    return bool(e.args) and e.args[0] in (3024, "HYT00")
+
+
+async def evict_idle_pools():
+    """
+    Close the pools that haven't been used for DB_POOL_IDLE_TIMEOUT seconds.
+    """
+    now = time.monotonic()
+    for key, entry in list(POOLS.items()):
+        if entry.in_use == 0 and now - entry.last_used > DB_POOL_IDLE_TIMEOUT:
+            POOL_STATS["closed_idle"] += 1
+            await discard_pool(key, entry)
+
+
+async def sweep_idle_pools():
+    """
+    Close idle pools every DB_POOL_SWEEP_INTERVAL seconds, until cancelled.
+    This runs in the background for the lifetime of the app (see startup.py).
+    """
+    while True:
+        await asyncio.sleep(DB_POOL_SWEEP_INTERVAL)
+        try:
+            await evict_idle_pools()
+        except Exception as e:
+            LOGGER.warning(f"Error closing idle connection pools: {str(e)}")
+
+
+def drop_pool_lock(key: str):
+    """
+    Drop the lock of a key that no longer has a pool, unless a pool is being
+    created for it. Tasks still waiting for the dropped lock notice that it
+    was dropped in `get_pool`.
+    """
+    lock = POOL_LOCKS.get(key)
+    if lock is not None and not lock.locked() and key not in POOLS:
+        POOL_LOCKS.pop(key)
+
+
+async def discard_pool(key: str, entry: PoolEntry):
+    """
+    Stop handing out a pool, and close it once the queries using it are done
+    (see `release_pool`), so that they aren't cut off.
+    """
+    if POOLS.get(key) is entry:
+        POOLS.pop(key)
+    drop_pool_lock(key)
+    if entry.closing:
+        return
+    entry.closing = True
+    if entry.in_use == 0:
+        await close_pool(entry)
+
+
+async def release_pool(entry: PoolEntry):
+    """
+    Mark a query using a pool as done, closing the pool if it was discarded
+    and this was its last query.
+    """
+    entry.in_use -= 1
+    entry.last_used = time.monotonic()
+    if entry.closing and entry.in_use == 0:
+        await close_pool(entry)
+
+
+async def get_pool(db_type: str, db_creds: dict[str, Any]) -> tuple[str, PoolEntry]:
+    """
+    Get the pool for a set of db creds, creating it if needed. Pools that have
+    been idle for a while are health checked first.
+    """
+    key = get_creds_key(db_type, db_creds)
+    loop = asyncio.get_running_loop()
+    while True:
+        lock = POOL_LOCKS.setdefault(key, asyncio.Lock())
+        async with lock:
+            # the lock was dropped (along with its pool) while we waited for it
+            if POOL_LOCKS.get(key) is not lock:
+                continue
+            return key, await get_or_create_pool(key, db_type, db_creds, loop)
+
+
+async def get_or_create_pool(
+    key: str, db_type: str, db_creds: dict[str, Any], loop: asyncio.AbstractEventLoop
+) -> PoolEntry:
+    """
+    The body of `get_pool`, which must be called with the key's lock held.
+    """
+    entry = POOLS.get(key)
+    now = time.monotonic()
+    if entry is not None and entry.loop is not loop:
+        # pools can't be shared across event loops (e.g. in scripts and tests)
+        POOLS.pop(key)
+        entry = None
+    if entry is not None and entry.db_type != "bigquery":
+        if now - entry.last_checked > DB_POOL_HEALTH_CHECK_INTERVAL:
+            try:
+                await run_query(entry, "SELECT 1")
+                entry.last_checked = now
+            except Exception as e:
+                LOGGER.warning(f"Health check of {db_type} connection pool failed, recreating it: {str(e)}")
+                POOL_STATS["health_check_failures"] += 1
+                await discard_pool(key, entry)
+                entry = None
+    if entry is None:
+        entry = PoolEntry(
+            db_type=db_type,
+            pool=await create_pool(db_type, db_creds),
+            loop=loop,
+            last_used=now,
+            last_checked=now,
+        )
+        POOLS[key] = entry
+        POOL_STATS["created"] += 1
+    else:
+        POOL_STATS["reused"] += 1
+    entry.last_used = now
+    return entry
+
+
+async def execute_query(
+    db_type: str, db_creds: dict[str, Any], query: str
+) -> tuple[list[str], list[list[Any]]]:
+    """
+    Drop-in replacement for `async_execute_query_once` that reuses a pool of
+    connections per set of db creds (for the db types in POOLED_DB_TYPES), so
+    that we only pay for the connection handshake once.
+    If the query fails because the connection is bad, the pool is recreated
+    and the query is retried once.
+    Returns the column names and rows.
+    """
+    if db_type not in POOLED_DB_TYPES:
+        return await async_execute_query_once(db_type, db_creds, query)
+
+    await evict_idle_pools()
+    for attempt in range(2):
+        key, entry = await get_pool(db_type, db_creds)
+        entry.in_use += 1
+        try:
+            return await run_query(entry, query)
+        except Exception as e:
+            # queries on invalidated pools fail because the pool was closed,
+            # and shouldn't be retried with the old creds
+            if attempt > 0 or entry.invalidated or not is_connection_error(e):
+                raise
+            LOGGER.warning(f"Connection error on {db_type} connection pool, recreating it: {str(e)}")
+            POOL_STATS["connection_errors"] += 1
+            await discard_pool(key, entry)
+        finally:
+            await release_pool(entry)
+
+
+async def set_connection_timeout(entry: PoolEntry, conn: Any, timeout: float | None):
+    """
+    Set the timeout of the next query on a pooled mysql or sql server
+    connection, natively so that the database stops the query itself. It is
+    set (or reset) every time, since connections are reused across queries.
+    """
+    if entry.db_type == "mysql":
+        # MAX_EXECUTION_TIME only exists in mysql 5.7.8+ (and not in mariadb)
+        value = math.ceil(timeout * 1000) if timeout else "DEFAULT"
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(f"SET SESSION MAX_EXECUTION_TIME = {value}")
+        except Exception as e:
+            LOGGER.debug(f"Could not set the mysql query timeout: {str(e)}")
+    elif entry.db_type == "sqlserver":
+        # the pyodbc query timeout, in whole seconds (0 means no timeout)
+        conn._conn.timeout = math.ceil(timeout) if timeout else 0
+
+
+async def kill_mysql_query(entry: PoolEntry, thread_id: int):
+    # from another connection, since the query's connection is busy with it
+    async with entry.pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(f"KILL QUERY {thread_id}")
+
+
+async def cancel_query(entry: PoolEntry, cancel: Any):
+    """
+    Cancel a query on the database when the task running it is cancelled, so
+    that it doesn't keep running on the database. Errors are only logged, so
+    that the cancellation still propagates.
+    """
+    try:
+        await asyncio.wait_for(cancel, DB_CANCEL_TIMEOUT)
+    except Exception as e:
+        LOGGER.warning(f"Could not cancel {entry.db_type} query: {str(e)}")
+
+
+async def run_query_in_chunks(
+    entry: PoolEntry, query: str, chunk_size: int, timeout: float | None = None
+) -> AsyncIterator[tuple[list[str], list[list[Any]]]]:
+    """
+    Run a query on a connection from the pool with a server-side cursor, and
+    yield the column names and the rows, chunk_size rows at a time.
+    The first chunk is always yielded, even if it is empty.
+    The database stops the query if it runs for longer than timeout seconds,
+    and the query is cancelled if the task running it is cancelled.
+    """
+    if entry.db_type in ("postgres", "redshift"):
+        async with entry.pool.acquire() as conn:
+            # cursors only exist within a transaction
+            async with conn.transaction():
+                # SET LOCAL only lasts until the end of the transaction.
+                # asyncpg cancels the query itself if the task is cancelled.
+                if timeout:
+                    await conn.execute(f"SET LOCAL statement_timeout = {math.ceil(timeout * 1000)}")
+                statement = await conn.prepare(query)
+                colnames = [attribute.name for attribute in statement.get_attributes()]
+                if entry.db_type == "redshift":
+                    colnames = [
+                        f"{col}_{i}" if colnames.count(col) > 1 else col
+                        for i, col in enumerate(colnames)
+                    ]
+                cursor = await statement.cursor()
+                rows = await cursor.fetch(chunk_size)
+                yield colnames, [list(row.values()) for row in rows]
+                while len(rows) == chunk_size:
+                    rows = await cursor.fetch(chunk_size)
+                    if rows:
+                        yield colnames, [list(row.values()) for row in rows]
+    elif entry.db_type in ("mysql", "sqlserver"):
+        cursor_args = []
+        if entry.db_type == "mysql":
+            import aiomysql
+
+            # unbuffered, so that rows are read from the server as they are fetched.
+            # Closing it early still reads (and discards) the remaining rows.
+            cursor_args.append(aiomysql.SSCursor)
+        async with entry.pool.acquire() as conn:
+            await set_connection_timeout(entry, conn, timeout)
+            cur = await conn.cursor(*cursor_args)
+            try:
+                await cur.execute(query)
+                colnames = [desc[0] for desc in cur.description]
+                rows = await cur.fetchmany(chunk_size)
+                yield colnames, [list(row) for row in rows]
+                while len(rows) == chunk_size:
+                    rows = await cur.fetchmany(chunk_size)
+                    if rows:
+                        yield colnames, [list(row) for row in rows]
+            except asyncio.CancelledError:
+                if entry.db_type == "mysql":
+                    await cancel_query(entry, kill_mysql_query(entry, conn.thread_id()))
+                    # close the connection rather than reading the rest of the
+                    # results of the killed query, so that the pool discards it
+                    conn.close()
+                else:
+                    # pyodbc cursors can be cancelled from another thread
+                    await cancel_query(entry, asyncio.to_thread(cur._impl.cancel))
+                raise
+            finally:
+                if not conn.closed:
+                    await cur.close()
+    elif entry.db_type == "bigquery":
+        from google.cloud import bigquery
+
+        job_config = bigquery.QueryJobConfig(job_timeout_ms=math.ceil(timeout * 1000) if timeout else None)
+        query_job = await asyncio.to_thread(entry.pool.query, query, job_config=job_config)
+        try:
+            try:
+                results = await asyncio.to_thread(query_job.result, page_size=chunk_size, timeout=timeout)
+            except TimeoutError as e:
+                # the job itself is stopped by bigquery after job_timeout_ms
+                raise QueryTimeoutError(timeout) from e
+            colnames = [field.name for field in results.schema]
+            pages = results.pages
+            page = await asyncio.to_thread(next, pages, None)
+            yield colnames, [list(row.values()) for row in page or []]
+            while page is not None:
+                page = await asyncio.to_thread(next, pages, None)
+                if page is not None:
+                    yield colnames, [list(row.values()) for row in page]
+        except asyncio.CancelledError:
+            await cancel_query(entry, asyncio.to_thread(query_job.cancel))
+            raise
+    else:
+        raise ValueError(f"Database type {entry.db_type} is not pooled")
+
+
+async def stream_query(
+    db_type: str,
+    db_creds: dict[str, Any],
+    query: str,
+    chunk_size: int,
+    timeout: float | None = None,
+) -> AsyncIterator[tuple[list[str], list[list[Any]]]]:
+    """
+    Like `execute_query`, but yields the column names and the rows in chunks of
+    chunk_size rows, fetched with a server-side cursor, so that only one chunk
+    needs to be in memory at a time. The first chunk is always yielded, even
+    if it is empty. Db types that aren't pooled are fetched in full and then
+    chunked.
+    Pooled db types stop the query on the database once it has run for timeout
+    seconds, and raise a QueryTimeoutError. Other db types only time out with
+    the deadline of `utils_query_results.fetch_query_results`.
+    Use with `contextlib.aclosing` when not consuming all the chunks, so that
+    the connection is returned to the pool straight away.
+    """
+    if db_type not in POOLED_DB_TYPES:
+        colnames, rows = await async_execute_query_once(db_type, db_creds, query)
+        yield colnames, rows[:chunk_size]
+        for i in range(chunk_size, len(rows), chunk_size):
+            yield colnames, rows[i : i + chunk_size]
+        return
+
+    await evict_idle_pools()
+    for attempt in range(2):
+        key, entry = await get_pool(db_type, db_creds)
+        entry.in_use += 1
+        started = False
+        try:
+            async with aclosing(run_query_in_chunks(entry, query, chunk_size, timeout)) as chunks:
+                async for chunk in chunks:
+                    started = True
+                    yield chunk
+            return
+        except Exception as e:
+            if timeout and is_timeout_error(e):
+                raise QueryTimeoutError(timeout) from e
+            # only retry if nothing has been yielded yet
+            if started or attempt > 0 or entry.invalidated or not is_connection_error(e):
+                raise
+            LOGGER.warning(f"Connection error on {db_type} connection pool, recreating it: {str(e)}")
+            POOL_STATS["connection_errors"] += 1
+            await discard_pool(key, entry)
+        finally:
+            await release_pool(entry)
+
+
+async def invalidate_pools(db_type: str, db_creds: dict[str, Any]):
+    """
+    Close the pool for a set of db creds, e.g. when they are changed or deleted.
+    Queries already running on it are allowed to finish first, and are not
+    retried if they fail.
+    Other workers close their pool for the old creds once it is idle, since
+    pools are keyed by the creds.
+    """
+    key = get_creds_key(db_type, db_creds)
+    entry = POOLS.get(key)
+    if entry is not None:
+        POOL_STATS["invalidated"] += 1
+        entry.invalidated = True
+        await discard_pool(key, entry)
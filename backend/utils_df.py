@@ -1,6 +1,9 @@
 # helper functions for dataframes
+import re
 from typing import List, Tuple
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 from utils_logging import LOGGER
 
@@ -12,6 +15,13 @@ TYPE_INTEGER = "int64"
 TYPE_FLOAT = "float64"
 TYPE_MONEY = "money"
 
+# number of most frequent values listed per column in summarize_df
+SUMMARY_TOP_N = 10
+# the time buckets of rollups in summarize_df: the first bucket whose min span
+# (in days) is at most the span of the date column is used
+SUMMARY_TIME_BUCKETS = [(3 * 365, "Y"), (90, "M"), (3, "D"), (0, "h")]
+SUMMARY_PERIOD_NAMES = {"Y": "year", "M": "month", "D": "day", "h": "hour"}
+
 REGEX_DATE_PATTERN = r"^\d{4}-\d{2}-\d{2}$"
 REGEX_TIME_PATTERN = r"^\d{2}:\d{2}:\d{2}$"
 REGEX_DATETIME_PATTERN = r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$"
@@ -20,36 +30,60 @@ REGEX_FLOAT_PATTERN = r"^\d+(\.\d+)?$"
 REGEX_MONEY_PATTERN = r"^\$?\d{1,3}(,?\d{3})*(\.\d{2})?$"
 
 
+# the patterns of each type, in order of priority: a column has the first type
+# whose pattern all of its values match
+TYPE_PATTERNS = {
+    TYPE_DATE: REGEX_DATE_PATTERN,
+    TYPE_TIME: REGEX_TIME_PATTERN,
+    TYPE_DATETIME: REGEX_DATETIME_PATTERN,
+    TYPE_INTEGER: REGEX_INTEGER_PATTERN,
+    TYPE_FLOAT: REGEX_FLOAT_PATTERN,
+    TYPE_MONEY: REGEX_MONEY_PATTERN,
+}
+# matches all the type patterns at once, with an optional lookahead per type
+# that captures the value into a group named after the type if it matches
+REGEX_TYPES_PATTERN = "^" + "".join(
+    f"(?=(?P<{format_type}>{re.sub(r'[(](?![?])', '(?:', pattern[1:])}))?"
+    for format_type, pattern in TYPE_PATTERNS.items()
+)
+# number of values that the type of an object column is guessed from, before
+# checking that guess against the whole column
+TYPE_DETECTION_SAMPLE_SIZE = 1000
+
+
+def classify_strings(strings: pd.Series) -> str:
+    """
+    Get the first type (in order of priority) whose pattern all the strings
+    match, with a single regex pass over the strings.
+    """
+    matches = strings.str.extract(REGEX_TYPES_PATTERN).notna().all()
+    for format_type in TYPE_PATTERNS:
+        if matches[format_type]:
+            return format_type
+    return TYPE_STRING
+
+
 def determine_column_type(column: pd.Series) -> str:
     """
     Determines the type of the column based on the data.
     We get the "lowest common denominator" type of the column. i.e. if the column
     has a mix of dates and normal text, we return 'string'.
+    The type of object columns is guessed from a sample of their values, and then
+    only that type is checked against the whole column.
     """
     if column.dtype == "object":
-        # Check if it's a date, time, or datetime column
-        date_matches = column.astype(str).str.match(REGEX_DATE_PATTERN)
-        if date_matches.all():
-            return TYPE_DATE
-        time_matches = column.astype(str).str.match(REGEX_TIME_PATTERN)
-        if time_matches.all():
-            return TYPE_TIME
-        datetime_matches = column.astype(str).str.match(REGEX_DATETIME_PATTERN)
-        if datetime_matches.all():
-            return TYPE_DATETIME
-        # Check if it's an integer column
-        integer_matches = column.astype(str).str.match(REGEX_INTEGER_PATTERN)
-        if integer_matches.all():
-            return TYPE_INTEGER
-        # Check if it's a float column
-        float_matches = column.astype(str).str.match(REGEX_FLOAT_PATTERN)
-        if float_matches.all():
-            return TYPE_FLOAT
-        # Check if it's a money column
-        money_matches = column.astype(str).str.match(REGEX_MONEY_PATTERN)
-        if money_matches.all():
-            return TYPE_MONEY
-        return TYPE_STRING
+        strings = column.astype(str)
+        format_type = classify_strings(strings.iloc[:TYPE_DETECTION_SAMPLE_SIZE])
+        # the types before the guessed one don't match the sample, so they can't
+        # match the whole column either. Neither can any type if none match the sample.
+        if len(strings) <= TYPE_DETECTION_SAMPLE_SIZE or format_type == TYPE_STRING:
+            return format_type
+        # checked with arrow's regex engine, which is much faster than python's on long columns
+        matches = pc.match_substring_regex(pa.array(strings, type=pa.string()), TYPE_PATTERNS[format_type])
+        if pc.all(matches).as_py():
+            return format_type
+        # the sample wasn't representative of the whole column
+        return classify_strings(strings)
     elif column.dtype == "int64":
         return TYPE_INTEGER
     elif column.dtype == "float64":
@@ -60,36 +94,76 @@ def determine_column_type(column: pd.Series) -> str:
         return TYPE_STRING
 
 
+def convert_column_type(column: pd.Series) -> pd.Series:
+    """
+    Convert a column to the type determined by determine_column_type.
+    """
+    format_type = determine_column_type(column.dropna())
+
+    if format_type == TYPE_DATETIME:
+        return pd.to_datetime(column, errors="coerce")
+    elif format_type == TYPE_DATE:
+        return pd.to_datetime(column, errors="coerce")
+    elif format_type == TYPE_TIME:
+        # note that the .dt.time accessor coerces the type to 'object'
+        return pd.to_datetime(column, format="%H:%M:%S", errors="coerce").dt.time
+    elif format_type == TYPE_INTEGER:
+        try:
+            return pd.to_numeric(column, errors="coerce").astype("int64")
+        except:
+            return column
+    elif format_type == TYPE_FLOAT:
+        return pd.to_numeric(column, errors="coerce").astype("float64")
+    elif format_type == TYPE_MONEY:
+        # Convert money strings to float by removing currency symbols and commas
+        column = column.astype(str).str.replace(r'[^\d.-]', '', regex=True)
+        return pd.to_numeric(column, errors="coerce").astype("float64")
+    return column
+
+
 def mk_df(data: List, columns: List[str]) -> pd.DataFrame:
     """
     Make a dataframe from a list of lists, with the appropriate column data types.
     """
     df = pd.DataFrame(data, columns=columns)
 
-    for col in df.columns:
-        column_non_null = df[col].dropna()
-        format_type = determine_column_type(column_non_null)
-
-        if format_type == TYPE_DATETIME:
-            df[col] = pd.to_datetime(df[col], errors="coerce")
-        elif format_type == TYPE_DATE:
-            df[col] = pd.to_datetime(df[col], errors="coerce")
-        elif format_type == TYPE_TIME:
-            # note that the .dt.time accessor coerces the type to 'object'
-            df[col] = pd.to_datetime(
-                df[col], format="%H:%M:%S", errors="coerce"
-            ).dt.time
-        elif format_type == TYPE_INTEGER:
-            try:
-                df[col] = pd.to_numeric(df[col], errors="coerce").astype("int64")
-            except:
-                pass
-        elif format_type == TYPE_FLOAT:
-            df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
-        elif format_type == TYPE_MONEY:
-            # Convert money strings to float by removing currency symbols and commas
-            df[col] = df[col].astype(str).str.replace(r'[^\d.-]', '', regex=True)
-            df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+    for i in range(df.shape[1]):
+        df.isetitem(i, convert_column_type(df.iloc[:, i]))
+
+    return df
+
+
+def arrow_to_df(table: pa.Table) -> pd.DataFrame:
+    """
+    Convert an arrow table into a dataframe. Numeric columns without nulls are
+    converted without copying where possible, dates become datetime64 columns
+    (like in mk_df), and nested values (e.g. lists) are kept as python objects.
+    """
+    nested_columns = {
+        i: table.column(i).to_pylist()
+        for i, field in enumerate(table.schema)
+        if pa.types.is_nested(field.type)
+    }
+    df = table.to_pandas(
+        date_as_object=False,
+        coerce_temporal_nanoseconds=True,
+        split_blocks=True,
+    )
+    for i, values in nested_columns.items():
+        df.isetitem(i, pd.Series(values, index=df.index, dtype=object))
+    return df
+
+
+def mk_df_from_arrow(table: pa.Table) -> pd.DataFrame:
+    """
+    Like mk_df, but from an arrow table. Only the string columns need their
+    types to be determined, since the other columns are already typed.
+    """
+    df = arrow_to_df(table)
+
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            df.isetitem(i, convert_column_type(df.iloc[:, i]))
 
     return df
 
@@ -122,3 +196,57 @@ def get_columns_summary(df: pd.DataFrame) -> Tuple[str, str, str]:
     else:
         date_columns_summary = ""
     return numeric_columns_summary, non_numeric_columns_summary, date_columns_summary
+
+
+def get_time_bucket(column: pd.Series) -> str:
+    """
+    Get the period (year, month, day or hour) to bucket a date column by in
+    rollups, so that there are a reasonable number of buckets.
+    """
+    span_days = (column.max() - column.min()) / pd.Timedelta(days=1)
+    for min_span_days, period in SUMMARY_TIME_BUCKETS:
+        if span_days >= min_span_days:
+            return period
+    return SUMMARY_TIME_BUCKETS[-1][1]
+
+
+def summarize_df(df: pd.DataFrame, top_n: int = SUMMARY_TOP_N) -> str:
+    """
+    Summarize a dataframe that has too many rows to be shown in full, like
+    get_columns_summary: statistics of the numeric columns, the top_n most
+    frequent values of the other columns, and rollups of each date column
+    (the number of rows, and the sums of the numeric columns, per time bucket).
+    Returns the sections as CSV, with a heading each.
+    """
+    numeric_columns = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col])]
+    date_columns = [col for col in df.columns if pd.api.types.is_datetime64_any_dtype(df[col])]
+    other_columns = [col for col in df.columns if col not in numeric_columns and col not in date_columns]
+
+    sections = [f"Summary of {len(df)} rows"]
+    if numeric_columns:
+        # the statistic names (e.g. count, mean, etc) are in the index
+        summary = df[numeric_columns].describe().to_csv(index=True, float_format="%.2f")
+        sections.append(f"Numeric columns:\n{summary}")
+    for col in other_columns:
+        values = df[col].astype(str).where(df[col].notna())
+        counts = values.value_counts().head(top_n).rename("count")
+        sections.append(
+            f"Column {col} ({values.nunique()} distinct values), most frequent values:\n"
+            + counts.to_csv(index=True)
+        )
+    for col in date_columns:
+        dates = df[col].dropna()
+        if dates.empty:
+            continue
+        if dates.dt.tz is not None:
+            dates = dates.dt.tz_localize(None)
+        period = get_time_bucket(dates)
+        groups = df.loc[dates.index].groupby(dates.dt.to_period(period))
+        rollup = groups.size().rename("row_count").to_frame()
+        if numeric_columns:
+            rollup = rollup.join(groups[numeric_columns].sum().add_prefix("sum_"))
+        sections.append(
+            f"Rollup by {col} (per {SUMMARY_PERIOD_NAMES[period]}):\n"
+            + rollup.to_csv(index=True, float_format="%.2f")
+        )
+    return "\n".join(sections)
@@ -1,7 +1,153 @@
+import asyncio
+import hashlib
+import os
+import struct
+
+import redis
+from db_config import redis_client_binary
 from openai import AsyncOpenAI
+from utils_cache import LRUCache, register_cache_stats
+from utils_logging import LOGGER
 
 client_openai = AsyncOpenAI()
 
+# Embeddings are cached in 2 tiers: an in-process LRU cache, and redis (which
+# is shared across workers). Both store the embedding as packed float32s.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 7 * 24 * 60 * 60))
+EMBEDDING_CACHE = LRUCache(max_size=EMBEDDING_CACHE_SIZE)
+EMBEDDING_REDIS_STATS = {"hits": 0, "misses": 0, "errors": 0}
+# the embeddings API accepts at most 2048 inputs per request
+EMBEDDING_BATCH_SIZE = 1000
+
+
+def get_embedding_cache_stats() -> dict[str, float]:
+    redis_total = EMBEDDING_REDIS_STATS["hits"] + EMBEDDING_REDIS_STATS["misses"]
+    return {
+        "local": EMBEDDING_CACHE.stats(),
+        "redis": {
+            **EMBEDDING_REDIS_STATS,
+            "hit_rate": EMBEDDING_REDIS_STATS["hits"] / redis_total if redis_total else 0.0,
+        },
+    }
+
+
+register_cache_stats("embedding", get_embedding_cache_stats)
+
+
+def normalize_embedding_text(text: str) -> str:
+    """
+    Collapse all runs of whitespace into a single space, so that trivial
+    differences in formatting don't result in cache misses.
+    """
+    return " ".join(text.split())
+
+
+def get_embedding_cache_key(text: str, model: str, dimensions: int) -> str:
+    text_hash = hashlib.sha256(normalize_embedding_text(text).encode("utf-8")).hexdigest()
+    return f"embedding:{model}:{dimensions}:{text_hash}"
+
+
+def pack_embedding(embedding: list[float]) -> bytes:
+    return struct.pack(f"<{len(embedding)}f", *embedding)
+
+
+def unpack_embedding(packed: bytes) -> list[float]:
+    return list(struct.unpack(f"<{len(packed) // 4}f", packed))
+
+
+def get_cached_embeddings(keys: list[str]) -> list[bytes | None]:
+    """
+    Look up packed embeddings in the local cache first, then in redis.
+    Embeddings found in redis are copied into the local cache.
+    """
+    packed_embeddings = [EMBEDDING_CACHE.get(key) for key in keys]
+    missing_idx = [i for i, packed in enumerate(packed_embeddings) if packed is None]
+    if not missing_idx:
+        return packed_embeddings
+    try:
+        redis_values = redis_client_binary.mget([keys[i] for i in missing_idx])
+    except redis.RedisError as e:
+        LOGGER.warning(f"Could not read embeddings from redis: {e}")
+        EMBEDDING_REDIS_STATS["errors"] += 1
+        return packed_embeddings
+    for i, packed in zip(missing_idx, redis_values):
+        if packed is None:
+            EMBEDDING_REDIS_STATS["misses"] += 1
+            continue
+        EMBEDDING_REDIS_STATS["hits"] += 1
+        EMBEDDING_CACHE.set(keys[i], packed)
+        packed_embeddings[i] = packed
+    return packed_embeddings
+
+
+def cache_embeddings(
+    texts: list[str],
+    embeddings: list[list[float]],
+    model: str = "text-embedding-3-small",
+    dimensions: int = 512,
+) -> None:
+    """
+    Write embeddings into both cache tiers in bulk (with a single redis round trip).
+    """
+    if not texts:
+        return
+    items = {
+        get_embedding_cache_key(text, model, dimensions): pack_embedding(embedding)
+        for text, embedding in zip(texts, embeddings)
+    }
+    for key, packed in items.items():
+        EMBEDDING_CACHE.set(key, packed)
+    try:
+        pipeline = redis_client_binary.pipeline(transaction=False)
+        for key, packed in items.items():
+            pipeline.set(key, packed, ex=EMBEDDING_CACHE_TTL)
+        pipeline.execute()
+    except redis.RedisError as e:
+        LOGGER.warning(f"Could not write embeddings to redis: {e}")
+        EMBEDDING_REDIS_STATS["errors"] += 1
+
+
+async def get_embeddings(
+    texts: list[str],
+    model: str = "text-embedding-3-small",
+    dimensions: int = 512,
+) -> list[list[float]]:
+    """
+    Returns the embeddings of the given texts in the same order, using the
+    cache where possible. Cache misses are embedded in concurrent requests of
+    up to EMBEDDING_BATCH_SIZE texts each.
+    """
+    keys = [get_embedding_cache_key(text, model, dimensions) for text in texts]
+    packed_embeddings = get_cached_embeddings(keys)
+    embeddings = [
+        unpack_embedding(packed) if packed is not None else None
+        for packed in packed_embeddings
+    ]
+    missing_idx = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing_idx:
+        missing_texts = [texts[i] for i in missing_idx]
+        responses = await asyncio.gather(
+            *[
+                client_openai.embeddings.create(
+                    input=missing_texts[start : start + EMBEDDING_BATCH_SIZE],
+                    model=model,
+                    dimensions=dimensions,
+                )
+                for start in range(0, len(missing_texts), EMBEDDING_BATCH_SIZE)
+            ]
+        )
+        new_embeddings = [
+            item.embedding
+            for resp in responses
+            for item in sorted(resp.data, key=lambda d: d.index)
+        ]
+        cache_embeddings(missing_texts, new_embeddings, model, dimensions)
+        for i, embedding in zip(missing_idx, new_embeddings):
+            embeddings[i] = embedding
+    return embeddings
+
+
 async def get_embedding(
     text: str,
     model: str="text-embedding-3-small",
@@ -9,10 +155,7 @@ async def get_embedding(
 ):
     """
     Returns the embedding of the given text, using the text-embedding-3-small model.
+    Repeated calls with the same text (ignoring whitespace) are served from the cache.
     """
-    resp = await client_openai.embeddings.create(
-        input=text,
-        model=model,
-        dimensions=dimensions,
-    )
-    return resp.data[0].embedding
\ No newline at end of file
+    embeddings = await get_embeddings([text], model=model, dimensions=dimensions)
+    return embeddings[0]
@@ -2,18 +2,42 @@
 ### Instructions Related Functions Below ###
 ########################################
 
-from sqlalchemy import select, delete
+import os
+import re
+import time
+from sqlalchemy import Text, any_, bindparam, func, select, delete
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from db_models import GoldenQueries
 from db_config import engine
 from pydantic import BaseModel, Field
 from typing import List
+from utils_cache import bump_golden_queries_version
+from utils_embedding import get_embeddings
+from utils_logging import LOGGER
+from utils_vector_search import search_hnsw_index
+
+# size of the candidate list used by the HNSW index when searching. Higher
+# values give better recall at the cost of latency.
+GOLDEN_QUERIES_EF_SEARCH = int(os.getenv("GOLDEN_QUERIES_EF_SEARCH", 100))
+
+# if the closest golden query is at least this similar (cosine similarity) to
+# the question, its SQL is returned as is without calling the LLM. Set to a
+# value above 1 to disable this.
+GOLDEN_QUERY_MATCH_THRESHOLD = float(os.getenv("GOLDEN_QUERY_MATCH_THRESHOLD", 0.95))
+
+# literal values in questions that we can substitute into a golden query's SQL:
+# quoted strings and numbers (which also covers years)
+QUESTION_LITERAL_REGEX = re.compile(r"'([^']*)'|\"([^\"]*)\"|(?<![\w.])(\d+(?:\.\d+)?)(?!\w|\.\d)")
 
 
 class GoldenQuery(BaseModel):
     db_name: str = Field(..., description="The name of the database")
     question: str = Field(..., description="The question to generate SQL for")
     sql: str = Field(..., description="The query itself")
+    similarity: float | None = Field(
+        None, description="Cosine similarity to the question searched for, if any"
+    )
 
 
 async def get_all_golden_queries(db_name: str) -> list[dict[str, str]]:
@@ -34,20 +58,116 @@ async def get_closest_golden_queries(
 ) -> List[GoldenQuery]:
     async with AsyncSession(engine) as session:
         async with session.begin():
-            result = await session.execute(
-                select(GoldenQueries.question, GoldenQueries.sql)
+            distance = GoldenQueries.embedding.cosine_distance(question_embedding)
+            rows = await search_hnsw_index(
+                session,
+                select(GoldenQueries.question, GoldenQueries.sql, distance)
                 .where(GoldenQueries.db_name == db_name)
-                .order_by(GoldenQueries.embedding.cosine_distance(question_embedding))
-                .limit(num_queries)
+                .order_by(distance)
+                .limit(num_queries),
+                limit=num_queries,
+                ef_search=GOLDEN_QUERIES_EF_SEARCH,
             )
             closest_queries = []
-            for row in result.all():
+            for row in rows:
                 closest_queries.append(
-                    GoldenQuery(db_name=db_name, question=row[0], sql=row[1])
+                    GoldenQuery(
+                        db_name=db_name,
+                        question=row[0],
+                        sql=row[1],
+                        similarity=1 - row[2] if row[2] is not None else None,
+                    )
                 )
             return closest_queries
 
 
+def split_question_literals(question: str) -> tuple[str, list[tuple[str, str]]]:
+    """
+    Split a question into a lowercased template with its literal values
+    replaced by placeholders, and the list of (kind, value) literals, where
+    kind is "string" or "number".
+    """
+    literals = []
+
+    def replace(match: re.Match) -> str:
+        if match.group(3) is not None:
+            literals.append(("number", match.group(3)))
+        else:
+            literals.append(("string", match.group(1) if match.group(1) is not None else match.group(2)))
+        return "<literal>"
+
+    template = QUESTION_LITERAL_REGEX.sub(replace, question)
+    template = " ".join(template.lower().split()).rstrip("?.! ")
+    return template, literals
+
+
+def substitute_literal(sql: str, kind: str, old: str, new: str) -> str | None:
+    """
+    Replace a literal value in the SQL. Returns None if the old value doesn't
+    occur in the SQL exactly once, since we then can't tell which occurrence
+    (if any) corresponds to the question's literal.
+    """
+    if kind == "number":
+        # skip numbers that are part of identifiers, strings or dates
+        pattern = re.compile(rf"(?<![\w.'-]){re.escape(old)}(?![\w'-]|\.\d)")
+        replacement = new
+    else:
+        escaped_old = old.replace("'", "''")
+        pattern = re.compile(f"'{re.escape(escaped_old)}'", re.IGNORECASE)
+        replacement = "'" + new.replace("'", "''") + "'"
+    if len(pattern.findall(sql)) != 1:
+        return None
+    return pattern.sub(lambda _: replacement, sql)
+
+
+def adapt_golden_query_sql(question: str, golden_query: GoldenQuery) -> str | None:
+    """
+    Adapt the SQL of a (very similar) golden query to the given question.
+    The question may only differ from the golden question in its case,
+    whitespace, trailing punctuation and literal values (quoted strings and
+    numbers), which are substituted into the golden SQL. Returns None if the
+    golden SQL can't be safely reused, e.g. because the question is worded
+    differently, since even a small change in wording can change the answer.
+    """
+    template, literals = split_question_literals(question)
+    golden_template, golden_literals = split_question_literals(golden_query.question)
+    if template != golden_template or len(literals) != len(golden_literals):
+        return None
+
+    sql = golden_query.sql
+    for (kind, new), (golden_kind, old) in zip(literals, golden_literals):
+        if old == new:
+            continue
+        if kind != golden_kind:
+            return None
+        sql = substitute_literal(sql, kind, old, new)
+        if sql is None:
+            return None
+    return sql
+
+
+def match_golden_query(
+    question: str,
+    golden_queries: List[GoldenQuery],
+    threshold: float = GOLDEN_QUERY_MATCH_THRESHOLD,
+) -> tuple[GoldenQuery, str] | None:
+    """
+    Given the closest golden queries for a question (as returned by
+    `get_closest_golden_queries`), return the closest one along with its SQL
+    adapted to the question if it is at least `threshold` similar to the
+    question, else None.
+    """
+    if not golden_queries:
+        return None
+    closest = max(golden_queries, key=lambda gq: gq.similarity or -1)
+    if closest.similarity is None or closest.similarity < threshold:
+        return None
+    sql = adapt_golden_query_sql(question, closest)
+    if sql is None:
+        return None
+    return closest, sql
+
+
 async def set_golden_query(
     db_name: str, question: str, sql: str, question_embedding: List[float]
 ) -> None:
@@ -71,7 +191,7 @@ async def set_golden_query(
             else:
                 new_query.sql = sql
                 new_query.embedding = question_embedding
-            return
+    bump_golden_queries_version(db_name)
 
 async def delete_golden_query(db_name: str, question: str) -> None:
     async with AsyncSession(engine) as session:
@@ -81,4 +201,126 @@ async def delete_golden_query(db_name: str, question: str) -> None:
                 .where(GoldenQueries.db_name == db_name)
                 .where(GoldenQueries.question == question)
             )
-    return
\ No newline at end of file
+    bump_golden_queries_version(db_name)
+    return
+
+
+async def delete_golden_queries(db_name: str, questions: List[str]) -> None:
+    """
+    Deletes all the given questions for a db_name in a single statement.
+    """
+    if not questions:
+        return
+    async with AsyncSession(engine) as session:
+        async with session.begin():
+            await session.execute(
+                delete(GoldenQueries)
+                .where(GoldenQueries.db_name == db_name)
+                .where(
+                    GoldenQueries.question
+                    == any_(bindparam("questions", questions, type_=ARRAY(Text)))
+                )
+            )
+    bump_golden_queries_version(db_name)
+
+
+async def get_embedded_golden_questions(db_name: str, questions: List[str]) -> set[str]:
+    """
+    Returns the subset of the given questions that already exist for a db_name
+    with an embedding. Since golden queries are keyed by their question, the
+    embeddings of these questions are still valid and need not be recomputed.
+    """
+    if not questions:
+        return set()
+    async with AsyncSession(engine) as session:
+        async with session.begin():
+            result = await session.execute(
+                select(GoldenQueries.question)
+                .where(GoldenQueries.db_name == db_name)
+                .where(
+                    GoldenQueries.question
+                    == any_(bindparam("questions", questions, type_=ARRAY(Text)))
+                )
+                .where(GoldenQueries.embedding.is_not(None))
+            )
+            return set(result.scalars().all())
+
+
+async def set_golden_queries(
+    db_name: str,
+    golden_queries: List[dict[str, str]],
+    batch_size: int = 100,
+) -> dict:
+    """
+    Bulk version of `set_golden_query`. `golden_queries` is a list of dicts with
+    the keys `question` and `sql`.
+    - Questions that already have an embedding are not re-embedded
+    - The remaining questions are embedded in batches of `batch_size`
+    - Everything is upserted with a single INSERT ... ON CONFLICT statement
+    Returns the number of questions embedded / reused, along with the
+    throughput of each embedding batch.
+    """
+    # if a question is repeated, the last sql wins (same as calling
+    # `set_golden_query` for each golden query in order)
+    sql_by_question = {gq["question"]: gq["sql"] for gq in golden_queries}
+    if not sql_by_question:
+        return {"num_embedded": 0, "num_reused": 0, "batches": []}
+    questions = list(sql_by_question.keys())
+
+    embedded_questions = await get_embedded_golden_questions(db_name, questions)
+    questions_to_embed = [q for q in questions if q not in embedded_questions]
+
+    embeddings = {}
+    batches = []
+    num_batches = (len(questions_to_embed) + batch_size - 1) // batch_size
+    for i in range(0, len(questions_to_embed), batch_size):
+        batch = questions_to_embed[i : i + batch_size]
+        t_start = time.time()
+        batch_embeddings = await get_embeddings(batch)
+        duration = time.time() - t_start
+        embeddings.update(zip(batch, batch_embeddings))
+        batch_stats = {
+            "batch": len(batches) + 1,
+            "num_questions": len(batch),
+            "duration": round(duration, 3),
+            "questions_per_second": round(len(batch) / duration, 1) if duration > 0 else None,
+        }
+        batches.append(batch_stats)
+        LOGGER.info(
+            f"Embedded golden queries batch {batch_stats['batch']}/{num_batches} for {db_name}: "
+            f"{len(batch)} questions in {duration:.2f}s ({batch_stats['questions_per_second']} questions/s)"
+        )
+
+    stmt = insert(GoldenQueries)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[GoldenQueries.db_name, GoldenQueries.question],
+        set_={
+            "sql": stmt.excluded.sql,
+            # unchanged questions are written with a NULL embedding, so keep the existing one
+            "embedding": func.coalesce(stmt.excluded.embedding, GoldenQueries.embedding),
+        },
+    )
+    t_start = time.time()
+    async with AsyncSession(engine) as session:
+        async with session.begin():
+            await session.execute(
+                stmt,
+                [
+                    {
+                        "db_name": db_name,
+                        "question": question,
+                        "sql": sql,
+                        "embedding": embeddings.get(question),
+                    }
+                    for question, sql in sql_by_question.items()
+                ],
+            )
+    bump_golden_queries_version(db_name)
+    LOGGER.info(
+        f"Upserted {len(sql_by_question)} golden queries for {db_name} in {time.time() - t_start:.2f}s"
+    )
+    return {
+        "num_embedded": len(questions_to_embed),
+        "num_reused": len(embedded_questions),
+        "batches": batches,
+    }
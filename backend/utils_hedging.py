@@ -0,0 +1,73 @@
+###############################################
+### Request Hedging Related Functions Below ###
+###############################################
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+
+@dataclass
+class HedgedResult:
+    """
+    The outcome of `run_hedged`.
+    `winner` is "primary" or "hedge", or None if neither request succeeded, in
+    which case `result` is the outcome of the primary request.
+    `outcomes` has the result (or exception) of every request that finished,
+    and `cancelled` names the requests that were cancelled before they did.
+    """
+
+    result: Any
+    winner: str | None
+    hedge_fired: bool
+    outcomes: dict[str, Any] = field(default_factory=dict)
+    cancelled: list[str] = field(default_factory=list)
+
+
+async def run_hedged(
+    primary: Callable[[], Awaitable[Any]],
+    hedge: Callable[[], Awaitable[Any]],
+    delay: float,
+    is_success: Callable[[Any], bool] = lambda result: True,
+) -> HedgedResult:
+    """
+    Start the primary request, and if it hasn't succeeded within `delay`
+    seconds (or it fails before that), start the hedge request as well.
+    The first request whose result passes `is_success` wins, and the other
+    request is cancelled. Exceptions raised by a request count as failures.
+    Cancelled requests are awaited before returning, so that they have finished
+    cleaning up (and the ones that finished before they could be cancelled are
+    in `outcomes`).
+    """
+    tasks = {asyncio.create_task(primary()): "primary"}
+    outcomes, cancelled = {}, []
+    winner = None
+    hedge_fired = False
+    try:
+        while tasks and winner is None:
+            done, _ = await asyncio.wait(
+                tasks,
+                timeout=None if hedge_fired else delay,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                name = tasks.pop(task)
+                outcome = task.exception() or task.result()
+                outcomes[name] = outcome
+                if winner is None and not isinstance(outcome, BaseException) and is_success(outcome):
+                    winner = name
+            # the primary request is either slow (nothing is done yet) or it failed
+            if winner is None and not hedge_fired:
+                tasks[asyncio.create_task(hedge())] = "hedge"
+                hedge_fired = True
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for task, name in tasks.items():
+            if task.cancelled():
+                cancelled.append(name)
+            else:
+                outcomes[name] = task.exception() or task.result()
+    result = outcomes[winner] if winner is not None else outcomes["primary"]
+    return HedgedResult(result, winner, hedge_fired, outcomes, cancelled)
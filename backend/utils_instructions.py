@@ -2,11 +2,27 @@
 ### Instructions Related Functions Below ###
 ########################################
 
+import os
+import re
+
 from sqlalchemy import delete, insert, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
-from db_models import Instructions
+from db_models import InstructionChunks, Instructions
 from db_config import engine
+from utils_cache import bump_schema_version
+from utils_embedding import get_embedding, get_embeddings
 from utils_logging import LOGGER
+from utils_vector_search import search_hnsw_index
+
+# instructions longer than this are not pasted into prompts in full. Instead,
+# we retrieve the INSTRUCTIONS_TOP_K chunks most relevant to the question,
+# along with all pinned chunks.
+INSTRUCTIONS_RETRIEVAL_MIN_CHARS = int(os.getenv("INSTRUCTIONS_RETRIEVAL_MIN_CHARS", 4000))
+INSTRUCTIONS_TOP_K = int(os.getenv("INSTRUCTIONS_TOP_K", 10))
+INSTRUCTION_CHUNK_MAX_CHARS = 1500
+# rules containing this marker are always included in prompts
+PINNED_INSTRUCTION_MARKER = "[always]"
+INSTRUCTION_BREAK_REGEX = re.compile(r"^\s*(?:[-*•]|\d+[.)]|#+)\s+")
 
 
 async def get_instructions(db_name: str, instructions_type: str = "sql_instructions") -> str:
@@ -60,9 +76,162 @@ async def set_instructions(db_name: str, instructions_text: str):
                         db_name=db_name, sql_instructions=instructions_text
                     )
                 )
+    await refresh_instruction_chunks(db_name, instructions_text)
+    bump_schema_version(db_name)
     return
 
 
+def split_instructions(instructions: str) -> list[tuple[str, bool]]:
+    """
+    Split instructions into chunks of roughly 1 rule each, and return the
+    (content, pinned) of each chunk. A new chunk starts at every blank line,
+    list item or markdown heading (a heading stays with the rule after it).
+    Chunks longer than INSTRUCTION_CHUNK_MAX_CHARS are split between lines.
+    Chunks containing PINNED_INSTRUCTION_MARKER are pinned, and the marker is
+    removed from their content.
+    """
+    blocks, lines, heading_only = [], [], False
+    for line in (instructions or "").splitlines():
+        starts_block = not line.strip() or INSTRUCTION_BREAK_REGEX.match(line)
+        if starts_block and lines and not heading_only:
+            blocks.append(lines)
+            lines = []
+        if line.strip():
+            if not lines:
+                heading_only = line.lstrip().startswith("#")
+            elif heading_only and not line.lstrip().startswith("#"):
+                heading_only = False
+            lines.append(line)
+    if lines:
+        blocks.append(lines)
+
+    chunks = []
+    for block in blocks:
+        content = ""
+        for line in block:
+            if content and len(content) + len(line) + 1 > INSTRUCTION_CHUNK_MAX_CHARS:
+                chunks.append(content)
+                content = ""
+            content = f"{content}\n{line}" if content else line
+        chunks.append(content)
+    pinned_marker_regex = re.compile(re.escape(PINNED_INSTRUCTION_MARKER) + r"[ \t]*")
+    return [
+        (pinned_marker_regex.sub("", chunk).strip(), PINNED_INSTRUCTION_MARKER in chunk)
+        for chunk in chunks
+        if pinned_marker_regex.sub("", chunk).strip()
+    ]
+
+
+async def refresh_instruction_chunks(db_name: str, instructions_text: str | None = None):
+    """
+    Replace the instruction chunks (and their embeddings) of a db_name with the
+    chunks of its current instructions. instructions_text is read from the db
+    if not given. Errors are logged instead of raised, and any stale chunks are
+    deleted so that the full instructions are used instead.
+    """
+    try:
+        if instructions_text is None:
+            instructions_text = await get_instructions(db_name)
+        chunks = split_instructions(instructions_text)
+        # unchanged chunks are served from the embedding cache
+        embeddings = await get_embeddings([content for content, _ in chunks])
+        async with engine.begin() as conn:
+            await conn.execute(
+                delete(InstructionChunks).where(InstructionChunks.db_name == db_name)
+            )
+            if chunks:
+                await conn.execute(
+                    insert(InstructionChunks),
+                    [
+                        {
+                            "db_name": db_name,
+                            "chunk_index": i,
+                            "content": content,
+                            "pinned": pinned,
+                            "embedding": embedding,
+                        }
+                        for i, ((content, pinned), embedding) in enumerate(
+                            zip(chunks, embeddings)
+                        )
+                    ],
+                )
+        LOGGER.info(f"Refreshed {len(chunks)} instruction chunks for {db_name}")
+        return len(chunks)
+    except Exception as e:
+        LOGGER.error(f"Error refreshing instruction chunks for {db_name}: {str(e)}")
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(
+                    delete(InstructionChunks).where(InstructionChunks.db_name == db_name)
+                )
+        except Exception as e:
+            LOGGER.error(f"Error deleting instruction chunks for {db_name}: {str(e)}")
+        return 0
+
+
+async def get_closest_instruction_chunks(
+    db_name: str, question_embedding: list[float], top_k: int = INSTRUCTIONS_TOP_K
+) -> list[str]:
+    """
+    Get the pinned instruction chunks of a db_name (in their original order),
+    followed by the top_k other chunks most similar to the question (most
+    similar first), using the HNSW index on the chunk embeddings.
+    """
+    distance = InstructionChunks.embedding.cosine_distance(question_embedding)
+    async with engine.begin() as conn:
+        pinned = await conn.execute(
+            select(InstructionChunks.content)
+            .where(InstructionChunks.db_name == db_name)
+            .where(InstructionChunks.pinned)
+            .order_by(InstructionChunks.chunk_index)
+        )
+        pinned_chunks = pinned.scalars().all()
+        closest = await search_hnsw_index(
+            conn,
+            select(InstructionChunks.content)
+            .where(InstructionChunks.db_name == db_name)
+            .where(InstructionChunks.pinned.is_not(True))
+            .order_by(distance)
+            .limit(top_k),
+            limit=top_k,
+            ef_search=100,
+        )
+        return list(pinned_chunks) + [row[0] for row in closest]
+
+
+async def get_relevant_instructions(
+    db_name: str,
+    question: str,
+    instructions: str,
+    question_embedding: list[float] | None = None,
+    top_k: int = INSTRUCTIONS_TOP_K,
+) -> str:
+    """
+    Return the parts of a db_name's instructions that should go into a prompt
+    for the question: the full instructions if they are short, else the pinned
+    chunks and the top_k chunks most relevant to the question. Falls back to the
+    full instructions if the chunks can't be retrieved (e.g. they haven't been
+    created yet for this db_name).
+    """
+    if not instructions or len(instructions) <= INSTRUCTIONS_RETRIEVAL_MIN_CHARS:
+        return instructions
+    try:
+        if question_embedding is None:
+            question_embedding = await get_embedding(question)
+        chunks = await get_closest_instruction_chunks(db_name, question_embedding, top_k)
+    except Exception as e:
+        LOGGER.warning(f"Error retrieving instruction chunks, using all instructions: {str(e)}")
+        return instructions
+    if not chunks:
+        return instructions
+    relevant_instructions = "\n\n".join(chunks)
+    LOGGER.debug(
+        f"Retrieved {len(chunks)} instruction chunks for {db_name} "
+        f"({len(relevant_instructions)} of {len(instructions)} chars)"
+    )
+    return relevant_instructions
+
+
 async def get_join_hints(db_name: str) -> list[list[str]] | None:
     """
     Get join hints for a given db_name.
@@ -83,6 +252,7 @@ async def delete_join_hints(db_name: str):
             await session.execute(
                 delete(Instructions).where(Instructions.db_name == db_name)
             )
+    bump_schema_version(db_name)
     return
 
 
@@ -105,4 +275,5 @@ async def set_join_hints(db_name: str, join_hints: list[list[str]]):
                 await session.execute(
                     insert(Instructions).values(db_name=db_name, join_hints=join_hints)
                 )
+    bump_schema_version(db_name)
     return
@@ -2,15 +2,21 @@
 ### Metadata Related Functions Below ###
 ########################################
 
+import collections
 import json
+import re
 import sqlglot
 from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from db_models import (
     Metadata as DbMetadata,
+    SchemaFormat as DbSchemaFormat,
 )  # to disambiguate from sqlalchemy's Metadata
 from db_config import engine
-from request_models import TableDescription
+from request_models import SchemaFormat, TableDescription
+from utils_cache import bump_schema_version
+from utils_column_embeddings import schedule_column_embeddings_refresh
 import os
 
 home_dir = os.path.expanduser("~")
@@ -106,6 +112,8 @@ async def set_metadata(db_name: str, table_metadata: list[dict[str, str]]):
             with open(selected_tables_path, "w") as f:
                 json.dump(table_names, f)
 
+    bump_schema_version(db_name)
+    schedule_column_embeddings_refresh(db_name)
     return
 
 
@@ -188,6 +196,145 @@ def mk_create_ddl(
     return md_create
 
 
+# shorter spellings of common (mostly postgres) data types for the compact
+# schema format. Anything after the type, like the length in varchar(255) or
+# constraints like NOT NULL, is kept.
+DATA_TYPE_ABBREVIATIONS = {
+    "character varying": "varchar",
+    "character": "char",
+    "timestamp without time zone": "timestamp",
+    "timestamp with time zone": "timestamptz",
+    "time without time zone": "time",
+    "time with time zone": "timetz",
+    "double precision": "float8",
+    "integer": "int",
+    "smallint": "int2",
+    "bigint": "int8",
+    "boolean": "bool",
+    "real": "float4",
+    "decimal": "numeric",
+}
+# longest first, so that e.g. "character varying" is not abbreviated as "char varying"
+DATA_TYPE_ABBREVIATIONS_ORDER = sorted(DATA_TYPE_ABBREVIATIONS, key=len, reverse=True)
+
+COMPACT_SCHEMA_HEADER = (
+    "-- table: description, then its columns as `data_type: column (description), ...`;"
+    " [n] refers to the shared descriptions at the end\n"
+)
+
+
+def abbreviate_data_type(data_type: str) -> str:
+    """
+    Return the abbreviated, lowercased form of a data type, e.g.
+    `CHARACTER VARYING (255)` -> `varchar(255)`. Unknown types are only lowercased.
+    """
+    data_type = " ".join((data_type or "").lower().split())
+    data_type = re.sub(r"\s*([(),])\s*", r"\1", data_type)
+    for full_type in DATA_TYPE_ABBREVIATIONS_ORDER:
+        if data_type.startswith(full_type) and not data_type[len(full_type) :][:1].isalnum():
+            return DATA_TYPE_ABBREVIATIONS[full_type] + data_type[len(full_type) :]
+    return data_type
+
+
+def mk_compact_ddl(
+    md: list[dict[str, str]], table_descriptions: list[TableDescription] = []
+) -> str:
+    """
+    Return a compact text representation of the schema in a metadata list,
+    which uses far fewer tokens than `mk_create_ddl` for wide schemas:
+    - each table is introduced once, with its description on the same line
+    - columns are grouped by their (abbreviated) data type
+    - descriptions shared by more than one column are written once in a
+      numbered list at the end and referenced as [n]
+    Tables are listed in their order of appearance in the metadata.
+    """
+    table_descriptions_dict = {
+        td.table_name: td.table_description for td in table_descriptions
+    }
+    description_counts = collections.Counter(
+        column.get("column_description") or "" for column in md
+    )
+    shared_descriptions = {}
+    for description, count in description_counts.items():
+        if description and count > 1:
+            shared_descriptions[description] = len(shared_descriptions) + 1
+
+    md_dict = {}
+    for column in md:
+        md_dict.setdefault(column["table_name"], []).append(column)
+
+    md_compact = COMPACT_SCHEMA_HEADER
+    for table_name, columns in md_dict.items():
+        table_description = table_descriptions_dict.get(table_name)
+        md_compact += (
+            f"{table_name}: {table_description}\n" if table_description else f"{table_name}:\n"
+        )
+        type_columns = {}
+        for column in columns:
+            col_name = column["column_name"]
+            # same quoting as mk_create_table_ddl
+            if " " in col_name and not col_name.startswith('"'):
+                col_name = f'"{col_name}"'
+            col_desc = column.get("column_description") or ""
+            if col_desc in shared_descriptions:
+                col_name += f" [{shared_descriptions[col_desc]}]"
+            elif col_desc:
+                col_name += f" ({col_desc})"
+            dtype = abbreviate_data_type(column["data_type"])
+            type_columns.setdefault(dtype, []).append(col_name)
+        for dtype, col_names in type_columns.items():
+            md_compact += f"  {dtype}: {', '.join(col_names)}\n"
+    if shared_descriptions:
+        md_compact += "\n"
+        for description, i in shared_descriptions.items():
+            md_compact += f"[{i}] {description}\n"
+    return md_compact
+
+
+def mk_schema_prompt(
+    md: list[dict[str, str]],
+    table_descriptions: list[TableDescription] = [],
+    schema_format: SchemaFormat = "ddl",
+) -> str:
+    """
+    Render the schema in a metadata list for our prompts, either as DDL
+    statements (`mk_create_ddl`) or in the compact format (`mk_compact_ddl`).
+    """
+    if schema_format == "compact":
+        return mk_compact_ddl(md, table_descriptions)
+    return mk_create_ddl(md, table_descriptions)
+
+
+async def get_schema_format(db_name: str) -> SchemaFormat:
+    """
+    Get the format used to render the schema of a db_name in our prompts.
+    Defaults to "ddl" if none has been set.
+    """
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            select(DbSchemaFormat.schema_format).where(
+                DbSchemaFormat.db_name == db_name
+            )
+        )
+        schema_format = result.scalar_one_or_none()
+    return schema_format or "ddl"
+
+
+async def set_schema_format(db_name: str, schema_format: SchemaFormat):
+    """
+    Set the format used to render the schema of a db_name in our prompts.
+    """
+    async with engine.begin() as conn:
+        await conn.execute(
+            pg_insert(DbSchemaFormat)
+            .values(db_name=db_name, schema_format=schema_format)
+            .on_conflict_do_update(
+                index_elements=["db_name"], set_={"schema_format": schema_format}
+            )
+        )
+    bump_schema_version(db_name)
+
+
 def check_metadata_validity(
     table_metadata: list[dict[str, str]], db_type: str
 ) -> str | None:
@@ -3,7 +3,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from oracle_models import Clarification
 from db_models import OracleGuidelines, OracleReports, PDFFiles, Project
 from db_config import engine
-from utils_md import get_metadata, mk_create_ddl
+from utils_schema_context import get_schema_context
 from defog.llm.utils import chat_async
 from utils_logging import LOGGER
 from typing import Literal, Any
@@ -37,8 +37,8 @@ async def clarify_question(
     provider: str = "openai",
     model_name: str = "gpt-4o",
 ) -> dict:
-    metadata = await get_metadata(db_name)
-    ddl = mk_create_ddl(metadata)
+    schema_context = await get_schema_context(db_name)
+    ddl = schema_context.ddl
 
     user_prompt = CLARIFICATION_USER_PROMPTS.format(
         question=user_question,
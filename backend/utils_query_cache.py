@@ -0,0 +1,325 @@
+##########################################
+### Query Result Cache Functions Below ###
+##########################################
+
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Any
+
+import pyarrow as pa
+import redis
+from db_config import engine, redis_client_binary
+from db_models import QueryCacheTTL
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlglot import exp, parse_one
+from utils_cache import get_query_setting, invalidate_query_setting, register_cache_stats
+from utils_connection_pool import get_creds_key
+from utils_logging import LOGGER
+from utils_query_results import (
+    QUERY_MAX_ROWS,
+    QueryResults,
+    fetch_query_results,
+    get_query_timeout,
+)
+
+# query results are cached in redis (shared across workers) for this many
+# seconds, for db_names without their own ttl. The cache key includes a hash of
+# the db creds, so changing the creds of a db implicitly invalidates its entries.
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", 10 * 60))
+# results that take up more than this many bytes once compressed are not cached
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", 10 * 1024 * 1024))
+QUERY_CACHE_COMPRESSION = "zstd"
+
+# queries that call functions whose results change between runs (e.g. the
+# current time, or random numbers) are never cached. Dialect-specific functions
+# that sqlglot doesn't have expressions for are matched by name, as are bare
+# keywords like SYSDATE that sqlglot parses as columns.
+VOLATILE_EXPRESSIONS = tuple(
+    getattr(exp, name)
+    for name in [
+        "CurrentDate",
+        "CurrentDatetime",
+        "CurrentTime",
+        "CurrentTimestamp",
+        "CurrentTimestampLTZ",
+        "Localtime",
+        "Localtimestamp",
+        "Systimestamp",
+        "Rand",
+        "Randn",
+        "Uuid",
+    ]
+    if hasattr(exp, name)
+)
+VOLATILE_FUNCTIONS = {
+    "CLOCK_TIMESTAMP",
+    "CURDATE",
+    "CURRENT_DATE",
+    "CURRENT_TIME",
+    "CURRENT_TIMESTAMP",
+    "CURTIME",
+    "GEN_RANDOM_UUID",
+    "GENERATE_UUID",
+    "GETDATE",
+    "GETUTCDATE",
+    "LOCALTIME",
+    "LOCALTIMESTAMP",
+    "NEWID",
+    "NOW",
+    "RAND",
+    "RANDOM",
+    "STATEMENT_TIMESTAMP",
+    "SYSDATE",
+    "SYSDATETIME",
+    "SYSTIMESTAMP",
+    "TIMEOFDAY",
+    "TODAY",
+    "TRANSACTION_TIMESTAMP",
+    "UNIX_TIMESTAMP",
+    "UTC_DATE",
+    "UTC_TIME",
+    "UTC_TIMESTAMP",
+    "UUID",
+}
+VOLATILE_FUNCTIONS_PATTERN = re.compile(
+    r"\b(" + "|".join(sorted(VOLATILE_FUNCTIONS)) + r")\b", re.IGNORECASE
+)
+
+QUERY_CACHE_STATS = {
+    "hits": 0,
+    "misses": 0,
+    "bypassed": 0,
+    "volatile": 0,
+    "too_large": 0,
+    "errors": 0,
+}
+
+
+def get_query_cache_stats() -> dict[str, float]:
+    total = QUERY_CACHE_STATS["hits"] + QUERY_CACHE_STATS["misses"]
+    return {
+        **QUERY_CACHE_STATS,
+        "hit_rate": QUERY_CACHE_STATS["hits"] / total if total else 0.0,
+    }
+
+
+register_cache_stats("query_results", get_query_cache_stats)
+
+
+async def load_query_cache_ttl(db_name: str) -> int:
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            select(QueryCacheTTL.ttl).where(QueryCacheTTL.db_name == db_name)
+        )
+        ttl = result.scalar_one_or_none()
+    return QUERY_CACHE_TTL if ttl is None else ttl
+
+
+async def get_query_cache_ttl(db_name: str) -> int:
+    """
+    Get how long the results of queries on a db_name are cached for, in
+    seconds. 0 means that they are not cached.
+    The ttl itself is cached (see utils_cache.get_query_setting).
+    """
+    return await get_query_setting("cache_ttl", db_name, lambda: load_query_cache_ttl(db_name))
+
+
+async def set_query_cache_ttl(db_name: str, ttl: int | None):
+    """
+    Set how long the results of queries on a db_name are cached for, or reset
+    it to QUERY_CACHE_TTL if ttl is None.
+    """
+    async with engine.begin() as conn:
+        if ttl is None:
+            await conn.execute(
+                delete(QueryCacheTTL).where(QueryCacheTTL.db_name == db_name)
+            )
+        else:
+            await conn.execute(
+                pg_insert(QueryCacheTTL)
+                .values(db_name=db_name, ttl=ttl)
+                .on_conflict_do_update(index_elements=["db_name"], set_={"ttl": ttl})
+            )
+    invalidate_query_setting("cache_ttl", db_name)
+
+
+def parse_sql(sql: str, db_type: str) -> exp.Expression | None:
+    """
+    Parse the SQL with sqlglot, or return None if it can't be parsed.
+    """
+    dialect = "tsql" if db_type == "sqlserver" else db_type
+    try:
+        return parse_one(sql, read=dialect)
+    except Exception as e:
+        LOGGER.debug(f"Could not parse SQL to normalize it: {str(e)}")
+        return None
+
+
+def normalize_sql(sql: str, db_type: str, parsed: exp.Expression | None) -> str:
+    """
+    Normalize the SQL (as parsed by `parse_sql`) with sqlglot, so that queries
+    that only differ in whitespace, comments or keyword case share a cache
+    entry. SQL that sqlglot can't parse only has its whitespace normalized.
+    """
+    if parsed is None:
+        return " ".join(sql.split())
+    dialect = "tsql" if db_type == "sqlserver" else db_type
+    return parsed.sql(dialect=dialect, comments=False)
+
+
+def is_volatile_sql(sql: str, parsed: exp.Expression | None) -> bool:
+    """
+    Whether the SQL (as parsed by `parse_sql`) calls a function whose result
+    changes between runs, like NOW() or RANDOM(). SQL that sqlglot can't parse
+    is searched for the names of such functions instead.
+    """
+    if parsed is None:
+        return VOLATILE_FUNCTIONS_PATTERN.search(sql) is not None
+    for node in parsed.walk():
+        if isinstance(node, VOLATILE_EXPRESSIONS):
+            return True
+        if isinstance(node, exp.Anonymous) and node.name.upper() in VOLATILE_FUNCTIONS:
+            return True
+        if (
+            isinstance(node, exp.Column)
+            and not node.table
+            and node.name.upper() in VOLATILE_FUNCTIONS
+        ):
+            return True
+    return False
+
+
+def get_query_cache_key(
+    db_name: str,
+    db_type: str,
+    db_creds: dict[str, Any],
+    sql: str,
+    max_rows: int,
+) -> str | None:
+    """
+    Returns the cache key for the results of a query, or None if its results
+    shouldn't be cached because they change between runs (see
+    `is_volatile_sql`). The creds are only included as a hash (see
+    utils_connection_pool.get_creds_key).
+    """
+    parsed = parse_sql(sql, db_type)
+    if is_volatile_sql(sql, parsed):
+        return None
+    key_inputs = json.dumps(
+        {
+            "creds_key": get_creds_key(db_type, db_creds),
+            "sql": normalize_sql(sql, db_type, parsed),
+            "max_rows": max_rows,
+        },
+        sort_keys=True,
+    )
+    return f"query_results:{db_name}:{hashlib.sha256(key_inputs.encode('utf-8')).hexdigest()}"
+
+
+def serialize_query_results(results: QueryResults) -> bytes:
+    """
+    Serialize query results as compressed Arrow IPC, with when they were cached
+    and whether they were truncated in the schema metadata.
+    """
+    metadata = {
+        "cached_at": str(time.time()),
+        "truncated": json.dumps(results.truncated),
+    }
+    table = results.table.replace_schema_metadata(metadata)
+    sink = pa.BufferOutputStream()
+    options = pa.ipc.IpcWriteOptions(compression=QUERY_CACHE_COMPRESSION)
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def deserialize_query_results(data: bytes) -> QueryResults:
+    """
+    Inverse of `serialize_query_results`. The returned results are marked as
+    cached, along with how old they are in seconds.
+    """
+    with pa.ipc.open_stream(data) as reader:
+        table = reader.read_all()
+    metadata = table.schema.metadata or {}
+    cached_at = float(metadata.get(b"cached_at", time.time()))
+    return QueryResults(
+        table=table.replace_schema_metadata(None),
+        truncated=json.loads(metadata.get(b"truncated", b"false")),
+        cached=True,
+        cache_age=max(time.time() - cached_at, 0.0),
+    )
+
+
+def get_cached_query_results(cache_key: str) -> QueryResults | None:
+    try:
+        data = redis_client_binary.get(cache_key)
+    except redis.RedisError as e:
+        LOGGER.warning(f"Could not read query results from redis: {e}")
+        QUERY_CACHE_STATS["errors"] += 1
+        return None
+    if data is None:
+        QUERY_CACHE_STATS["misses"] += 1
+        return None
+    try:
+        results = deserialize_query_results(data)
+    except Exception as e:
+        LOGGER.warning(f"Could not read cached query results: {e}")
+        QUERY_CACHE_STATS["errors"] += 1
+        return None
+    QUERY_CACHE_STATS["hits"] += 1
+    return results
+
+
+def cache_query_results(cache_key: str, results: QueryResults, ttl: int) -> None:
+    data = serialize_query_results(results)
+    if len(data) > QUERY_CACHE_MAX_BYTES:
+        QUERY_CACHE_STATS["too_large"] += 1
+        return
+    try:
+        redis_client_binary.set(cache_key, data, ex=ttl)
+    except redis.RedisError as e:
+        LOGGER.warning(f"Could not write query results to redis: {e}")
+        QUERY_CACHE_STATS["errors"] += 1
+
+
+async def fetch_cached_query_results(
+    db_name: str,
+    db_type: str,
+    db_creds: dict[str, Any],
+    sql: str,
+    max_rows: int = QUERY_MAX_ROWS,
+    use_cache: bool = True,
+    timeout: float | None = None,
+) -> QueryResults:
+    """
+    Like `utils_query_results.fetch_query_results`, but serves the results from
+    the query result cache of the db_name if they are there, and caches them
+    otherwise. Set use_cache to False to always run the query (the fresh
+    results are still cached). Queries whose results change between runs
+    (e.g. that call NOW()) are never cached.
+    Queries time out after the timeout of the db_name, or after timeout seconds
+    if that is lower (see utils_query_results.get_query_timeout).
+    """
+    timeout = await get_query_timeout(db_name, timeout)
+    ttl = await get_query_cache_ttl(db_name)
+    if ttl <= 0:
+        return await fetch_query_results(db_type, db_creds, sql, max_rows=max_rows, timeout=timeout)
+
+    cache_key = get_query_cache_key(db_name, db_type, db_creds, sql, max_rows)
+    if cache_key is None:
+        QUERY_CACHE_STATS["volatile"] += 1
+        return await fetch_query_results(db_type, db_creds, sql, max_rows=max_rows, timeout=timeout)
+    if use_cache:
+        results = get_cached_query_results(cache_key)
+        if results is not None:
+            return results
+    else:
+        QUERY_CACHE_STATS["bypassed"] += 1
+
+    results = await fetch_query_results(db_type, db_creds, sql, max_rows=max_rows, timeout=timeout)
+    cache_query_results(cache_key, results, ttl)
+    return results
@@ -0,0 +1,157 @@
+###############################################
+### Query Preflight Related Functions Below ###
+###############################################
+
+import asyncio
+import json
+import re
+from dataclasses import dataclass
+from typing import Any
+
+from db_config import engine
+from db_models import QueryPreflight
+from request_models import QueryPreflightConfig
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from utils_cache import get_query_setting, invalidate_query_setting
+from utils_connection_pool import execute_query, get_pool, release_pool
+from utils_logging import LOGGER
+
+# db types whose queries can be estimated without running them
+PREFLIGHT_DB_TYPES = {"postgres", "redshift", "mysql", "bigquery"}
+
+# the root node of postgres and redshift's EXPLAIN output, e.g.
+# `Aggregate  (cost=0.00..1234.56 rows=100 width=8)`
+REGEX_EXPLAIN_ROOT = re.compile(r"cost=[\d.]+\.\.([\d.]+) rows=(\d+)")
+
+
+@dataclass
+class QueryEstimate:
+    """
+    The planner's estimate of the number of rows a query returns, and of what
+    it costs. The cost is in the planner's own units for postgres, redshift and
+    mysql, and is the number of bytes processed for bigquery. Either can be None
+    if the database doesn't estimate it.
+    """
+
+    rows: float | None = None
+    cost: float | None = None
+
+
+async def load_query_preflight_config(db_name: str) -> QueryPreflightConfig:
+    async with engine.begin() as connection:
+        result = await connection.execute(
+            select(QueryPreflight).where(QueryPreflight.db_name == db_name)
+        )
+        row = result.mappings().one_or_none()
+    if row is None:
+        return QueryPreflightConfig()
+    return QueryPreflightConfig(
+        **{
+            field: row[field]
+            for field in QueryPreflightConfig.model_fields
+            if row[field] is not None
+        }
+    )
+
+
+async def get_query_preflight_config(db_name: str) -> QueryPreflightConfig:
+    """
+    Get the query preflight config for a given db_name.
+    Returns the default (disabled) config if none has been set.
+    The config is cached (see utils_cache.get_query_setting), and copied so
+    that callers can't modify the cached config.
+    """
+    config = await get_query_setting(
+        "preflight_config", db_name, lambda: load_query_preflight_config(db_name)
+    )
+    return config.model_copy()
+
+
+async def set_query_preflight_config(db_name: str, config: QueryPreflightConfig):
+    """
+    Set the query preflight config for a given db_name.
+    """
+    values = config.model_dump()
+    async with engine.begin() as connection:
+        await connection.execute(
+            insert(QueryPreflight)
+            .values(db_name=db_name, **values)
+            .on_conflict_do_update(index_elements=["db_name"], set_=values)
+        )
+    invalidate_query_setting("preflight_config", db_name)
+
+
+def parse_postgres_explain(lines: list[str]) -> QueryEstimate | None:
+    """
+    Parse the estimate of the root node of postgres or redshift's text EXPLAIN
+    output, which is the first line with a cost.
+    """
+    for line in lines:
+        match = REGEX_EXPLAIN_ROOT.search(line)
+        if match:
+            return QueryEstimate(rows=float(match.group(2)), cost=float(match.group(1)))
+    return None
+
+
+def parse_mysql_explain(explain_json: str) -> QueryEstimate | None:
+    """
+    Parse the total cost from mysql's `EXPLAIN FORMAT=JSON` output. Mysql only
+    estimates the rows read from each table, and not the rows returned, so
+    only the cost is estimated.
+    """
+    cost = json.loads(explain_json).get("query_block", {}).get("cost_info", {}).get("query_cost")
+    if cost is None:
+        return None
+    return QueryEstimate(cost=float(cost))
+
+
+async def estimate_bigquery_query(db_creds: dict[str, Any], sql: str) -> QueryEstimate:
+    from google.cloud import bigquery
+
+    _, entry = await get_pool("bigquery", db_creds)
+    entry.in_use += 1
+    try:
+        # dry runs are free, and only validate the query and estimate its bytes
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        query_job = await asyncio.to_thread(entry.pool.query, sql, job_config=job_config)
+    finally:
+        await release_pool(entry)
+    return QueryEstimate(cost=float(query_job.total_bytes_processed))
+
+
+async def estimate_query(
+    db_type: str, db_creds: dict[str, Any], sql: str
+) -> QueryEstimate | None:
+    """
+    Estimate the rows and cost of a query without running it, with EXPLAIN (or
+    a dry run for bigquery). Returns None for db types that we can't estimate
+    queries for, or if the estimate fails, in which case the query is just run.
+    """
+    if db_type not in PREFLIGHT_DB_TYPES:
+        return None
+    sql = sql.strip().rstrip(";")
+    try:
+        if db_type in ("postgres", "redshift"):
+            _, rows = await execute_query(db_type, db_creds, f"EXPLAIN {sql}")
+            return parse_postgres_explain([row[0] for row in rows])
+        elif db_type == "mysql":
+            _, rows = await execute_query(db_type, db_creds, f"EXPLAIN FORMAT=JSON {sql}")
+            return parse_mysql_explain(rows[0][0]) if rows else None
+        elif db_type == "bigquery":
+            return await estimate_bigquery_query(db_creds, sql)
+    except Exception as e:
+        LOGGER.warning(f"Could not estimate the cost of the query: {str(e)}")
+    return None
+
+
+def get_cost_error(estimate: QueryEstimate | None, max_cost: float | None) -> str | None:
+    """
+    Returns why a query is refused if its estimated cost is over max_cost, or
+    None if it can be run.
+    """
+    if estimate is None or estimate.cost is None or max_cost is None:
+        return None
+    if estimate.cost > max_cost:
+        return f"The query is estimated to cost {estimate.cost:,.0f}, which is over the max cost of {max_cost:,.0f} for this database"
+    return None
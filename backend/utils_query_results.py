@@ -0,0 +1,291 @@
+#############################################
+### Query Results Related Functions Below ###
+#############################################
+
+import asyncio
+import json
+import os
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import Any, AsyncIterator
+
+import pyarrow as pa
+from db_config import engine
+from db_models import QueryRowLimit, QueryTimeout
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlglot import exp, parse_one
+from utils_cache import get_query_setting, invalidate_query_setting
+from utils_connection_pool import QueryTimeoutError, stream_query
+from utils_logging import LOGGER
+
+# max number of rows fetched per query, for db_names without their own limit
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", 10000))
+# number of rows fetched from the database (and streamed to callers) at a time
+QUERY_FETCH_CHUNK_SIZE = int(os.getenv("QUERY_FETCH_CHUNK_SIZE", 1000))
+# max seconds that a query can run for, for db_names without their own timeout
+QUERY_TIMEOUT = int(os.getenv("QUERY_TIMEOUT", 300))
+
+
+@dataclass
+class QueryResults:
+    """
+    The results of a query as an arrow table, capped at a max number of rows.
+    `truncated` is True if the query returned more rows than that. `cached` is
+    True if they were served from the query result cache (see utils_query_cache),
+    in which case `cache_age` is how old they are in seconds.
+    """
+
+    table: pa.Table
+    truncated: bool = False
+    cached: bool = False
+    cache_age: float | None = None
+
+    @classmethod
+    def from_rows(cls, columns: list[str], rows: list[list[Any]], **kwargs) -> "QueryResults":
+        column_chunks = [[to_arrow_array([row[i] for row in rows])] for i in range(len(columns))]
+        return cls(build_arrow_table(columns, column_chunks), **kwargs)
+
+    @property
+    def columns(self) -> list[str]:
+        return self.table.column_names
+
+    @property
+    def rows(self) -> list[list[Any]]:
+        columns = [column.to_pylist() for column in self.table.columns]
+        return [list(row) for row in zip(*columns)]
+
+
+def to_arrow_array(values: list[Any]) -> pa.Array:
+    """
+    Convert the values of a column (in one chunk of rows) into an arrow array,
+    inferring its type. Decimals become ints if they have no decimal places,
+    and floats otherwise, like in utils_df.mk_df. Values of mixed or
+    unsupported types are kept as strings.
+    """
+    try:
+        array = pa.array(values)
+    except (pa.ArrowException, TypeError, OverflowError):
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+    if pa.types.is_decimal(array.type):
+        if array.type.scale == 0 and array.type.precision <= 18:
+            return array.cast(pa.int64())
+        return array.cast(pa.float64())
+    return array
+
+
+def unify_arrow_chunks(chunks: list[pa.Array]) -> pa.ChunkedArray:
+    """
+    Combine the chunks of a column, whose types were inferred separately, into
+    a single type. Chunks with only nulls take the type of the other chunks,
+    ints and floats become floats, and other mixed types become strings.
+    """
+    types = {chunk.type for chunk in chunks if not pa.types.is_null(chunk.type)}
+    if not types:
+        return pa.chunked_array(chunks, type=pa.null())
+    if len(types) == 1:
+        column_type = types.pop()
+    elif all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        column_type = pa.float64()
+    else:
+        return pa.chunked_array(
+            [
+                pa.array([None if v is None else str(v) for v in chunk.to_pylist()], type=pa.string())
+                for chunk in chunks
+            ],
+            type=pa.string(),
+        )
+    return pa.chunked_array(
+        [chunk if chunk.type == column_type else chunk.cast(column_type) for chunk in chunks],
+        type=column_type,
+    )
+
+
+def build_arrow_table(columns: list[str], column_chunks: list[list[pa.Array]]) -> pa.Table:
+    return pa.Table.from_arrays(
+        [unify_arrow_chunks(chunks) for chunks in column_chunks], names=columns
+    )
+
+
+async def load_max_rows(db_name: str) -> int:
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            select(QueryRowLimit.max_rows).where(QueryRowLimit.db_name == db_name)
+        )
+        return result.scalar_one_or_none() or QUERY_MAX_ROWS
+
+
+async def get_max_rows(db_name: str, max_rows: int | None = None) -> int:
+    """
+    Get the max number of rows fetched per query for a db_name. Call sites can
+    pass their own max_rows to lower it, but not to raise it.
+    The db_name's row limit is cached (see utils_cache.get_query_setting).
+    """
+    db_max_rows = await get_query_setting("max_rows", db_name, lambda: load_max_rows(db_name))
+    return min(max_rows, db_max_rows) if max_rows else db_max_rows
+
+
+async def set_max_rows(db_name: str, max_rows: int | None):
+    """
+    Set the max number of rows fetched per query for a db_name, or reset it
+    to QUERY_MAX_ROWS if max_rows is None.
+    """
+    async with engine.begin() as conn:
+        if max_rows is None:
+            await conn.execute(
+                delete(QueryRowLimit).where(QueryRowLimit.db_name == db_name)
+            )
+        else:
+            await conn.execute(
+                pg_insert(QueryRowLimit)
+                .values(db_name=db_name, max_rows=max_rows)
+                .on_conflict_do_update(
+                    index_elements=["db_name"], set_={"max_rows": max_rows}
+                )
+            )
+    invalidate_query_setting("max_rows", db_name)
+
+
+async def load_query_timeout(db_name: str) -> float:
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            select(QueryTimeout.timeout).where(QueryTimeout.db_name == db_name)
+        )
+        return result.scalar_one_or_none() or QUERY_TIMEOUT
+
+
+async def get_query_timeout(db_name: str, timeout: float | None = None) -> float:
+    """
+    Get the max number of seconds that a query on a db_name can run for. Call
+    sites can pass their own timeout to lower it, but not to raise it.
+    The db_name's timeout is cached (see utils_cache.get_query_setting).
+    """
+    db_timeout = await get_query_setting("timeout", db_name, lambda: load_query_timeout(db_name))
+    return min(timeout, db_timeout) if timeout else db_timeout
+
+
+async def set_query_timeout(db_name: str, timeout: int | None):
+    """
+    Set the max number of seconds that a query on a db_name can run for, or
+    reset it to QUERY_TIMEOUT if timeout is None.
+    """
+    async with engine.begin() as conn:
+        if timeout is None:
+            await conn.execute(
+                delete(QueryTimeout).where(QueryTimeout.db_name == db_name)
+            )
+        else:
+            await conn.execute(
+                pg_insert(QueryTimeout)
+                .values(db_name=db_name, timeout=timeout)
+                .on_conflict_do_update(
+                    index_elements=["db_name"], set_={"timeout": timeout}
+                )
+            )
+    invalidate_query_setting("timeout", db_name)
+
+
+def add_row_limit(sql: str, db_type: str, max_rows: int) -> str:
+    """
+    Limit the SQL to max_rows + 1 rows (with LIMIT, TOP or FETCH depending on
+    the dialect), so that the database doesn't send more rows than we need and
+    we can tell if there are more than max_rows. SQL that already has a limit
+    of at most max_rows, or that sqlglot can't parse, is returned unchanged.
+    """
+    dialect = "tsql" if db_type == "sqlserver" else db_type
+    try:
+        parsed = parse_one(sql, read=dialect)
+    except Exception as e:
+        LOGGER.debug(f"Could not parse SQL to add a row limit: {str(e)}")
+        return sql
+    if not isinstance(parsed, exp.Query):
+        return sql
+
+    limit = parsed.args.get("limit")
+    if isinstance(limit, exp.Limit):
+        limit = limit.expression
+    elif isinstance(limit, exp.Fetch):
+        limit = limit.args.get("count")
+    if isinstance(limit, exp.Literal) and limit.is_int and int(limit.this) <= max_rows:
+        return sql
+    return parsed.limit(max_rows + 1).sql(dialect=dialect, pretty=True)
+
+
+async def fetch_query_results(
+    db_type: str,
+    db_creds: dict[str, Any],
+    sql: str,
+    max_rows: int = QUERY_MAX_ROWS,
+    chunk_size: int = QUERY_FETCH_CHUNK_SIZE,
+    timeout: float | None = QUERY_TIMEOUT,
+) -> QueryResults:
+    """
+    Run the SQL on the user's database and return at most max_rows rows.
+    The row limit is added to the SQL, and rows are also fetched in chunks
+    (stopping once there are more than max_rows) in case it couldn't be.
+    Each chunk is converted into arrow arrays as soon as it is fetched, so that
+    only one chunk of rows is held as python objects at a time.
+    Raises a QueryTimeoutError if the query (including fetching its rows) takes
+    longer than timeout seconds. The timeout is also set on the database where
+    possible (see utils_connection_pool.run_query_in_chunks), and the query is
+    cancelled otherwise.
+    """
+    sql = add_row_limit(sql, db_type, max_rows)
+    columns, column_chunks, num_rows = [], [], 0
+    try:
+        async with asyncio.timeout(timeout) as deadline:
+            async with aclosing(stream_query(db_type, db_creds, sql, chunk_size, timeout)) as chunks:
+                async for columns, chunk in chunks:
+                    if not column_chunks:
+                        column_chunks = [[] for _ in columns]
+                    chunk = chunk[: max_rows + 1 - num_rows]
+                    for i, arrays in enumerate(column_chunks):
+                        arrays.append(to_arrow_array([row[i] for row in chunk]))
+                    num_rows += len(chunk)
+                    if num_rows > max_rows:
+                        break
+    except TimeoutError as e:
+        if not deadline.expired():
+            raise
+        raise QueryTimeoutError(timeout) from e
+    table = build_arrow_table(columns, column_chunks)
+    return QueryResults(table.slice(0, max_rows), truncated=num_rows > max_rows)
+
+
+async def stream_query_results(
+    db_type: str,
+    db_creds: dict[str, Any],
+    sql: str,
+    max_rows: int = QUERY_MAX_ROWS,
+    chunk_size: int = QUERY_FETCH_CHUNK_SIZE,
+    timeout: float | None = QUERY_TIMEOUT,
+) -> AsyncIterator[str]:
+    """
+    Run the SQL on the user's database and yield at most max_rows rows as
+    newline-delimited JSON: a line with the `columns`, a line with the `rows`
+    of each chunk, and a last line with the `row_count` and whether the results
+    were `truncated` (or with the `error`, if the query failed).
+    The timeout is only set on the database, since the rows are sent to the
+    client as they are fetched.
+    """
+    sql = add_row_limit(sql, db_type, max_rows)
+    row_count, truncated, sent_columns = 0, False, False
+    try:
+        async with aclosing(stream_query(db_type, db_creds, sql, chunk_size, timeout)) as chunks:
+            async for columns, chunk in chunks:
+                if not sent_columns:
+                    yield json.dumps({"columns": columns}) + "\n"
+                    sent_columns = True
+                if row_count + len(chunk) > max_rows:
+                    chunk = chunk[: max_rows - row_count]
+                    truncated = True
+                if chunk:
+                    row_count += len(chunk)
+                    yield json.dumps({"rows": chunk}, default=str) + "\n"
+                if truncated:
+                    break
+    except Exception as e:
+        LOGGER.error(f"Error streaming query results: {str(e)}")
+        yield json.dumps({"error": str(e)}) + "\n"
+        return
+    yield json.dumps({"row_count": row_count, "truncated": truncated}) + "\n"
@@ -0,0 +1,114 @@
+##############################################
+### Schema Context Related Functions Below ###
+##############################################
+
+import asyncio
+
+from pydantic import BaseModel, Field
+from request_models import SchemaFormat, SchemaPruningConfig, TableDescription
+from utils_cache import LRUCache, get_schema_version, register_cache_stats
+from utils_instructions import get_instructions, get_join_hints
+from utils_logging import LOGGER
+from utils_md import get_metadata, get_schema_format, mk_schema_prompt
+from utils_schema_pruning import get_schema_pruning_config
+from utils_table_descriptions import get_all_table_descriptions
+from utils_token_budget import SchemaTokenCounts
+
+# the version counter in redis is the source of truth for invalidation, the ttl
+# is only a safety net in case the counter itself is evicted from redis
+SCHEMA_CONTEXT_CACHE = LRUCache(max_size=64, ttl=600)
+register_cache_stats("schema_context", SCHEMA_CONTEXT_CACHE.stats)
+
+
+class SchemaContext(BaseModel):
+    """
+    Everything about a db_name that we paste into our prompts, along with the
+    schema version it was read at.
+    """
+
+    db_name: str
+    version: int
+    metadata: list[dict[str, str]]
+    table_descriptions: list[TableDescription]
+    instructions: str
+    join_hints: list[list[str]] | None = None
+    pruning_config: SchemaPruningConfig = SchemaPruningConfig()
+    schema_format: SchemaFormat = "ddl"
+    # the schema rendered in schema_format
+    ddl: str
+    # token counts of the schema by schema format and tokenizer, filled in by
+    # `fit_prompt_to_budget` as the schema is first budgeted for each of them
+    token_counts: dict[str, SchemaTokenCounts] = Field(default_factory=dict)
+
+
+async def load_optional(name: str, db_name: str, coro, default):
+    """
+    Await one of the optional parts of the schema context, falling back to its
+    default if it fails, so that SQL can still be generated without it.
+    """
+    try:
+        return await coro
+    except Exception as e:
+        LOGGER.error(f"Error getting {name} for {db_name}, using the default instead: {e}")
+        return default
+
+
+async def load_schema_context(db_name: str, version: int = 0) -> SchemaContext:
+    """
+    Read the schema context for a given db_name from the internal db and render
+    its schema in the db_name's schema format. This always hits the db - use `get_schema_context` instead.
+    Failures to read the instructions, join hints, pruning config or schema
+    format are logged, and their defaults are used instead.
+    """
+    (
+        metadata,
+        table_descriptions,
+        instructions,
+        join_hints,
+        pruning_config,
+        schema_format,
+    ) = await asyncio.gather(
+        get_metadata(db_name),
+        get_all_table_descriptions(db_name),
+        load_optional("instructions", db_name, get_instructions(db_name), ""),
+        load_optional("join hints", db_name, get_join_hints(db_name), None),
+        load_optional("schema pruning config", db_name, get_schema_pruning_config(db_name), SchemaPruningConfig()),
+        load_optional("schema format", db_name, get_schema_format(db_name), "ddl"),
+    )
+    return SchemaContext(
+        db_name=db_name,
+        version=version,
+        metadata=metadata,
+        table_descriptions=table_descriptions,
+        instructions=instructions or "",
+        join_hints=join_hints,
+        pruning_config=pruning_config,
+        schema_format=schema_format,
+        ddl=mk_schema_prompt(metadata, table_descriptions, schema_format),
+    )
+
+
+async def get_schema_context(db_name: str) -> SchemaContext:
+    """
+    Get the schema context for a given db_name, served from an in-process cache
+    as long as the schema version in redis hasn't been bumped by
+    `set_metadata`, `update_table_descriptions`, `set_instructions`,
+    `set_join_hints`, `set_schema_pruning_config` or `set_schema_format` (in
+    any worker).
+    Callers must treat the returned object as read-only since it is shared.
+    """
+    version = get_schema_version(db_name)
+    if version is None:
+        # redis is unavailable, so we can't tell if our cached copy is stale
+        return await load_schema_context(db_name)
+
+    cached = SCHEMA_CONTEXT_CACHE.get(db_name)
+    if cached is not None and cached.version == version:
+        return cached
+
+    LOGGER.debug(f"Loading schema context for {db_name} at version {version}")
+    schema_context = await load_schema_context(db_name, version)
+    # if the version was bumped while we were loading, the stale copy will be
+    # replaced on the next call since its version no longer matches
+    SCHEMA_CONTEXT_CACHE.set(db_name, schema_context)
+    return schema_context
@@ -0,0 +1,251 @@
+##############################################
+### Schema Pruning Related Functions Below ###
+##############################################
+
+import collections
+
+import numpy as np
+from db_config import engine
+from db_models import SchemaPruning
+from request_models import SchemaPruningConfig, TableDescription
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from utils_cache import bump_schema_version
+from utils_column_embeddings import get_closest_columns, get_column_embedding_text
+from utils_embedding import get_embeddings
+from utils_logging import LOGGER
+
+
+async def get_schema_pruning_config(db_name: str) -> SchemaPruningConfig:
+    """
+    Get the schema pruning config for a given db_name.
+    Returns the default (disabled) config if none has been set.
+    """
+    async with engine.begin() as connection:
+        result = await connection.execute(
+            select(SchemaPruning).where(SchemaPruning.db_name == db_name)
+        )
+        row = result.mappings().one_or_none()
+    if row is None:
+        return SchemaPruningConfig()
+    return SchemaPruningConfig(
+        **{
+            field: row[field]
+            for field in SchemaPruningConfig.model_fields
+            if row[field] is not None
+        }
+    )
+
+
+async def set_schema_pruning_config(db_name: str, config: SchemaPruningConfig):
+    """
+    Set the schema pruning config for a given db_name.
+    """
+    values = config.model_dump()
+    async with engine.begin() as connection:
+        await connection.execute(
+            insert(SchemaPruning)
+            .values(db_name=db_name, **values)
+            .on_conflict_do_update(index_elements=["db_name"], set_=values)
+        )
+    bump_schema_version(db_name)
+
+
+def split_table_column(join_key: str) -> tuple[str, str] | None:
+    """
+    Split a join key like `schema.table.column` into (`schema.table`, `column`).
+    """
+    join_key_split = join_key.rsplit(".", 1)
+    if len(join_key_split) != 2:
+        return None
+    return join_key_split[0], join_key_split[1]
+
+
+def mk_join_graph(join_hints: list[list[str]] | None) -> dict[str, set[str]]:
+    """
+    Build an undirected graph of tables from the join hints, where 2 tables
+    are adjacent if any join hint contains a column from each of them.
+    """
+    graph = collections.defaultdict(set)
+    for join_keys in join_hints or []:
+        tables = set()
+        for join_key in join_keys:
+            table_column = split_table_column(join_key)
+            if table_column:
+                tables.add(table_column[0])
+        for table in tables:
+            graph[table].update(tables - {table})
+    return graph
+
+
+def find_join_path(
+    graph: dict[str, set[str]], start: str, end: str, max_hops: int
+) -> list[str] | None:
+    """
+    Returns the shortest list of tables from start to end (inclusive) in the
+    join graph with at most max_hops joins, or None if there is no such path.
+    """
+    if start == end:
+        return [start]
+    parents = {start: None}
+    frontier = [start]
+    for _ in range(max_hops):
+        next_frontier = []
+        for table in frontier:
+            for neighbour in sorted(graph.get(table, ())):
+                if neighbour in parents:
+                    continue
+                parents[neighbour] = table
+                if neighbour == end:
+                    path = [end]
+                    while parents[path[-1]] is not None:
+                        path.append(parents[path[-1]])
+                    return path[::-1]
+                next_frontier.append(neighbour)
+        frontier = next_frontier
+    return None
+
+
+def add_join_path_tables(
+    tables: list[str], graph: dict[str, set[str]], max_hops: int
+) -> list[str]:
+    """
+    Add the tables needed to join each pair of the given tables (if they are
+    at most max_hops joins apart) after the given tables.
+    """
+    tables_with_paths = list(tables)
+    for i, start in enumerate(tables):
+        for end in tables[i + 1 :]:
+            path = find_join_path(graph, start, end, max_hops)
+            for table in path or []:
+                if table not in tables_with_paths:
+                    tables_with_paths.append(table)
+    return tables_with_paths
+
+
+def get_join_key_columns(
+    join_hints: list[list[str]] | None, tables: set[str]
+) -> set[tuple[str, str]]:
+    """
+    Get the (table_name, column_name) of all join keys between the given tables.
+    """
+    join_key_columns = set()
+    for join_keys in join_hints or []:
+        table_columns = [split_table_column(join_key) for join_key in join_keys]
+        table_columns = [tc for tc in table_columns if tc and tc[0] in tables]
+        if len({table for table, _ in table_columns}) > 1:
+            join_key_columns.update(table_columns)
+    return join_key_columns
+
+
+async def score_columns(
+    question_embedding: list[float],
+    metadata: list[dict[str, str]],
+    table_descriptions: list[TableDescription],
+    db_name: str | None = None,
+    num_candidates: int = 300,
+) -> np.ndarray:
+    """
+    Returns the cosine similarity between the question and each column in the
+    metadata (in the same order).
+    If db_name is given, we only look up the num_candidates closest columns in
+    the column embeddings index, and give all other columns a score of -1.
+    We fall back to embedding all of the columns if the index is empty.
+    """
+    if db_name:
+        closest_columns = await get_closest_columns(
+            db_name, question_embedding, num_candidates
+        )
+        if closest_columns:
+            similarities = {
+                (c.table_name, c.column_name): c.similarity for c in closest_columns
+            }
+            return np.array(
+                [
+                    similarities.get((column["table_name"], column["column_name"]), -1.0)
+                    for column in metadata
+                ],
+                dtype=np.float32,
+            )
+        LOGGER.debug(f"No column embeddings found for {db_name}, embedding all columns")
+
+    table_descriptions_dict = {
+        td.table_name: td.table_description for td in table_descriptions
+    }
+    texts = [
+        get_column_embedding_text(column, table_descriptions_dict.get(column["table_name"]))
+        for column in metadata
+    ]
+    column_embeddings = np.array(await get_embeddings(texts), dtype=np.float32)
+    question_embedding = np.array(question_embedding, dtype=np.float32)
+    column_embeddings /= np.linalg.norm(column_embeddings, axis=1, keepdims=True)
+    question_embedding /= np.linalg.norm(question_embedding)
+    return column_embeddings @ question_embedding
+
+
+async def prune_schema(
+    question_embedding: list[float],
+    metadata: list[dict[str, str]],
+    table_descriptions: list[TableDescription],
+    join_hints: list[list[str]] | None,
+    config: SchemaPruningConfig,
+    db_name: str | None = None,
+) -> tuple[list[dict[str, str]], list[TableDescription]]:
+    """
+    Keep only the tables and columns of the schema that are most relevant to
+    the question, and return the pruned metadata and table descriptions:
+    1. Each table is scored by its most similar column to the question, and
+       the top `max_tables` tables are kept.
+    2. Tables on the join path between the kept tables (according to the join
+       hints) are added, so that the LLM knows how to join them.
+    3. For each kept table, the top `max_columns_per_table` columns are kept,
+       along with the join keys between the kept tables.
+    The original order of the metadata is preserved.
+    If db_name is given, the columns are scored with its column embeddings index.
+    """
+    if not config.enabled or len(metadata) <= config.min_columns:
+        return metadata, table_descriptions
+
+    scores = await score_columns(
+        question_embedding,
+        metadata,
+        table_descriptions,
+        db_name=db_name,
+        num_candidates=config.max_tables * config.max_columns_per_table,
+    )
+
+    table_scores = {}
+    table_column_idx = collections.defaultdict(list)
+    for i, column in enumerate(metadata):
+        table_name = column["table_name"]
+        table_scores[table_name] = max(table_scores.get(table_name, -1.0), scores[i])
+        table_column_idx[table_name].append(i)
+
+    top_tables = sorted(table_scores, key=lambda t: table_scores[t], reverse=True)
+    top_tables = top_tables[: config.max_tables]
+    join_graph = mk_join_graph(join_hints)
+    kept_tables = add_join_path_tables(top_tables, join_graph, config.max_join_hops)
+    kept_tables = [table for table in kept_tables if table in table_column_idx]
+    join_key_columns = get_join_key_columns(join_hints, set(kept_tables))
+
+    kept_idx = set()
+    for table_name in kept_tables:
+        column_idx = sorted(
+            table_column_idx[table_name], key=lambda i: scores[i], reverse=True
+        )
+        kept_idx.update(column_idx[: config.max_columns_per_table])
+        kept_idx.update(
+            i
+            for i in column_idx
+            if (table_name, metadata[i]["column_name"]) in join_key_columns
+        )
+
+    pruned_metadata = [column for i, column in enumerate(metadata) if i in kept_idx]
+    pruned_table_descriptions = [
+        td for td in table_descriptions if td.table_name in kept_tables
+    ]
+    LOGGER.debug(
+        f"Pruned schema from {len(metadata)} columns in {len(table_scores)} tables "
+        f"to {len(pruned_metadata)} columns in {len(kept_tables)} tables"
+    )
+    return pruned_metadata, pruned_table_descriptions
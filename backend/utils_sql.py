@@ -1,26 +1,41 @@
+import asyncio
 import collections
 import os
 import re
 import time
 from datetime import datetime
-from typing import Dict, Optional, Tuple
+from typing import Dict, Literal, Optional, Tuple
 
 import pandas as pd
 import sqlparse
 from db_utils import get_db_type_creds
+from defog.llm.cost import CostCalculator
 from defog.llm.utils import chat_async
-from defog.query import async_execute_query_once
 from generic_utils import is_sorry
 from pandas.testing import assert_frame_equal, assert_series_equal
-from request_models import ColumnMetadata, HardFilter, QuestionAnswer, TableDescription
+from request_models import (
+    ColumnMetadata,
+    HardFilter,
+    QuestionAnswer,
+    SchemaFormat,
+    TableDescription,
+)
 from sqlglot import exp, parse_one
-from utils_df import mk_df
+from utils_cache import register_cache_stats
+from utils_df import mk_df_from_arrow
 from utils_embedding import get_embedding
-from utils_golden_queries import get_closest_golden_queries
-from utils_instructions import get_instructions
+from utils_golden_queries import get_closest_golden_queries, match_golden_query
+from utils_hedging import run_hedged
+from utils_instructions import get_relevant_instructions
 from utils_logging import LOGGER, log_timings, save_timing
-from utils_md import get_metadata, mk_create_ddl
+from utils_md import mk_schema_prompt
+from utils_query_cache import fetch_cached_query_results
+from utils_query_results import QUERY_MAX_ROWS, QUERY_TIMEOUT, fetch_query_results
+from utils_schema_context import get_schema_context
+from utils_schema_pruning import prune_schema
+from utils_sql_cache import SQL_CACHE_STATS, cache_sql, get_cached_sql, get_sql_cache_key
 from utils_table_descriptions import get_all_table_descriptions
+from utils_token_budget import TokenBudget, count_tokens, fit_prompt_to_budget
 
 BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
 with open(os.path.join(BACKEND_DIR, "prompts/generate_sql/system.md"), "r") as f:
@@ -35,6 +50,30 @@ with open(os.path.join(BACKEND_DIR, "prompts/fix_sql/system.md"), "r") as f:
 with open(os.path.join(BACKEND_DIR, "prompts/fix_sql/user.md"), "r") as f:
     FIX_SQL_USER_PROMPT = f.read()
 
+# "cache_aware" moves the parts of the prompt that are stable for a db_name (the
+# DDL, guidelines and instructions) into the system message, ahead of the parts
+# that vary per request, so that providers can reuse their cached prefix.
+GENERATE_SQL_PROMPT_LAYOUT = os.getenv("GENERATE_SQL_PROMPT_LAYOUT", "default")
+# the first placeholder in the user prompt that varies per request
+VOLATILE_PROMPT_PLACEHOLDER = "{golden_queries_prompt}"
+
+# token usage of the SQL generation requests in this worker, to verify how much
+# of the prompt is served from the providers' prompt caches
+PROMPT_CACHE_STATS = {"requests": 0, "input_tokens": 0, "cached_input_tokens": 0}
+
+
+def get_prompt_cache_stats() -> dict[str, float]:
+    input_tokens = PROMPT_CACHE_STATS["input_tokens"]
+    return {
+        **PROMPT_CACHE_STATS,
+        "cached_fraction": (
+            PROMPT_CACHE_STATS["cached_input_tokens"] / input_tokens if input_tokens else 0.0
+        ),
+    }
+
+
+register_cache_stats("sql_generation_prompt", get_prompt_cache_stats)
+
 
 UNSAFE_KEYWORDS = ["CREATE", "UPDATE", "DELETE", "DROP", "ALTER", "INSERT"]
 # Combine keywords into one regex pattern for efficiency
@@ -52,9 +91,20 @@ async def execute_sql(
     db_type: str,
     db_creds: Dict,
     sql: str,
+    max_rows: int = QUERY_MAX_ROWS,
+    db_name: Optional[str] = None,
+    use_cache: bool = True,
+    timeout: Optional[float] = None,
 ) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
     """
     Asynchronously run the SQL query on the user's database using SQLAlchemy and return the results as a dataframe.
+    At most max_rows rows are fetched (see utils_query_results.fetch_query_results).
+    Whether the query returned more rows than that is stored in the `truncated` attr of the dataframe.
+    If db_name is given, the results are served from / stored in the query result cache of the db_name
+    (see utils_query_cache), unless use_cache is False. Whether they were served from the cache and
+    how old they are is stored in the `cached` and `cache_age` attrs of the dataframe.
+    The query times out after the timeout of the db_name (or QUERY_TIMEOUT), or after timeout
+    seconds if that is lower, and is cancelled on the database if the calling task is cancelled.
     Returns the error message if any to let upstream caller decide how they want to handle it.
     This is sometimes logged and ignored, or used for iterative generation.
     """
@@ -72,9 +122,19 @@ async def execute_sql(
         return None, err_msg
 
     try:
-        colnames, rows = await async_execute_query_once(db_type, db_creds, sql)
-        data = [list(row) for row in rows]
-        df = mk_df(data, colnames)
+        if db_name:
+            results = await fetch_cached_query_results(
+                db_name, db_type, db_creds, sql, max_rows=max_rows, use_cache=use_cache, timeout=timeout
+            )
+        else:
+            timeout = min(timeout, QUERY_TIMEOUT) if timeout else QUERY_TIMEOUT
+            results = await fetch_query_results(db_type, db_creds, sql, max_rows=max_rows, timeout=timeout)
+        if results.truncated:
+            LOGGER.warning(f"Query returned more than {max_rows} rows, only the first {max_rows} were fetched")
+        df = mk_df_from_arrow(results.table)
+        df.attrs["truncated"] = results.truncated
+        df.attrs["cached"] = results.cached
+        df.attrs["cache_age"] = results.cache_age
     except Exception as e:
         err_msg = f"Error occurred in running SQL: {e}\nSQL: {sql}"
         df = None
@@ -288,6 +348,9 @@ async def compare_query_results(
     Compares the results of two queries and returns a dictionary with the key:
     'correct' indicating if the queries are correct or if the result of the
     generated query is a subset of the golden query.
+    If either result was truncated at the row limit (see the `truncated` attr of
+    `execute_sql`'s dataframe), only some of the rows can be compared, so the
+    comparison is inconclusive: 'correct' is False and 'inconclusive' is True.
     Returns the error message in case of an error.
     """
     correct = False
@@ -297,6 +360,9 @@ async def compare_query_results(
     if err_msg:
         LOGGER.error(err_msg)
         correct = False
+    elif df_gold.attrs.get("truncated") or df_gen.attrs.get("truncated"):
+        LOGGER.warning("Query results were truncated at the row limit, so they can't be compared")
+        return {"correct": False, "inconclusive": True}
     elif df_gold.empty and df_gen.empty:
         correct = False
     elif compare_df(df_gold, df_gen, question, query_gold, query_gen):
@@ -306,140 +372,193 @@ async def compare_query_results(
     return {"correct": correct}
 
 
-def add_schema_to_tables(query, schema):
-    # Parse the query into a SQL AST (Abstract Syntax Tree)
-    tree = parse_one(query)
+# statements that are not allowed anywhere in generated SQL
+UNSAFE_EXPRESSIONS = (
+    exp.Create,
+    exp.Insert,
+    exp.Update,
+    exp.Delete,
+    exp.Drop,
+    exp.Alter,
+    exp.Command,
+    exp.Merge,
+    exp.TruncateTable,
+    exp.Grant,
+    exp.Copy,
+    exp.Into,
+)
+HARD_FILTER_OPERATORS = {
+    "=": exp.EQ,
+    "!=": exp.NEQ,
+    ">": exp.GT,
+    ">=": exp.GTE,
+    "<": exp.LT,
+    "<=": exp.LTE,
+}
+
+
+def get_dialect(db_type: str) -> str:
+    """
+    Get the sqlglot dialect for a given db_type.
+    """
+    return "tsql" if db_type == "sqlserver" else db_type
 
-    # Traverse and modify all table nodes in the AST
-    for node in tree.find_all(exp.Table):
-        # If the table node has a schema, skip it
-        if node.catalog or node.db:
-            continue
-        # Modify the table name by prefixing it with the schema
-        node.set("this", f"{schema}.{node.this}")
 
-    # Return the modified SQL query as a string
-    return tree.sql()
+def extract_sql(response: str) -> str:
+    """
+    Extract the first SQL statement from an LLM response, which may be wrapped
+    in a ```sql code block.
+    """
+    return response.split("```sql", 1)[-1].split(";", 1)[0].replace("```", "").strip()
 
 
-def add_hard_filters(sql: str, hard_filters: list[HardFilter]) -> str:
+def qualify_tables(parsed: exp.Expression, schema: str) -> exp.Expression:
     """
-    Takes in a SQL query and a list of HardFilter objects.
-    For every SELECT that references a table_name from any HardFilter,
-    add conditions (table_alias.column_name operator 'value') into the WHERE.
+    Prefix every table in the AST that doesn't have a schema (and isn't a CTE)
+    with the given schema, in place.
     """
-    if not hard_filters or len(hard_filters) == 0:
-        return sql
-
-    # Parse into sqlglot Expression Tree
-    parsed = parse_one(sql, read="postgres")
+    cte_names = {cte.alias_or_name for cte in parsed.find_all(exp.CTE)}
+    for node in parsed.find_all(exp.Table):
+        if node.catalog or node.db or node.name in cte_names:
+            continue
+        node.set("db", exp.to_identifier(schema))
+    return parsed
 
-    # Map each SELECT node -> {table_name: set_of_aliases}
-    select_table_aliases = {}
 
-    def collect_tables(node, current_select=None):
-        # If this node is a SELECT, mark it as the current SELECT
-        if isinstance(node, exp.Select):
-            current_select = node
-            if current_select not in select_table_aliases:
-                select_table_aliases[current_select] = {}
-
-        # If this node is a table reference, record it in the current SELECT
-        if isinstance(node, exp.Table):
-            table_name = node.name  # e.g. 'my_table'
-            alias = node.alias or table_name
-            if current_select:
-                select_table_aliases[current_select].setdefault(table_name, set()).add(
-                    alias
-                )
+def add_schema_to_tables(query, schema):
+    return qualify_tables(parse_one(query), schema).sql()
 
-        # Recurse into children
-        for value in node.args.values():
-            if isinstance(value, exp.Expression):
-                collect_tables(value, current_select)
-            elif isinstance(value, list):
-                for item in value:
-                    if isinstance(item, exp.Expression):
-                        collect_tables(item, current_select)
-
-    collect_tables(parsed)
-
-    def build_filter_expr(hf: HardFilter, alias: str) -> exp.Expression:
-        """
-        Build something like `alias.column_name = 'value'`.
-        """
-        col = exp.Column(
-            this=exp.to_identifier(hf.column_name),
-            table=exp.to_identifier(alias),
-        )
-        val = exp.Literal.string(hf.value)
-        op_map = {
-            "=": exp.EQ,
-            "!=": exp.NEQ,
-            ">": exp.GT,
-            ">=": exp.GTE,
-            "<": exp.LT,
-            "<=": exp.LTE,
-        }
-        op_class = op_map.get(hf.operator, exp.EQ)
-        return op_class(this=col, expression=val)
 
-    def apply_filters_to_select(select_node: exp.Select):
-        """
-        For a given SELECT node, gather *all* the filters that apply
-        to any tables it references, and AND them all into the WHERE.
-        """
-        if select_node not in select_table_aliases:
-            return
+def apply_hard_filters(
+    parsed: exp.Expression, hard_filters: list[HardFilter] | None
+) -> exp.Expression:
+    """
+    For every SELECT in the AST that references a table_name from any HardFilter,
+    AND the conditions (table_alias.column_name operator 'value') into its WHERE,
+    in place. Tables belong to the closest SELECT that contains them.
+    """
+    if not hard_filters:
+        return parsed
 
-        table_map = select_table_aliases[select_node]
-        # Example: table_map = {"my_table": {"t"}}
+    # Map each SELECT node -> {table_name: aliases}, in a single pass over the tables
+    select_table_aliases = {}
+    for table in parsed.find_all(exp.Table):
+        select_node = table.find_ancestor(exp.Select)
+        if select_node is None:
+            continue
+        aliases = select_table_aliases.setdefault(id(select_node), (select_node, {}))[1]
+        aliases.setdefault(table.name, []).append(table.alias or table.name)
 
-        # Build a list of all new conditions
+    for select_node, table_map in select_table_aliases.values():
+        # Build a list of all new conditions, e.g. t.foo = 'bar', t.baz = 'qux'
         new_conds = []
         for table_name, aliases in table_map.items():
-            # For each HardFilter that mentions `table_name`, build conditions
             for hf in hard_filters:
-                if hf.table_name == table_name:
-                    for alias in aliases:
-                        new_conds.append(build_filter_expr(hf, alias))
-
-        # If no new conditions, do nothing
+                if hf.table_name != table_name:
+                    continue
+                for alias in dict.fromkeys(aliases):
+                    op_class = HARD_FILTER_OPERATORS.get(hf.operator, exp.EQ)
+                    new_conds.append(
+                        op_class(
+                            this=exp.Column(
+                                this=exp.to_identifier(hf.column_name),
+                                table=exp.to_identifier(alias),
+                            ),
+                            expression=exp.Literal.string(hf.value),
+                        )
+                    )
         if not new_conds:
-            return
+            continue
 
-        # Combine them into a single expression with AND
-        # e.g. t.foo = 'bar' AND t.baz = 'qux' AND ...
+        # Combine them into a single expression with AND, and merge with any existing WHERE
         final_new_cond = new_conds[0]
         for cond in new_conds[1:]:
             final_new_cond = exp.And(this=final_new_cond, expression=cond)
-
-        # Merge with existing WHERE
         existing_where = select_node.args.get("where")
         if existing_where:
-            combined = exp.And(this=existing_where.this, expression=final_new_cond)
-            select_node.set("where", exp.Where(this=combined))
-        else:
-            select_node.set("where", exp.Where(this=final_new_cond))
+            final_new_cond = exp.And(this=existing_where.this, expression=final_new_cond)
+        select_node.set("where", exp.Where(this=final_new_cond))
+    return parsed
 
-    def walk(node):
-        # If it's a SELECT, apply all relevant filters at once
-        if isinstance(node, exp.Select):
-            apply_filters_to_select(node)
 
-        # Recurse to children
-        for k, v in node.args.items():
-            if isinstance(v, exp.Expression):
-                walk(v)
-            elif isinstance(v, list):
-                for x in v:
-                    if isinstance(x, exp.Expression):
-                        walk(x)
+def add_hard_filters(sql: str, hard_filters: list[HardFilter]) -> str:
+    """
+    Takes in a SQL query and a list of HardFilter objects.
+    For every SELECT that references a table_name from any HardFilter,
+    add conditions (table_alias.column_name operator 'value') into the WHERE.
+    """
+    if not hard_filters or len(hard_filters) == 0:
+        return sql
+    parsed = parse_one(sql, read="postgres")
+    return apply_hard_filters(parsed, hard_filters).sql(dialect="postgres")
+
+
+def fix_nullif_division(parsed: exp.Expression) -> exp.Expression:
+    """
+    Rewrite `x / NULLIF(y, 0)` as `x / NULLIF(1.0 * y, 0)` in place, so that
+    the division is never an integer division.
+    """
+    for div in parsed.find_all(exp.Div):
+        nullif = div.expression
+        if isinstance(nullif, exp.Nullif) and not (
+            isinstance(nullif.this, exp.Mul)
+            and isinstance(nullif.this.this, exp.Literal)
+            and nullif.this.this.name == "1.0"
+        ):
+            nullif.set(
+                "this", exp.Mul(this=exp.Literal.number("1.0"), expression=nullif.this)
+            )
+    return parsed
+
+
+def is_safe_ast(parsed: exp.Expression) -> bool:
+    """
+    Check that the AST is a single read-only query.
+    """
+    if not isinstance(parsed, exp.Query):
+        return False
+    return parsed.find(*UNSAFE_EXPRESSIONS) is None
 
-    # Walk the AST once, applying filters to each SELECT node
-    walk(parsed)
 
-    return parsed.sql(dialect="postgres")
+def postprocess_sql(
+    sql: str,
+    db_type: str,
+    hard_filters: list[HardFilter] | None = None,
+    schema: str | None = None,
+) -> tuple[Optional[str], Optional[str]]:
+    """
+    Post-process generated SQL by parsing it once in the dialect of the db_type,
+    applying these transforms to the AST, and rendering it once:
+    - adding the hard filters (see `apply_hard_filters`)
+    - qualifying tables without a schema with `schema`, if given
+    - making divisions by NULLIF(...) float divisions
+    - checking that it is a read-only query
+    If sqlglot can't parse the SQL (it doesn't support every dialect-specific
+    feature), we fall back to `clean_generated_query` and `safe_sql`, unless
+    hard filters have to be added.
+    Returns the processed SQL and the error message if any.
+    """
+    dialect = get_dialect(db_type)
+    # LLMs sometimes split comparison operators, which sqlglot can't parse
+    sql = sql.replace("< =", "<=").replace("> =", ">=")
+    try:
+        parsed = parse_one(sql, read=dialect)
+    except Exception as e:
+        if hard_filters:
+            return None, f"Failed to add hard filters to SQL: {str(e)}"
+        LOGGER.debug(f"Could not parse SQL with sqlglot, cleaning it as text: {str(e)}")
+        sql = clean_generated_query(sql)
+        if not safe_sql(sql):
+            return None, "Unsafe SQL query"
+        return sql, None
+
+    if not is_safe_ast(parsed):
+        return None, "Unsafe SQL query"
+    apply_hard_filters(parsed, hard_filters)
+    if schema:
+        qualify_tables(parsed, schema)
+    fix_nullif_division(parsed)
+    return parsed.sql(dialect=dialect, pretty=True), None
 
 
 def get_messages(
@@ -452,9 +571,17 @@ def get_messages(
     user_prompt: str,
     previous_context: list[QuestionAnswer] | None = None,
     golden_queries_prompt: str = "",
+    layout: Literal["default", "cache_aware"] = "default",
 ):
     """
     Creates messages for the chatbot.
+    With the "default" layout, the previous context comes between the system
+    prompt and the user prompt.
+    With the "cache_aware" layout, the part of the user prompt before
+    `{golden_queries_prompt}` is appended to the system prompt, so that the
+    messages start with a prefix that only changes when the schema or
+    instructions change. The previous context and the rest of the user prompt
+    come after it.
     """
     system_prompt = system_prompt.format(db_type=db_type, date_today=date_today)
     previous_messages = []
@@ -476,12 +603,18 @@ def get_messages(
                 }
             )
 
-    user_prompt = user_prompt.format(
-        user_question=user_question,
-        table_metadata_ddl=table_metadata_ddl,
-        instructions=instructions,
-        golden_queries_prompt=golden_queries_prompt,
-    )
+    prompt_args = {
+        "user_question": user_question,
+        "table_metadata_ddl": table_metadata_ddl,
+        "instructions": instructions,
+        "golden_queries_prompt": golden_queries_prompt,
+    }
+    if layout == "cache_aware" and VOLATILE_PROMPT_PLACEHOLDER in user_prompt:
+        stable_prompt, volatile_prompt = user_prompt.split(VOLATILE_PROMPT_PLACEHOLDER, 1)
+        system_prompt = system_prompt + "\n\n" + stable_prompt.format(**prompt_args).strip()
+        user_prompt = (VOLATILE_PROMPT_PLACEHOLDER + volatile_prompt).format(**prompt_args).strip()
+    else:
+        user_prompt = user_prompt.format(**prompt_args)
 
     messages = (
         [{"role": "system", "content": system_prompt}]
@@ -493,6 +626,53 @@ def get_messages(
     return messages
 
 
+def add_cache_breakpoints(messages: list[dict], provider: str) -> list[dict]:
+    """
+    Mark the end of the system message and of the previous context as cache
+    breakpoints for providers that need them to be explicit (Anthropic).
+    OpenAI caches the longest matching prefix automatically, so the messages
+    are returned as is for other providers.
+    """
+    if provider != "anthropic":
+        return messages
+    messages = [dict(message) for message in messages]
+    breakpoints = [0]
+    if len(messages) > 2:
+        # the last message of the previous context
+        breakpoints.append(len(messages) - 2)
+    for i in breakpoints:
+        messages[i]["content"] = [
+            {
+                "type": "text",
+                "text": messages[i]["content"],
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
+    return messages
+
+
+def sql_parses(sql: str, db_type: str) -> bool:
+    """
+    Check if sqlglot can parse the SQL in the dialect of the given db_type.
+    """
+    try:
+        parse_one(sql, read=get_dialect(db_type))
+        return True
+    except Exception:
+        return False
+
+
+def estimate_input_cost_in_cents(messages: list[dict], model_name: str) -> float | None:
+    """
+    Estimate the cost of sending the messages to a model, without any output,
+    e.g. for a hedged request that was cancelled before it reported its usage.
+    Prompt caching discounts are ignored. Returns None if the pricing of the
+    model isn't known.
+    """
+    input_tokens = sum(count_tokens(message["content"], model_name) for message in messages)
+    return CostCalculator.calculate_cost(model_name, input_tokens, 0)
+
+
 def clean_generated_query(query: str):
     """
     Clean up the generated query by
@@ -525,11 +705,35 @@ async def generate_sql_query(
     num_golden_queries: int = 4,
     provider: str = "openai",
     model_name: str = "o3-mini",
+    cache: Literal["use", "bypass"] = "use",
+    hedge_provider: str = None,
+    hedge_model_name: str = None,
+    hedge_delay: float = 5.0,
+    prompt_layout: Literal["default", "cache_aware"] = GENERATE_SQL_PROMPT_LAYOUT,
+    token_budget: TokenBudget = None,
+    schema_format: SchemaFormat = None,
 ):
     """
     Generate SQL query for a given question, using an LLM.
     if db_type, metadata, and instructions are explicitly provided, they are used as is.
     Else, we use the db_name to extract the db_type, metadata, and instructions.
+    If all of the context comes from the db_name, previously generated SQL for the
+    exact same inputs is returned from the cache, unless `cache` is "bypass" (in
+    which case the newly generated SQL still replaces the cached SQL).
+    If there are no hard filters or previous context and the closest golden query
+    is similar enough to the question, its SQL (with any differing literal values
+    substituted) is returned without calling the LLM.
+    Large schemas from the db_name are pruned to the tables and columns most
+    relevant to the question if schema pruning is enabled for the db_name, and
+    long instructions from the db_name are cut down to the pinned rules and the
+    rules most relevant to the question (see `get_relevant_instructions`).
+    If hedge_model_name is given and the LLM hasn't returned usable SQL within
+    hedge_delay seconds, we also ask hedge_model_name (with hedge_provider, which
+    defaults to provider) and return whichever valid SQL comes back first.
+    prompt_layout controls the order of the messages (see `get_messages`).
+    The prompt is trimmed to fit token_budget (see `fit_prompt_to_budget`).
+    The schema is rendered in schema_format if given, else in the db_name's
+    schema format (or as DDL if the metadata is provided).
     Returns the generated SQL query and the error message if any.
     """
     t_start, timings = time.time(), []
@@ -541,83 +745,233 @@ async def generate_sql_query(
         return {"sql": None, "error": "Either db_name or db_type must be provided"}
 
     using_db_metadata = metadata is None or len(metadata) == 0
+    # we only cache when all of the schema context comes from the db, since the
+    # cache is invalidated by changes to the db's schema context version.
+    # Bypassing the cache skips the lookup, but still stores the fresh SQL.
+    use_sql_cache = using_db_metadata and not table_descriptions and not instructions
+    if hedge_model_name:
+        hedge_provider = hedge_provider or provider
+    if cache == "bypass":
+        SQL_CACHE_STATS["bypassed"] += 1
+    # read once, so that the prompt and the cache key agree on the date
+    date_today = datetime.now().strftime("%Y-%m-%d")
+
+    # The lookups below are independent of each other, so we fan them out
+    # concurrently instead of paying for each internal-db / embedding round trip
+    # one after another. Each branch records its own timing.
+    async def timed(coro, msg: str):
+        t_branch = time.time()
+        result = await coro
+        save_timing(t_branch, msg, timings)
+        return result
+
+    async def fetch_golden_queries() -> tuple[list[float], list]:
+        # errors from embedding the question are propagated to the caller,
+        # while errors from retrieving the golden queries are not fatal
+        question_embedding = await timed(get_embedding(question), "Embedded question")
+        golden_queries = []
+        try:
+            golden_queries = await timed(
+                get_closest_golden_queries(
+                    db_name=db_name,
+                    question_embedding=question_embedding,
+                    num_queries=num_golden_queries,
+                ),
+                "Retrieved golden queries",
+            )
+        except Exception as e:
+            LOGGER.warning(f"Error retrieving golden queries: {str(e)}")
+            # Continue without golden queries
+        return question_embedding, golden_queries
+
+    async def skip(value=None):
+        return value
+
+    (
+        db_creds_result,
+        schema_context,
+        db_table_descriptions,
+        golden_queries_result,
+    ) = await asyncio.gather(
+        timed(get_db_type_creds(db_name), "Retrieved db type")
+        if not db_type
+        else skip(),
+        timed(get_schema_context(db_name), "Retrieved schema context")
+        if using_db_metadata
+        else skip(),
+        timed(get_all_table_descriptions(db_name), "Retrieved table descriptions")
+        if not table_descriptions and not using_db_metadata
+        else skip(),
+        fetch_golden_queries() if using_db_metadata else skip((None, [])),
+        return_exceptions=True,
+    )
+    t_start = save_timing(t_start, "Fetched schema context", timings)
 
-    try:
-        if not db_type:
-            db_creds_result = await get_db_type_creds(db_name)
-            if not db_creds_result:
-                return {"sql": None, "error": f"Database '{db_name}' not found or credentials not configured"}
-            db_type, _ = db_creds_result
-    except Exception as e:
-        LOGGER.error(f"Error retrieving database credentials: {str(e)}")
-        return {"sql": None, "error": f"Failed to retrieve database credentials: {str(e)}"}
-
-    try:
-        if using_db_metadata:
-            metadata = await get_metadata(db_name)
-            if not metadata:
-                return {"sql": None, "error": f"No metadata found for database '{db_name}'"}
-    except Exception as e:
-        LOGGER.error(f"Error retrieving metadata: {str(e)}")
-        return {"sql": None, "error": f"Failed to retrieve metadata: {str(e)}"}
-
-    try:
-        if not table_descriptions:
-            table_descriptions = await get_all_table_descriptions(db_name)
-    except Exception as e:
-        LOGGER.error(f"Error retrieving table descriptions: {str(e)}")
-        return {"sql": None, "error": f"Failed to retrieve table descriptions: {str(e)}"}
-
-    try:
+    if not db_type:
+        if isinstance(db_creds_result, Exception):
+            LOGGER.error(f"Error retrieving database credentials: {str(db_creds_result)}")
+            return {"sql": None, "error": f"Failed to retrieve database credentials: {str(db_creds_result)}"}
+        if not db_creds_result:
+            return {"sql": None, "error": f"Database '{db_name}' not found or credentials not configured"}
+        db_type, _ = db_creds_result
+
+    # the cached DDL can only be used if the table descriptions also come from the db
+    combined_metadata_ddl = None
+    schema_token_counts = None
+    using_db_instructions = False
+    if using_db_metadata:
+        if isinstance(schema_context, Exception):
+            LOGGER.error(f"Error retrieving metadata: {str(schema_context)}")
+            return {"sql": None, "error": f"Failed to retrieve metadata: {str(schema_context)}"}
+        metadata = schema_context.metadata
+        if not metadata:
+            return {"sql": None, "error": f"No metadata found for database '{db_name}'"}
         if not instructions:
-            if using_db_metadata:
-                instructions = await get_instructions(db_name)
-    except Exception as e:
-        LOGGER.error(f"Error retrieving instructions: {str(e)}")
-        instructions = ""
-        # Continue without instructions
-
-    golden_queries_prompt = ""
+            instructions = schema_context.instructions
+            using_db_instructions = True
+        if not table_descriptions:
+            table_descriptions = schema_context.table_descriptions
+            schema_token_counts = schema_context.token_counts
+            if not schema_format or schema_format == schema_context.schema_format:
+                combined_metadata_ddl = schema_context.ddl
+        if not schema_format:
+            schema_format = schema_context.schema_format
+    elif not table_descriptions:
+        if isinstance(db_table_descriptions, Exception):
+            LOGGER.error(f"Error retrieving table descriptions: {str(db_table_descriptions)}")
+            return {"sql": None, "error": f"Failed to retrieve table descriptions: {str(db_table_descriptions)}"}
+        table_descriptions = db_table_descriptions
+    schema_format = schema_format or "ddl"
+
+    if isinstance(golden_queries_result, Exception):
+        LOGGER.error(f"Error generating question embedding: {str(golden_queries_result)}")
+        return {"sql": None, "error": f"Failed to generate embedding for question: {str(golden_queries_result)}"}
+    question_embedding, golden_queries = golden_queries_result
+
+    # near-duplicates of a golden question are answered with its SQL directly.
+    # hard filters and previous context can change the meaning of the question,
+    # so we always defer to the LLM when they are present.
+    if not hard_filters and not previous_context:
+        golden_match = match_golden_query(question, golden_queries)
+        if golden_match is not None:
+            golden_query, golden_sql = golden_match
+            if safe_sql(golden_sql):
+                LOGGER.info(
+                    f"Using golden query `{golden_query.question}` (similarity {golden_query.similarity:.3f})"
+                )
+                t_start = save_timing(t_start, "Matched golden query", timings)
+                log_timings(timings)
+                return {
+                    "sql": golden_sql,
+                    "error": None,
+                    "cached": False,
+                    "golden_query": golden_query.question,
+                }
 
-    if using_db_metadata:
-        try:
-            question_embedding = await get_embedding(question)
-            t_start = save_timing(t_start, "Embedded question", timings)
-        except Exception as e:
-            LOGGER.error(f"Error generating question embedding: {str(e)}")
-            return {"sql": None, "error": f"Failed to generate embedding for question: {str(e)}"}
+    sql_cache_key = None
+    if use_sql_cache:
+        sql_cache_key = get_sql_cache_key(
+            question=question,
+            db_name=db_name,
+            db_type=db_type,
+            hard_filters=hard_filters,
+            previous_context=previous_context,
+            provider=provider,
+            model_name=model_name,
+            num_golden_queries=num_golden_queries,
+            schema_format=schema_format,
+            hedge_provider=hedge_provider if hedge_model_name else None,
+            hedge_model_name=hedge_model_name,
+            date_today=date_today,
+            token_budget=token_budget or TokenBudget(),
+            prompt_layout=prompt_layout,
+        )
+        cached_sql = (
+            get_cached_sql(sql_cache_key) if sql_cache_key and cache != "bypass" else None
+        )
+        if cached_sql:
+            t_start = save_timing(t_start, "Retrieved cached SQL", timings)
+            log_timings(timings)
+            return {"sql": cached_sql, "error": None, "cached": True}
+
+    # only send the instructions that are relevant to the question for long
+    # instructions from the db. If retrieval fails, we fall back to all of them.
+    if using_db_instructions:
+        instructions = await get_relevant_instructions(
+            db_name, question, instructions, question_embedding
+        )
+        t_start = save_timing(t_start, "Retrieved relevant instructions", timings)
 
+    # only send the tables and columns that are relevant to the question for
+    # large schemas. If pruning fails, we fall back to the full schema.
+    if using_db_metadata and schema_context.pruning_config.enabled:
         try:
-            golden_queries = await get_closest_golden_queries(
-                db_name=db_name,
+            pruned_metadata, pruned_table_descriptions = await prune_schema(
                 question_embedding=question_embedding,
-                num_queries=num_golden_queries,
+                metadata=metadata,
+                table_descriptions=table_descriptions,
+                join_hints=schema_context.join_hints,
+                config=schema_context.pruning_config,
+                db_name=db_name,
             )
-            t_start = save_timing(t_start, "Retrieved golden queries", timings)
-
-            for i, golden_query in enumerate(golden_queries):
-                golden_queries_prompt += f"Example question {i+1}: {golden_query.question}\nExample query {i+1}:\n```sql\n{golden_query.sql}\n```\n\n"
-
-            if golden_queries_prompt != "":
-                golden_queries_prompt = (
-                    "The following are some potentially relevant questions and their corresponding SQL queries:\n\n"
-                    + golden_queries_prompt
-                )
+            if len(pruned_metadata) < len(metadata):
+                metadata = pruned_metadata
+                table_descriptions = pruned_table_descriptions
+                combined_metadata_ddl = None
+            t_start = save_timing(t_start, "Pruned schema", timings)
         except Exception as e:
-            LOGGER.warning(f"Error retrieving golden queries: {str(e)}")
-            # Continue without golden queries
+            LOGGER.warning(f"Error pruning schema, using the full schema: {str(e)}")
 
     try:
-        combined_metadata_ddl = mk_create_ddl(metadata, table_descriptions)
-        t_start = save_timing(t_start, "Created metadata DDL", timings)
+        if combined_metadata_ddl is None:
+            combined_metadata_ddl = mk_schema_prompt(
+                metadata, table_descriptions, schema_format
+            )
+            t_start = save_timing(t_start, "Created metadata DDL", timings)
     except Exception as e:
         LOGGER.error(f"Error creating metadata DDL: {str(e)}")
         return {"sql": None, "error": f"Failed to create metadata DDL: {str(e)}"}
 
+    # trim the variable sections of the prompt to fit the token budget
+    try:
+        budgeted_prompt = await fit_prompt_to_budget(
+            model_name=model_name,
+            question=question,
+            fixed_text=GENERATE_SQL_SYSTEM_PROMPT + GENERATE_SQL_USER_PROMPT + question,
+            metadata=metadata,
+            table_descriptions=table_descriptions,
+            ddl=combined_metadata_ddl,
+            instructions=instructions,
+            golden_queries=golden_queries,
+            previous_context=previous_context,
+            budget=token_budget,
+            question_embedding=question_embedding,
+            db_name=db_name if using_db_metadata else None,
+            schema_format=schema_format,
+            token_counts=schema_token_counts,
+        )
+        combined_metadata_ddl = budgeted_prompt.ddl
+        instructions = budgeted_prompt.instructions
+        golden_queries = budgeted_prompt.golden_queries
+        previous_context = budgeted_prompt.previous_context
+        t_start = save_timing(t_start, "Fit prompt to token budget", timings)
+    except Exception as e:
+        LOGGER.warning(f"Error fitting prompt to token budget, using the full prompt: {str(e)}")
+
+    golden_queries_prompt = ""
+    for i, golden_query in enumerate(golden_queries):
+        golden_queries_prompt += f"Example question {i+1}: {golden_query.question}\nExample query {i+1}:\n```sql\n{golden_query.sql}\n```\n\n"
+
+    if golden_queries_prompt != "":
+        golden_queries_prompt = (
+            "The following are some potentially relevant questions and their corresponding SQL queries:\n\n"
+            + golden_queries_prompt
+        )
+
     try:
         messages = get_messages(
             db_type=db_type,
-            date_today=datetime.now().strftime("%Y-%m-%d"),
+            date_today=date_today,
             instructions=instructions,
             user_question=question,
             table_metadata_ddl=combined_metadata_ddl,
@@ -625,65 +979,158 @@ async def generate_sql_query(
             user_prompt=GENERATE_SQL_USER_PROMPT,
             previous_context=previous_context,
             golden_queries_prompt=golden_queries_prompt,
+            layout=prompt_layout,
         )
     except Exception as e:
         LOGGER.error(f"Error formatting messages: {str(e)}")
         return {"sql": None, "error": f"Failed to format messages: {str(e)}"}
 
-    try:
-        query = await chat_async(
-            provider=provider,
-            model=model_name,
-            messages=messages,
-            # if model_name is a reasoning model, the temperature param will automatically be deleted in the request
-            # else, we want to use temperature=0
-            temperature=0.0,
-            # for reasoning models, we want to use low reasoning effort
-            # for non-reasoning models, this param will be ignored
-            reasoning_effort="low",
-        )
-
-        LOGGER.info(
-            "latency of query generation in seconds: " + "{:.2f}".format(query.time) + "s"
-        )
-        LOGGER.info("cost of query in cents: " + "{:.2f}".format(query.cost_in_cents) + "¢")
-    except Exception as e:
-        LOGGER.error(f"Error generating query with LLM: {str(e)}")
-        return {"sql": None, "error": f"Failed to generate SQL query with LLM: {str(e)}"}
+    async def generate_candidate(provider: str, model_name: str) -> dict:
+        # errors are returned instead of raised, so that a failed candidate
+        # doesn't cancel the other candidate when hedging
+        candidate = {"sql": None, "error": None, "provider": provider, "model_name": model_name, "cost_in_cents": None, "usage": None}
+        try:
+            query = await chat_async(
+                provider=provider,
+                model=model_name,
+                messages=add_cache_breakpoints(messages, provider),
+                # if model_name is a reasoning model, the temperature param will automatically be deleted in the request
+                # else, we want to use temperature=0
+                temperature=0.0,
+                # for reasoning models, we want to use low reasoning effort
+                # for non-reasoning models, this param will be ignored
+                reasoning_effort="low",
+            )
+            candidate["cost_in_cents"] = query.cost_in_cents
+            candidate["usage"] = {
+                "input_tokens": query.input_tokens,
+                "cached_input_tokens": query.cached_input_tokens or 0,
+                "output_tokens": query.output_tokens,
+            }
+            PROMPT_CACHE_STATS["requests"] += 1
+            PROMPT_CACHE_STATS["input_tokens"] += query.input_tokens or 0
+            PROMPT_CACHE_STATS["cached_input_tokens"] += query.cached_input_tokens or 0
+            LOGGER.info(
+                f"cached input tokens: {query.cached_input_tokens or 0} / {query.input_tokens}"
+            )
 
-    try:
-        sql_generated = query.content
-        sql_generated = (
-            sql_generated.split("```sql", 1)[-1].split(";", 1)[0].replace("```", "").strip()
-        )
-    except Exception as e:
-        LOGGER.error(f"Error extracting SQL from LLM response: {str(e)}")
-        return {"sql": None, "error": f"Failed to extract SQL from LLM response: {str(e)}"}
+            LOGGER.info(
+                f"latency of query generation with {model_name} in seconds: " + "{:.2f}".format(query.time) + "s"
+            )
+            LOGGER.info("cost of query in cents: " + "{:.2f}".format(query.cost_in_cents) + "¢")
+        except Exception as e:
+            LOGGER.error(f"Error generating query with LLM: {str(e)}")
+            candidate["error"] = f"Failed to generate SQL query with LLM: {str(e)}"
+            return candidate
 
-    try:
-        sql_generated = add_hard_filters(sql_generated, hard_filters)
-    except Exception as e:
-        LOGGER.error(f"Error adding hard filters: {str(e)}")
-        return {"sql": None, "error": f"Failed to add hard filters to SQL: {str(e)}"}
+        try:
+            sql_generated = extract_sql(query.content)
+        except Exception as e:
+            LOGGER.error(f"Error extracting SQL from LLM response: {str(e)}")
+            candidate["error"] = f"Failed to extract SQL from LLM response: {str(e)}"
+            return candidate
 
-    try:
-        sql_generated = clean_generated_query(sql_generated)
-    except Exception as e:
-        LOGGER.error(f"Error cleaning generated query: {str(e)}")
-        return {"sql": None, "error": f"Failed to clean generated SQL: {str(e)}"}
+        try:
+            sql_generated, err_msg = postprocess_sql(sql_generated, db_type, hard_filters)
+        except Exception as e:
+            LOGGER.error(f"Error post-processing generated query: {str(e)}")
+            candidate["error"] = f"Failed to post-process generated SQL: {str(e)}"
+            return candidate
+        if err_msg:
+            LOGGER.error(f"{err_msg}: {query.content}")
+            candidate["error"] = err_msg
+            return candidate
+
+        candidate["sql"] = sql_generated
+        return candidate
+
+    hedge_info = None
+    if hedge_model_name:
+        hedged = await run_hedged(
+            primary=lambda: generate_candidate(provider, model_name),
+            hedge=lambda: generate_candidate(hedge_provider, hedge_model_name),
+            delay=hedge_delay,
+            # when racing, a candidate only wins if its SQL also parses
+            is_success=lambda c: c["error"] is None and sql_parses(c["sql"], db_type),
+        )
+        if hedged.winner is not None:
+            candidate = hedged.result
+        else:
+            # neither candidate parses, so fall back to the first one without
+            # an error (sqlglot doesn't support every dialect-specific feature)
+            candidate = next(
+                (
+                    outcome
+                    for outcome in (hedged.outcomes.get("primary"), hedged.outcomes.get("hedge"))
+                    if isinstance(outcome, dict) and outcome["error"] is None
+                ),
+                hedged.outcomes["primary"],
+            )
+        # the spend of every candidate that was sent. Candidates that were
+        # cancelled before they finished don't report their usage, so only the
+        # cost of their input is estimated.
+        candidates = {}
+        for name, candidate_provider, candidate_model_name in [
+            ("primary", provider, model_name),
+            ("hedge", hedge_provider, hedge_model_name),
+        ]:
+            outcome = hedged.outcomes.get(name)
+            if isinstance(outcome, dict):
+                candidates[name] = {
+                    "provider": candidate_provider,
+                    "model_name": candidate_model_name,
+                    "cancelled": False,
+                    "usage": outcome["usage"],
+                    "cost_in_cents": outcome["cost_in_cents"],
+                }
+            elif name in hedged.cancelled:
+                candidates[name] = {
+                    "provider": candidate_provider,
+                    "model_name": candidate_model_name,
+                    "cancelled": True,
+                    "usage": None,
+                    "cost_in_cents": None,
+                    "estimated_input_cost_in_cents": estimate_input_cost_in_cents(
+                        messages, candidate_model_name
+                    ),
+                }
+        hedge_info = {
+            "fired": hedged.hedge_fired,
+            "winner": hedged.winner,
+            "provider": hedge_provider,
+            "model_name": hedge_model_name,
+            "delay": hedge_delay,
+            "candidates": candidates,
+            # actual costs of finished candidates plus estimated costs of
+            # cancelled ones
+            "total_cost_in_cents": sum(
+                (c["cost_in_cents"] if not c["cancelled"] else c["estimated_input_cost_in_cents"]) or 0
+                for c in candidates.values()
+            ),
+        }
+        LOGGER.info(f"Hedged SQL generation: {hedge_info}")
+    else:
+        candidate = await generate_candidate(provider, model_name)
+    t_start = save_timing(t_start, "Generated SQL", timings)
 
     log_timings(timings)
 
-    try:
-        if not safe_sql(sql_generated):
-            LOGGER.error(f"Unsafe SQL query: {sql_generated}")
-            error_msg = "Unsafe SQL query"
-            return {"sql": None, "error": error_msg}
-        else:
-            return {"sql": sql_generated, "error": None}
-    except Exception as e:
-        LOGGER.error(f"Error validating SQL safety: {str(e)}")
-        return {"sql": None, "error": f"Failed to validate SQL safety: {str(e)}"}
+    if candidate["error"] is not None:
+        return {"sql": None, "error": candidate["error"]}
+    if sql_cache_key:
+        cache_sql(sql_cache_key, candidate["sql"])
+    resp = {
+        "sql": candidate["sql"],
+        "error": None,
+        "cached": False,
+        "provider": candidate["provider"],
+        "model_name": candidate["model_name"],
+        "usage": candidate["usage"],
+    }
+    if hedge_info:
+        resp["hedge"] = hedge_info
+    return resp
+
 
 async def retry_query_after_error(
     question: str,
@@ -694,16 +1141,34 @@ async def retry_query_after_error(
     db_type: str = None,
     provider: str = "openai",
     model_name: str = "gpt-4o",
+    token_budget: TokenBudget = None,
+    schema_format: SchemaFormat = None,
 ) -> Optional[str]:
     """
     Fix the error that occurred while generating SQL / executing the query.
+    The DDL is trimmed to the tables most relevant to the question if the
+    prompt would exceed token_budget. It is rendered in schema_format if given,
+    else in the db_name's schema format (or as DDL if the metadata is provided).
     Returns the fixed sql query if successful, else None.
     """
     if not db_type:
         db_type, _ = await get_db_type_creds(db_name)
 
     if not metadata or len(metadata) == 0:
-        metadata = await get_metadata(db_name)
+        schema_context = await get_schema_context(db_name)
+        metadata = schema_context.metadata
+        table_descriptions = schema_context.table_descriptions
+        schema_token_counts = schema_context.token_counts
+        if not schema_format or schema_format == schema_context.schema_format:
+            metadata_ddl = schema_context.ddl
+            schema_format = schema_context.schema_format
+        else:
+            metadata_ddl = mk_schema_prompt(metadata, table_descriptions, schema_format)
+    else:
+        table_descriptions = []
+        schema_token_counts = None
+        schema_format = schema_format or "ddl"
+        metadata_ddl = mk_schema_prompt(metadata, table_descriptions, schema_format)
 
     if not metadata or len(metadata) == 0:
         LOGGER.error("No metadata found while fixing SQL query")
@@ -712,7 +1177,22 @@ async def retry_query_after_error(
             "error": "No metadata found",
         }
 
-    metadata_ddl = mk_create_ddl(metadata)
+    try:
+        budgeted_prompt = await fit_prompt_to_budget(
+            model_name=model_name,
+            question=question,
+            fixed_text=FIX_SQL_SYSTEM_PROMPT + FIX_SQL_USER_PROMPT + question + (sql or "") + (error or ""),
+            metadata=metadata,
+            table_descriptions=table_descriptions,
+            ddl=metadata_ddl,
+            budget=token_budget,
+            db_name=db_name,
+            schema_format=schema_format,
+            token_counts=schema_token_counts,
+        )
+        metadata_ddl = budgeted_prompt.ddl
+    except Exception as e:
+        LOGGER.warning(f"Error fitting prompt to token budget, using the full prompt: {str(e)}")
 
     system_prompt = FIX_SQL_SYSTEM_PROMPT.format(db_type=db_type)
     user_prompt = FIX_SQL_USER_PROMPT.format(
@@ -745,18 +1225,14 @@ async def retry_query_after_error(
         + "¢"
     )
 
-    sql_generated = query.content
-    sql_generated = (
-        sql_generated.split("```sql", 1)[-1].split(";", 1)[0].replace("```", "").strip()
-    )
-    sql_generated = clean_generated_query(sql_generated)
+    sql_generated, err_msg = postprocess_sql(extract_sql(query.content), db_type)
 
-    if not safe_sql(sql_generated):
-        LOGGER.error("Unsafe SQL query")
-        LOGGER.info(sql_generated)
+    if err_msg:
+        LOGGER.error(err_msg)
+        LOGGER.info(query.content)
         return {
             "sql": None,
-            "error": "Unsafe SQL query",
+            "error": err_msg,
         }
     else:
         return {
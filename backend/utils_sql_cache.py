@@ -0,0 +1,120 @@
+###########################################
+### SQL Generation Cache Functions Below ###
+###########################################
+
+import hashlib
+import json
+import os
+from typing import Any
+
+import redis
+from db_config import redis_client
+from pydantic import BaseModel
+from utils_cache import (
+    get_golden_queries_version,
+    get_schema_version,
+    register_cache_stats,
+)
+from utils_logging import LOGGER
+
+# generated SQL is cached in redis (shared across workers). The cache key
+# includes the schema and golden queries versions, so changing the metadata,
+# instructions or golden queries of a db implicitly invalidates its entries.
+# It also includes today's date (which is in the prompt), so entries only
+# live until the end of the day even if SQL_CACHE_TTL is longer.
+SQL_CACHE_TTL = int(os.getenv("SQL_CACHE_TTL", 24 * 60 * 60))
+SQL_CACHE_STATS = {"hits": 0, "misses": 0, "bypassed": 0, "errors": 0}
+
+
+def get_sql_cache_stats() -> dict[str, float]:
+    total = SQL_CACHE_STATS["hits"] + SQL_CACHE_STATS["misses"]
+    return {
+        **SQL_CACHE_STATS,
+        "hit_rate": SQL_CACHE_STATS["hits"] / total if total else 0.0,
+    }
+
+
+register_cache_stats("sql_generation", get_sql_cache_stats)
+
+
+def to_jsonable(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    return str(obj)
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.split())
+
+
+def get_sql_cache_key(
+    question: str,
+    db_name: str,
+    db_type: str,
+    hard_filters: list | None,
+    previous_context: list | None,
+    provider: str,
+    model_name: str,
+    num_golden_queries: int,
+    schema_format: str | None = None,
+    hedge_provider: str | None = None,
+    hedge_model_name: str | None = None,
+    date_today: str | None = None,
+    token_budget: BaseModel | None = None,
+    prompt_layout: str | None = None,
+) -> str | None:
+    """
+    Returns the cache key for a SQL generation request, or None if the schema /
+    golden queries versions can't be read (in which case we shouldn't cache).
+    Everything else that goes into the prompt (e.g. date_today, which relative
+    dates in the question are resolved against) must be part of the key.
+    """
+    schema_version = get_schema_version(db_name)
+    golden_queries_version = get_golden_queries_version(db_name)
+    if schema_version is None or golden_queries_version is None:
+        return None
+    key_inputs = json.dumps(
+        {
+            "question": normalize_question(question),
+            "db_name": db_name,
+            "db_type": db_type,
+            "schema_version": schema_version,
+            "golden_queries_version": golden_queries_version,
+            "hard_filters": hard_filters or [],
+            "previous_context": previous_context or [],
+            "provider": provider,
+            "model_name": model_name,
+            "num_golden_queries": num_golden_queries,
+            "schema_format": schema_format,
+            "hedge_provider": hedge_provider,
+            "hedge_model_name": hedge_model_name,
+            "date_today": date_today,
+            "token_budget": token_budget,
+            "prompt_layout": prompt_layout,
+        },
+        sort_keys=True,
+        default=to_jsonable,
+    )
+    return f"sql_generation:{db_name}:{hashlib.sha256(key_inputs.encode('utf-8')).hexdigest()}"
+
+
+def get_cached_sql(cache_key: str) -> str | None:
+    try:
+        sql = redis_client.get(cache_key)
+    except redis.RedisError as e:
+        LOGGER.warning(f"Could not read generated SQL from redis: {e}")
+        SQL_CACHE_STATS["errors"] += 1
+        return None
+    if sql is None:
+        SQL_CACHE_STATS["misses"] += 1
+    else:
+        SQL_CACHE_STATS["hits"] += 1
+    return sql
+
+
+def cache_sql(cache_key: str, sql: str) -> None:
+    try:
+        redis_client.set(cache_key, sql, ex=SQL_CACHE_TTL)
+    except redis.RedisError as e:
+        LOGGER.warning(f"Could not write generated SQL to redis: {e}")
+        SQL_CACHE_STATS["errors"] += 1
@@ -0,0 +1,278 @@
+##############################################
+### SQL Validation Related Functions Below ###
+##############################################
+
+import difflib
+import os
+import re
+from dataclasses import dataclass, field
+
+from sqlglot import exp, parse_one
+from sqlglot.optimizer.scope import Scope, traverse_scope
+from utils_logging import LOGGER
+from utils_schema_context import get_schema_context
+
+# columns that aren't in the metadata are replaced with the closest column in
+# the metadata, if it is the only one at least this similar
+SQL_FUZZY_MATCH_CUTOFF = float(os.getenv("SQL_FUZZY_MATCH_CUTOFF", 0.85))
+
+
+@dataclass
+class SQLValidationResult:
+    """
+    The outcome of `validate_sql`.
+    `sql` has any misspelled columns replaced (and is unchanged if `fixes` is
+    empty). `errors` describes the columns of known tables that could not be
+    resolved against the metadata, and is empty if the SQL is valid.
+    `warnings` lists the tables that aren't in the metadata (e.g. system
+    catalogs, or tables that weren't selected), which can't be checked, along
+    with the closest table in the metadata if there is one.
+    """
+
+    sql: str
+    errors: list[str] = field(default_factory=list)
+    fixes: list[str] = field(default_factory=list)
+    warnings: list[str] = field(default_factory=list)
+
+
+@dataclass
+class MetadataIndex:
+    """
+    The tables and columns of a metadata list, keyed by their lowercased names.
+    `columns` maps each full table name (with its schema, if any) to its
+    columns, and `short_names` maps each table name without its schema to the
+    full table names it could refer to.
+    """
+
+    columns: dict[str, dict[str, str]]
+    short_names: dict[str, list[str]]
+    table_names: dict[str, str]
+
+
+def mk_metadata_index(metadata: list[dict[str, str]]) -> MetadataIndex:
+    columns, short_names, table_names = {}, {}, {}
+    for column in metadata:
+        full_name = column["table_name"].lower()
+        if full_name not in columns:
+            columns[full_name] = {}
+            table_names[full_name] = column["table_name"]
+            short_names.setdefault(full_name.rsplit(".", 1)[-1], []).append(full_name)
+        columns[full_name][column["column_name"].lower()] = column["column_name"]
+    return MetadataIndex(columns, short_names, table_names)
+
+
+def get_close_match(name: str, candidates: list[str]) -> str | None:
+    """
+    Returns the only candidate that is at least SQL_FUZZY_MATCH_CUTOFF similar
+    to the name, or None if there are none or several. Candidates with different
+    digits (e.g. `sales_2023` vs `sales_2024`) are never a match.
+    """
+    digits = re.sub(r"\D", "", name)
+    candidates = [c for c in candidates if re.sub(r"\D", "", c) == digits]
+    matches = difflib.get_close_matches(name, candidates, n=2, cutoff=SQL_FUZZY_MATCH_CUTOFF)
+    return matches[0] if len(matches) == 1 else None
+
+
+def resolve_table(table: exp.Table, index: MetadataIndex) -> str | None:
+    """
+    Returns the full (lowercased) name of the table in the metadata, or None.
+    """
+    name = table.name.lower()
+    if table.db:
+        full_name = f"{table.db.lower()}.{name}"
+        return full_name if full_name in index.columns else None
+    if name in index.columns:
+        return name
+    full_names = index.short_names.get(name, [])
+    return full_names[0] if len(full_names) == 1 else None
+
+
+def get_source_columns(source, tables: dict[int, str], index: MetadataIndex) -> set[str] | None:
+    """
+    Returns the lowercased columns available from a source in a scope, or None
+    if they can't be known (e.g. a derived table that selects *).
+    """
+    if isinstance(source, exp.Table):
+        full_name = tables.get(id(source))
+        return set(index.columns[full_name]) if full_name else None
+    if isinstance(source, Scope) and isinstance(source.expression, exp.Query):
+        if source.expression.is_star:
+            return None
+        return {name.lower() for name in source.expression.named_selects}
+    return None
+
+
+def validate_sql(sql: str, db_type: str, metadata: list[dict[str, str]]) -> SQLValidationResult:
+    """
+    Resolve every table and column referenced in the SQL against the metadata,
+    using sqlglot's scopes so that CTEs, subqueries, aliases and correlated
+    references are handled.
+    Columns of tables in the metadata that aren't in the metadata but are a
+    close match to exactly 1 column that is (e.g. `custmer_id` vs
+    `customer_id`) are replaced with it.
+    Columns of tables in the metadata that can't be resolved are returned as
+    errors. Tables that aren't in the metadata may still exist in the database,
+    so they are returned as warnings, and their columns aren't checked.
+    Other references that can't be checked (e.g. columns of table functions, or
+    SQL that sqlglot can't parse) are assumed to be valid.
+    """
+    if not metadata:
+        return SQLValidationResult(sql)
+    dialect = "tsql" if db_type == "sqlserver" else db_type
+    try:
+        parsed = parse_one(sql, read=dialect)
+    except Exception as e:
+        LOGGER.debug(f"Could not parse SQL for validation, skipping it: {str(e)}")
+        return SQLValidationResult(sql)
+
+    index = mk_metadata_index(metadata)
+    try:
+        errors, fixes, warnings = resolve_references(parsed, index, dialect)
+    except Exception as e:
+        LOGGER.warning(f"Could not validate SQL, skipping validation: {str(e)}")
+        return SQLValidationResult(sql)
+
+    if warnings:
+        LOGGER.info(f"Could not fully validate SQL: {'; '.join(warnings)}")
+    if errors:
+        return SQLValidationResult(sql, errors, fixes, warnings)
+    if fixes:
+        LOGGER.info(f"Fixed generated SQL: {'; '.join(fixes)}")
+        return SQLValidationResult(parsed.sql(dialect=dialect, pretty=True), errors, fixes, warnings)
+    return SQLValidationResult(sql, warnings=warnings)
+
+
+def resolve_references(
+    parsed: exp.Expression, index: MetadataIndex, dialect: str
+) -> tuple[list[str], list[str], list[str]]:
+    """
+    Resolve the tables and columns in the AST against the metadata index, fixing
+    misspelled columns of known tables in place. Returns the errors, fixes and warnings.
+    """
+    errors, fixes, warnings = [], [], []
+
+    # resolve the tables first, since the columns are resolved against them
+    cte_names = {cte.alias_or_name.lower() for cte in parsed.find_all(exp.CTE)}
+    tables = {}
+    for table in parsed.find_all(exp.Table):
+        if not table.name or (not table.db and table.name.lower() in cte_names):
+            continue
+        full_name = resolve_table(table, index)
+        if full_name is None:
+            # tables that aren't in the metadata may exist in the database (e.g.
+            # `customer` and `customers` can both exist), so they are never
+            # replaced. The closest table is only suggested.
+            match = None
+            if not table.catalog:
+                candidates = list(index.columns) if table.db else list(index.short_names)
+                name = f"{table.db}.{table.name}".lower() if table.db else table.name.lower()
+                match = get_close_match(name, candidates)
+            suggestion = ""
+            if match is not None:
+                full_match = match if table.db else index.short_names[match][0]
+                suggestion = f" (did you mean `{index.table_names[full_match]}`?)"
+            warnings.append(
+                f"Table `{exp.table_name(table, dialect=dialect)}` is not in the metadata{suggestion}, so it was not checked"
+            )
+            continue
+        tables[id(table)] = full_name
+
+    for scope in traverse_scope(parsed):
+        if not isinstance(scope.expression, exp.Select):
+            continue
+        aliases = {
+            projection.alias.lower()
+            for projection in scope.expression.expressions
+            if isinstance(projection, exp.Alias)
+        }
+        for column in scope.columns:
+            if not column.name or column.args.get("db") or isinstance(column.this, exp.Star):
+                continue
+            # the columns of a scope include those of its correlated subqueries,
+            # which are checked in their own scope
+            if column.find_ancestor(exp.Select) is not scope.expression:
+                continue
+            name = column.name.lower()
+            if column.table:
+                # qualified column: check it against its table in this scope or
+                # an outer scope (for correlated subqueries)
+                source, outer_scope = None, scope
+                while outer_scope is not None and source is None:
+                    source = outer_scope.sources.get(column.table)
+                    outer_scope = outer_scope.parent
+                available = get_source_columns(source, tables, index) if source else None
+                if available is None or name in available:
+                    continue
+                match = get_close_match(name, list(available))
+                if match is not None and isinstance(source, exp.Table):
+                    fixed_name = index.columns[tables[id(source)]][match]
+                    fixes.append(f"Replaced column `{column.table}.{column.name}` with `{column.table}.{fixed_name}`")
+                    column.set("this", exp.to_identifier(fixed_name))
+                    continue
+                errors.append(
+                    f"Column `{column.name}` does not exist in `{column.table}`"
+                    + (f" (did you mean `{match}`?)" if match else "")
+                )
+            else:
+                # unqualified column: it can come from any table in this scope or
+                # an outer scope, or be an alias of a selected expression
+                if name in aliases:
+                    continue
+                available, all_known, outer_scope = {}, True, scope
+                while outer_scope is not None:
+                    for source in outer_scope.sources.values():
+                        source_columns = get_source_columns(source, tables, index)
+                        if source_columns is None:
+                            all_known = False
+                            continue
+                        for source_column in source_columns:
+                            available.setdefault(source_column, source)
+                    outer_scope = outer_scope.parent
+                if name in available or not all_known:
+                    continue
+                match = get_close_match(name, list(available))
+                if match is not None and isinstance(available[match], exp.Table):
+                    fixed_name = index.columns[tables[id(available[match])]][match]
+                    fixes.append(f"Replaced column `{column.name}` with `{fixed_name}`")
+                    column.set("this", exp.to_identifier(fixed_name))
+                    continue
+                errors.append(
+                    f"Column `{column.name}` does not exist in any of the tables in the query"
+                    + (f" (did you mean `{match}`?)" if match else "")
+                )
+
+    return list(dict.fromkeys(errors)), list(dict.fromkeys(fixes)), list(dict.fromkeys(warnings))
+
+
+async def validate_sql_for_db(db_name: str, db_type: str, sql: str) -> SQLValidationResult:
+    """
+    Validate the SQL against the stored metadata of a db_name (see `validate_sql`).
+    The SQL is assumed to be valid if the metadata can't be retrieved.
+    """
+    try:
+        schema_context = await get_schema_context(db_name)
+    except Exception as e:
+        LOGGER.warning(f"Could not get metadata to validate SQL for {db_name}: {str(e)}")
+        return SQLValidationResult(sql)
+    return validate_sql(sql, db_type, schema_context.metadata)
+
+
+def get_validation_hints(result: SQLValidationResult) -> str:
+    """
+    Describe the tables that couldn't be checked, for the LLM that fixes SQL
+    that failed in the database (e.g. because one of those tables doesn't exist).
+    """
+    if not result.warnings:
+        return ""
+    return "\nThe query references tables that aren't in the metadata:\n" + "\n".join(
+        f"- {warning}" for warning in result.warnings
+    )
+
+
+def get_validation_error(result: SQLValidationResult) -> str:
+    """
+    Describe the errors of a validation result for the LLM that fixes the SQL.
+    """
+    return "The query references columns that don't exist in the database:\n" + "\n".join(
+        f"- {error}" for error in result.errors
+    )
@@ -8,6 +8,8 @@ from pydantic import BaseModel
 from request_models import TableDescription
 from sqlalchemy import delete, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from utils_cache import bump_schema_version
+from utils_column_embeddings import schedule_column_embeddings_refresh
 from utils_logging import LOGGER
 from utils_md import mk_create_ddl
 
@@ -89,6 +91,8 @@ async def update_table_descriptions(
                             table_description=description,
                         )
                         session.add(new_table_info)
+        bump_schema_version(db_name)
+        schedule_column_embeddings_refresh(db_name)
     except Exception as e:
         LOGGER.error(f"Error updating table descriptions: {str(e)}")
 
@@ -114,6 +118,8 @@ async def delete_table_descriptions(db_name: str, table_names: list[str] = []) -
                                 TableInfo.table_name == table_name,
                             )
                         )
+        bump_schema_version(db_name)
+        schedule_column_embeddings_refresh(db_name)
     except Exception as e:
         LOGGER.error(f"Error deleting table descriptions: {str(e)}")
 
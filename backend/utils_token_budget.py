@@ -0,0 +1,465 @@
+############################################
+### Token Budget Related Functions Below ###
+############################################
+
+import asyncio
+import math
+import os
+import time
+from typing import Any
+
+import tiktoken
+from pydantic import BaseModel
+from request_models import SchemaFormat, TableDescription
+from utils_embedding import get_embedding
+from utils_logging import LOGGER
+from utils_md import mk_schema_prompt
+from utils_schema_pruning import score_columns
+
+# rough number of characters per token, used when the tokenizer can't be loaded
+CHARS_PER_TOKEN = 4
+# seconds to wait before trying to load a tokenizer again after it failed to load
+ENCODING_RETRY_INTERVAL = 60
+
+# encodings to load at startup, so that the first requests don't have to
+# download them. o200k_base is also used for models tiktoken doesn't know.
+PRELOAD_ENCODINGS = os.getenv("PRELOAD_TOKENIZER_ENCODINGS", "o200k_base").split(",")
+
+# tokenizers by model name, when each tokenizer that couldn't be loaded last
+# failed, and the background tasks loading tokenizers
+ENCODINGS: dict[str, tiktoken.Encoding] = {}
+ENCODING_FAILURES: dict[str, float] = {}
+ENCODING_LOAD_TASKS: dict[str, asyncio.Task] = {}
+
+
+class TokenBudget(BaseModel):
+    """
+    Maximum number of tokens for each variable section of a prompt, and for the
+    whole prompt (including the fixed parts like the system prompt and question).
+    """
+
+    total: int = int(os.getenv("PROMPT_TOKEN_BUDGET", 100_000))
+    ddl: int = int(os.getenv("PROMPT_DDL_TOKEN_BUDGET", 80_000))
+    instructions: int = int(os.getenv("PROMPT_INSTRUCTIONS_TOKEN_BUDGET", 10_000))
+    golden_queries: int = int(os.getenv("PROMPT_GOLDEN_QUERIES_TOKEN_BUDGET", 10_000))
+    previous_context: int = int(os.getenv("PROMPT_PREVIOUS_CONTEXT_TOKEN_BUDGET", 10_000))
+
+
+class BudgetedPrompt(BaseModel):
+    """
+    The sections of a prompt after they have been trimmed to fit a TokenBudget,
+    along with a description of everything that was cut.
+    """
+
+    metadata: list[dict[str, str]]
+    table_descriptions: list[TableDescription]
+    ddl: str
+    instructions: str
+    golden_queries: list[Any]
+    previous_context: list[Any]
+    num_tokens: int
+    cuts: list[str]
+
+
+class SchemaTokenCounts(BaseModel):
+    """
+    Token counts of a schema rendered in one schema format with one tokenizer.
+    These are kept on the cached SchemaContext, so that the schema is only
+    tokenized once per schema version. Tables are keyed by their name and the
+    names of their columns, since schema pruning can drop some of their columns.
+    """
+
+    header: int
+    tables: dict[str, int] = {}
+
+
+def load_encoding(model_name: str) -> tiktoken.Encoding | None:
+    """
+    Load the tokenizer for a model. Models that tiktoken doesn't know (e.g. from
+    other providers) use o200k_base, which is close enough for budgeting.
+    This blocks while the tokenizer is downloaded on first use, so it must not be
+    called on the event loop - use `get_encoding` instead.
+    Returns None if the tokenizer can't be loaded. Only tokenizers that load are
+    cached.
+    """
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        LOGGER.warning(f"Could not load tokenizer for {model_name}, estimating token counts: {e}")
+        ENCODING_FAILURES[model_name] = time.monotonic()
+        return None
+    ENCODINGS[model_name] = encoding
+    ENCODING_FAILURES.pop(model_name, None)
+    return encoding
+
+
+def get_encoding(model_name: str) -> tiktoken.Encoding | None:
+    """
+    Get the tokenizer for a model if it has been loaded. Otherwise, it is loaded
+    in a background thread and None is returned, so that callers estimate token
+    counts instead of blocking the event loop on the download. Outside of an
+    event loop (e.g. in scripts), the tokenizer is loaded directly.
+    After a failure, loading is retried once ENCODING_RETRY_INTERVAL seconds
+    have passed.
+    """
+    encoding = ENCODINGS.get(model_name)
+    if encoding is not None:
+        return encoding
+    if model_name in ENCODING_LOAD_TASKS:
+        return None
+    if time.monotonic() - ENCODING_FAILURES.get(model_name, -math.inf) < ENCODING_RETRY_INTERVAL:
+        return None
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return load_encoding(model_name)
+    task = loop.create_task(asyncio.to_thread(load_encoding, model_name))
+    ENCODING_LOAD_TASKS[model_name] = task
+    task.add_done_callback(lambda _: ENCODING_LOAD_TASKS.pop(model_name, None))
+    return None
+
+
+async def preload_encodings():
+    """
+    Load the encodings in PRELOAD_ENCODINGS in a background thread. tiktoken
+    keeps loaded encodings in memory, so tokenizers of models using them load
+    without a download later.
+    """
+    for encoding_name in PRELOAD_ENCODINGS:
+        try:
+            await asyncio.to_thread(tiktoken.get_encoding, encoding_name.strip())
+        except Exception as e:
+            LOGGER.warning(f"Could not preload tokenizer encoding {encoding_name}: {e}")
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    if not text:
+        return 0
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def get_golden_query_text(golden_query: Any) -> str:
+    return f"{golden_query.question}\n{golden_query.sql}"
+
+
+def get_question_answer_text(question_answer: dict[str, str]) -> str:
+    return f"{question_answer['question']}\n{question_answer['sql']}"
+
+
+def trim_previous_context(
+    previous_context: list[dict[str, str]], max_tokens: int, model_name: str
+) -> list[dict[str, str]]:
+    """
+    Drop the oldest question / answer pairs until the rest fit in max_tokens.
+    """
+    num_tokens = [count_tokens(get_question_answer_text(qa), model_name) for qa in previous_context]
+    start = 0
+    while start < len(previous_context) and sum(num_tokens[start:]) > max_tokens:
+        start += 1
+    return previous_context[start:]
+
+
+def trim_golden_queries(
+    golden_queries: list[Any], max_tokens: int, model_name: str
+) -> list[Any]:
+    """
+    Drop the golden queries least similar to the question until the rest fit in
+    max_tokens. The order of the remaining golden queries is preserved.
+    """
+    num_tokens = [count_tokens(get_golden_query_text(gq), model_name) for gq in golden_queries]
+    # golden queries without a similarity keep their order of relevance
+    ranked_idx = sorted(
+        range(len(golden_queries)),
+        key=lambda i: (
+            golden_queries[i].similarity
+            if getattr(golden_queries[i], "similarity", None) is not None
+            else -i
+        ),
+        reverse=True,
+    )
+    kept_idx, total = set(), 0
+    for i in ranked_idx:
+        if total + num_tokens[i] > max_tokens:
+            break
+        kept_idx.add(i)
+        total += num_tokens[i]
+    return [gq for i, gq in enumerate(golden_queries) if i in kept_idx]
+
+
+def truncate_text(text: str, max_tokens: int, model_name: str) -> str:
+    """
+    Keep as many whole lines from the start of the text as fit in max_tokens.
+    """
+    if count_tokens(text, model_name) <= max_tokens:
+        return text
+    kept_lines, total = [], 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = count_tokens(line, model_name)
+        if total + line_tokens > max_tokens:
+            break
+        kept_lines.append(line)
+        total += line_tokens
+    return "".join(kept_lines)
+
+
+def count_schema_tokens(
+    metadata: list[dict[str, str]],
+    table_descriptions: list[TableDescription],
+    model_name: str,
+    schema_format: SchemaFormat = "ddl",
+    token_counts: dict[str, SchemaTokenCounts] | None = None,
+) -> tuple[int, dict[str, int]]:
+    """
+    Count the tokens of the header of schema_format (if any), and of the DDL of
+    each table without the header. The DDL of the whole schema is about the
+    header plus the tables.
+    If token_counts is given (e.g. from a SchemaContext), counts are read from
+    and saved to it. Estimated counts (when the tokenizer isn't loaded yet) are
+    not saved.
+    """
+    table_columns = {}
+    for column in metadata:
+        table_columns.setdefault(column["table_name"], []).append(column)
+
+    counts = None
+    encoding = get_encoding(model_name)
+    if token_counts is not None and encoding is not None:
+        key = f"{schema_format}:{encoding.name}"
+        counts = token_counts.get(key)
+        if counts is None:
+            counts = SchemaTokenCounts(
+                header=count_tokens(mk_schema_prompt([], [], schema_format), model_name)
+            )
+            token_counts[key] = counts
+    header_tokens = (
+        counts.header
+        if counts is not None
+        else count_tokens(mk_schema_prompt([], [], schema_format), model_name)
+    )
+
+    table_tokens = {}
+    for table_name, columns in table_columns.items():
+        table_key = "\n".join([table_name] + [column["column_name"] for column in columns])
+        num_tokens = counts.tables.get(table_key) if counts is not None else None
+        if num_tokens is None:
+            # the header of the schema format is rendered with every table, but
+            # only appears once in the full schema
+            num_tokens = count_tokens(
+                mk_schema_prompt(columns, table_descriptions, schema_format), model_name
+            ) - header_tokens
+            if counts is not None:
+                counts.tables[table_key] = num_tokens
+        table_tokens[table_name] = num_tokens
+    return header_tokens, table_tokens
+
+
+def truncate_ddl(
+    metadata: list[dict[str, str]],
+    table_descriptions: list[TableDescription],
+    max_tokens: int,
+    model_name: str,
+    table_scores: dict[str, float] | None = None,
+    schema_format: SchemaFormat = "ddl",
+    token_counts: dict[str, SchemaTokenCounts] | None = None,
+) -> tuple[list[dict[str, str]], list[TableDescription]]:
+    """
+    Keep the most relevant tables (by table_scores, or in their original order)
+    whose DDL (rendered in schema_format) fits in max_tokens. The original order
+    of the metadata is preserved. token_counts is passed to `count_schema_tokens`.
+    """
+    header_tokens, table_tokens = count_schema_tokens(
+        metadata, table_descriptions, model_name, schema_format, token_counts
+    )
+    table_names = list(table_tokens)
+    if table_scores:
+        table_names.sort(key=lambda t: table_scores.get(t, -1.0), reverse=True)
+
+    kept_tables, total = set(), header_tokens
+    for table_name in table_names:
+        if total + table_tokens[table_name] > max_tokens:
+            continue
+        kept_tables.add(table_name)
+        total += table_tokens[table_name]
+
+    return (
+        [column for column in metadata if column["table_name"] in kept_tables],
+        [td for td in table_descriptions if td.table_name in kept_tables],
+    )
+
+
+async def get_table_scores(
+    question: str,
+    metadata: list[dict[str, str]],
+    table_descriptions: list[TableDescription],
+    question_embedding: list[float] | None = None,
+    db_name: str | None = None,
+) -> dict[str, float]:
+    """
+    Score each table by the similarity of its most relevant column to the question.
+    """
+    if question_embedding is None:
+        question_embedding = await get_embedding(question)
+    scores = await score_columns(
+        question_embedding, metadata, table_descriptions, db_name=db_name
+    )
+    table_scores = {}
+    for column, score in zip(metadata, scores):
+        table_name = column["table_name"]
+        table_scores[table_name] = max(table_scores.get(table_name, -1.0), float(score))
+    return table_scores
+
+
+async def fit_prompt_to_budget(
+    model_name: str,
+    question: str,
+    fixed_text: str,
+    metadata: list[dict[str, str]],
+    table_descriptions: list[TableDescription] | None = None,
+    ddl: str | None = None,
+    instructions: str = "",
+    golden_queries: list[Any] | None = None,
+    previous_context: list[dict[str, str]] | None = None,
+    budget: TokenBudget | None = None,
+    question_embedding: list[float] | None = None,
+    db_name: str | None = None,
+    schema_format: SchemaFormat = "ddl",
+    token_counts: dict[str, SchemaTokenCounts] | None = None,
+) -> BudgetedPrompt:
+    """
+    Trim the variable sections of a prompt so that each fits its own budget, and
+    the whole prompt (including fixed_text, e.g. the prompt templates and the
+    question) fits the total budget. When the prompt is over the total budget,
+    sections are cut in this order:
+    1. the oldest previous question / answer pairs
+    2. the golden queries least similar to the question
+    3. the end of the instructions
+    4. the tables least relevant to the question
+    All cuts are logged, and returned in `cuts`.
+    The DDL is (re-)rendered in schema_format, which should match the format of
+    ddl if it is given.
+    If token_counts is given, the DDL's tokens are counted per table and cached
+    in it (see `count_schema_tokens`), so only the other sections are counted on
+    every call. It must only be given along with the schema context's metadata
+    and table descriptions (or a pruned subset of them).
+    """
+    budget = budget or TokenBudget()
+    table_descriptions = table_descriptions or []
+    golden_queries = golden_queries or []
+    previous_context = previous_context or []
+    instructions = instructions or ""
+    if ddl is None:
+        ddl = mk_schema_prompt(metadata, table_descriptions, schema_format)
+    cuts = []
+
+    fixed_tokens = count_tokens(fixed_text, model_name)
+    previous_context_tokens = sum(
+        count_tokens(get_question_answer_text(qa), model_name) for qa in previous_context
+    )
+    golden_queries_tokens = sum(
+        count_tokens(get_golden_query_text(gq), model_name) for gq in golden_queries
+    )
+    instructions_tokens = count_tokens(instructions, model_name)
+
+    def get_ddl_tokens() -> int:
+        if token_counts is None:
+            return count_tokens(ddl, model_name)
+        header_tokens, table_tokens = count_schema_tokens(
+            metadata, table_descriptions, model_name, schema_format, token_counts
+        )
+        return header_tokens + sum(table_tokens.values())
+
+    ddl_tokens = get_ddl_tokens()
+
+    def get_overflow() -> int:
+        return (
+            fixed_tokens
+            + previous_context_tokens
+            + golden_queries_tokens
+            + instructions_tokens
+            + ddl_tokens
+            - budget.total
+        )
+
+    def get_max_tokens(section_budget: int, section_tokens: int) -> int:
+        return max(0, min(section_budget, section_tokens - max(0, get_overflow())))
+
+    max_tokens = get_max_tokens(budget.previous_context, previous_context_tokens)
+    if previous_context_tokens > max_tokens:
+        trimmed = trim_previous_context(previous_context, max_tokens, model_name)
+        cuts.append(f"dropped {len(previous_context) - len(trimmed)} oldest previous questions")
+        previous_context = trimmed
+        previous_context_tokens = sum(
+            count_tokens(get_question_answer_text(qa), model_name) for qa in previous_context
+        )
+
+    max_tokens = get_max_tokens(budget.golden_queries, golden_queries_tokens)
+    if golden_queries_tokens > max_tokens:
+        trimmed = trim_golden_queries(golden_queries, max_tokens, model_name)
+        cuts.append(f"dropped {len(golden_queries) - len(trimmed)} least similar golden queries")
+        golden_queries = trimmed
+        golden_queries_tokens = sum(
+            count_tokens(get_golden_query_text(gq), model_name) for gq in golden_queries
+        )
+
+    max_tokens = get_max_tokens(budget.instructions, instructions_tokens)
+    if instructions_tokens > max_tokens:
+        instructions = truncate_text(instructions, max_tokens, model_name)
+        new_instructions_tokens = count_tokens(instructions, model_name)
+        cuts.append(
+            f"truncated instructions from {instructions_tokens} to {new_instructions_tokens} tokens"
+        )
+        instructions_tokens = new_instructions_tokens
+
+    max_tokens = get_max_tokens(budget.ddl, ddl_tokens)
+    if ddl_tokens > max_tokens:
+        try:
+            table_scores = await get_table_scores(
+                question, metadata, table_descriptions, question_embedding, db_name
+            )
+        except Exception as e:
+            LOGGER.warning(f"Could not score tables, truncating the DDL in order: {e}")
+            table_scores = None
+        num_tables = len({column["table_name"] for column in metadata})
+        metadata, table_descriptions = truncate_ddl(
+            metadata,
+            table_descriptions,
+            max_tokens,
+            model_name,
+            table_scores,
+            schema_format,
+            token_counts,
+        )
+        ddl = mk_schema_prompt(metadata, table_descriptions, schema_format)
+        new_ddl_tokens = get_ddl_tokens()
+        cuts.append(
+            f"dropped {num_tables - len({column['table_name'] for column in metadata})} least relevant tables "
+            f"from the DDL ({ddl_tokens} to {new_ddl_tokens} tokens)"
+        )
+        ddl_tokens = new_ddl_tokens
+
+    num_tokens = get_overflow() + budget.total
+    if cuts:
+        LOGGER.info(
+            f"Trimmed prompt for {model_name} to {num_tokens} tokens "
+            f"(budget {budget.total}): {'; '.join(cuts)}"
+        )
+    if num_tokens > budget.total:
+        LOGGER.warning(
+            f"Prompt for {model_name} is still {num_tokens} tokens after trimming (budget {budget.total})"
+        )
+    return BudgetedPrompt(
+        metadata=metadata,
+        table_descriptions=table_descriptions,
+        ddl=ddl,
+        instructions=instructions,
+        golden_queries=golden_queries,
+        previous_context=previous_context,
+        num_tokens=num_tokens,
+        cuts=cuts,
+    )
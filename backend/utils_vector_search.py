@@ -0,0 +1,74 @@
+##############################################
+### Vector Search Related Functions Below ###
+##############################################
+
+from sqlalchemy import func, literal_column, select, text
+from utils_logging import LOGGER
+
+# pgvector only supports iterative index scans from 0.8.0 onwards
+ITERATIVE_SCAN_MIN_VERSION = (0, 8)
+# maximum value of hnsw.ef_search supported by pgvector
+MAX_EF_SEARCH = 1000
+
+# whether the internal db's pgvector supports iterative index scans. This is
+# checked once per process, the first time an index is searched.
+ITERATIVE_SCAN_SUPPORTED: bool | None = None
+
+
+def parse_pgvector_version(version: str) -> tuple[int, ...]:
+    return tuple(int(part) for part in version.split(".") if part.isdigit())
+
+
+async def supports_iterative_scan(conn) -> bool:
+    global ITERATIVE_SCAN_SUPPORTED
+    if ITERATIVE_SCAN_SUPPORTED is None:
+        result = await conn.execute(
+            text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        )
+        version = result.scalar_one_or_none()
+        ITERATIVE_SCAN_SUPPORTED = (
+            version is not None
+            and parse_pgvector_version(version) >= ITERATIVE_SCAN_MIN_VERSION
+        )
+        LOGGER.info(
+            f"pgvector version {version}, iterative index scans supported: {ITERATIVE_SCAN_SUPPORTED}"
+        )
+    return ITERATIVE_SCAN_SUPPORTED
+
+
+async def count_matching_rows(conn, stmt, limit: int) -> int:
+    """
+    Count the rows that pass the filters of a search `stmt`, up to `limit`.
+    Only the filters are evaluated, not the distances.
+    """
+    matching = stmt.with_only_columns(literal_column("1")).order_by(None).limit(limit)
+    result = await conn.execute(select(func.count()).select_from(matching.subquery()))
+    return result.scalar_one()
+
+
+async def search_hnsw_index(conn, stmt, limit: int, ef_search: int) -> list:
+    """
+    Run a nearest neighbour search `stmt` (ordered by distance and limited to
+    `limit` rows) on an HNSW index within the transaction of `conn`, which can
+    be a connection or a session.
+    The index is scanned before the search's filters (e.g. on db_name) are
+    applied, so a plain index scan can return fewer than `limit` rows when many
+    db_names share the index. Iterative scans are used to keep scanning the
+    index until enough rows pass the filters if pgvector supports them.
+    Otherwise, if fewer than `limit` rows come back but more rows pass the
+    filters (e.g. the db_name has enough rows), the search is repeated without
+    the index, which is exact. `stmt` must be a select statement.
+    """
+    await conn.execute(text(f"SET LOCAL hnsw.ef_search = {min(max(ef_search, limit), MAX_EF_SEARCH)}"))
+    iterative_scan = await supports_iterative_scan(conn)
+    if iterative_scan:
+        await conn.execute(text("SET LOCAL hnsw.iterative_scan = strict_order"))
+    rows = (await conn.execute(stmt)).all()
+    if (
+        len(rows) < limit
+        and not iterative_scan
+        and await count_matching_rows(conn, stmt, limit) > len(rows)
+    ):
+        await conn.execute(text("SET LOCAL enable_indexscan = off"))
+        rows = (await conn.execute(stmt)).all()
+    return rows